@@ -1,52 +1,87 @@
+# 最先导入，之后的导入耗时计入启动报告
+from startup import startup_profile
 import os
-import sqlite3
 from flask import Flask
-from config import Config
-from extensions import db, login_manager
+from config import Config, get_fixed_secret_key
+from extensions import db, login_manager, upstream_clients
+from billing import ledger_writer
+from database import init_database
+from documents import document_parser
+from catalog import model_catalog
+from official import official_pool
+from limits import limiter
+from conversations import conversation_store
+from retrieval import document_index
+from streams import stream_registry
+from response_cache import response_cache
+from assets import asset_pipeline
+from identity import identity_cache
+from shared import shared_state
 
 # 注册蓝图
-from routes import auth, user, chat, main
+from routes import auth, user, chat, conversation, main, metrics
+
+startup_profile.mark('imports')
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.config['SECRET_KEY'] = get_fixed_secret_key()
+startup_profile.budget = app.config['STARTUP_IMPORT_BUDGET_MS'] / 1000
+startup_profile.mark('config')
 
-# 初始化插件
-db.init_app(app)
-login_manager.init_app(app)
+# 初始化插件 (shared_state 需在 balance_cache / identity_cache / model_catalog / stream_registry 之后，把它们切换到跨进程后端)
+for component in (db, login_manager, identity_cache, upstream_clients, ledger_writer, document_parser, model_catalog,
+                  official_pool, limiter, conversation_store, document_index, stream_registry,
+                  response_cache, asset_pipeline, shared_state):
+    startup_profile.init(component, app)
 
 # 注册 Blueprints
 app.register_blueprint(auth.bp)
 app.register_blueprint(user.bp)
 app.register_blueprint(chat.bp)
+app.register_blueprint(conversation.bp)
 app.register_blueprint(main.bp)
+app.register_blueprint(metrics.bp)
+
+startup_profile.mark('blueprints')
+
+# 建表与版本化迁移 (任何 WSGI 入口导入 app 时都会执行)
+with startup_profile.phase('database'):
+    init_database(app)
+
+if app.config['STARTUP_WARMUP']: startup_profile.warm_up(document_parser)
+if app.config['STARTUP_REPORT'] or startup_profile.over_budget(): print(startup_profile.report())
 
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
-        # 数据库迁移检查
-        try:
-            inspector = db.inspect(db.engine)
-            columns = [c['name'] for c in inspector.get_columns('user')]
-            if 'points' not in columns:
-                print("Detected missing 'points' column. Migrating database...")
-                with sqlite3.connect('users.db') as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('ALTER TABLE user ADD COLUMN points INTEGER DEFAULT 1000')
-                    conn.commit()
-                print("Migration successful.")
-        except Exception as e:
-            print(f"Migration check skipped: {e}")    
-    
     port = int(os.environ.get('PORT', 5000))
     env_name = os.environ.get('FLASK_ENV', 'development')
     
-    if env_name == 'production':
+    if env_name == 'production' and app.config['ASYNC_MODE']:
+        try:
+            import uvicorn
+            from asgi import ChatASGI
+            print(f"WARNING: Production mode detected.")
+            print(f" * Serving with Uvicorn (Async streaming mode)")
+            print(f" * Listening on http://0.0.0.0:{port}")
+            uvicorn.run(ChatASGI(app), host='0.0.0.0', port=port, log_level='warning')
+        except ImportError:
+            print("[Error] 'uvicorn' 模块未安装。请运行: pip install uvicorn")
+    elif env_name == 'production' and app.config['WEB_WORKERS'] != 1 and os.name == 'posix':
+        # 多进程：主进程持有监听套接字，worker 为重新导入 app 的子进程
+        from prefork import Arbiter
+        print(f"WARNING: Production mode detected.")
+        print(f" * Serving with Waitress (prefork, graceful reload on SIGHUP)")
+        Arbiter('0.0.0.0', port, app.config['WEB_WORKERS'], app.config['WEB_THREADS'], app.config['GRACEFUL_TIMEOUT']).run()
+    elif env_name == 'production':
         try:
             from waitress import serve
+            if app.config['WEB_WORKERS'] != 1:
+                # prefork 依赖 SIGHUP 与 pass_fds 继承套接字，Windows 上不可用
+                print(f" * WEB_WORKERS is only supported on Linux / macOS, falling back to a single process")
             print(f"WARNING: Production mode detected.")
             print(f" * Serving with Waitress (Production WSGI Server)")
             print(f" * Listening on http://0.0.0.0:{port}")
-            serve(app, host='0.0.0.0', port=port, threads=6)
+            serve(app, host='0.0.0.0', port=port, threads=app.config['WEB_THREADS'])
         except ImportError:
             print("[Error] 'waitress' 模块未安装。请运行: pip install waitress")
             app.run(host='0.0.0.0', port=port, debug=False)
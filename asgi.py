@@ -0,0 +1,244 @@
+import io
+import sys
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import request
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from extensions import upstream_clients
+from streaming import sse_error
+from streams import stream_registry
+from routes.chat import (prepare_chat, new_transcoder, new_probe, settle_job, stream_headers, replay_cached,
+                         relay_attempts, relay_aborted, BUSY_ERROR)
+
+# ================= 异步服务模式 =================
+# 用法: ASYNC_MODE=true FLASK_ENV=production python app.py
+#   或: uvicorn asgi:application --host 0.0.0.0 --port 5000
+# /api/chat 的上游转发运行在事件循环上 (httpx.AsyncClient)，一个进程即可挂起成千上万条流；
+# 其余路由原样交给 Flask，在线程池 (ASYNC_WSGI_THREADS) 中同步执行。带 Content-Length 的响应一次发送；
+# 流式响应 (如 /api/chat/multi) 逐块转发，转发期间占用独立线程池 (ASYNC_STREAM_THREADS) 的一个线程，
+# 长时间挂起的流不会占满处理普通请求的线程池。
+
+ASYNC_ROUTES = {('POST', '/api/chat')}
+
+def build_environ(scope, body):
+    """把 ASGI scope 转换成 WSGI environ (PEP 3333)"""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1] or 80)
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = client[0], str(client[1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type': key = 'CONTENT_TYPE'
+        elif name == 'content-length': key = 'CONTENT_LENGTH'
+        else: key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ: value = f"{environ[key]},{value}"
+        environ[key] = value
+    return environ
+
+def encode_headers(headers):
+    return [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+def sse_headers(job, extra):
+    """流式回复的响应头；extra 为 process_response 给出的头 (Set-Cookie、after_request 添加的头等)"""
+    return [('Content-Type', 'text/event-stream; charset=utf-8'), ('Cache-Control', 'no-cache')] + \
+        list(stream_headers(job).items()) + extra
+
+class ChatASGI:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config.get('ASYNC_WSGI_THREADS', 16),
+            thread_name_prefix='wsgi'
+        )
+        self.stream_executor = ThreadPoolExecutor(
+            max_workers=flask_app.config.get('ASYNC_STREAM_THREADS', 64),
+            thread_name_prefix='wsgi-stream'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        body = await self.read_body(receive)
+        environ = build_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        if (scope['method'], scope['path']) in ASYNC_ROUTES:
+            received = time.perf_counter()
+            job, headers, error = await loop.run_in_executor(self.executor, self.prepare, environ)
+            if error:
+                return await self.send_response(send, *error)
+            if job['cached'] is not None:
+                return await self.send_cached(job, headers, send, received)
+            return await self.stream_chat(job, headers, receive, send, received)
+        await self.send_wsgi(environ, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await upstream_clients.aclose_all()
+                self.executor.shutdown(wait=False)
+                self.stream_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def send_response(self, send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def run_wsgi(self, environ):
+        """返回 (status, headers, body, result)：带 Content-Length 时 body 为完整响应体、result 为 None；
+        否则 body 为 None，由调用方逐块读取 result 并负责 close()"""
+        state = {}
+        def start_response(status, headers, exc_info=None):
+            state['status'] = int(status.split(' ', 1)[0])
+            state['headers'] = headers
+        result = self.flask_app(environ, start_response)
+        if not any(name.lower() == 'content-length' for name, _ in state['headers']):
+            return state['status'], state['headers'], None, result
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'): result.close()
+        return state['status'], state['headers'], body, None
+
+    async def send_wsgi(self, environ, receive, send):
+        loop = asyncio.get_running_loop()
+        status, headers, body, result = await loop.run_in_executor(self.executor, self.run_wsgi, environ)
+        if result is None:
+            return await self.send_response(send, status, headers, body)
+        chunks, stop = asyncio.Queue(), threading.Event()
+        watcher = asyncio.create_task(self.watch_disconnect(receive, stop.set))
+        loop.run_in_executor(self.stream_executor, self.drain_wsgi, result, loop, chunks, stop)
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+            while (chunk := await chunks.get()) is not None and not stop.is_set():
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not stop.is_set():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watcher.cancel()
+            stop.set()
+
+    def drain_wsgi(self, result, loop, chunks, stop):
+        """在一个线程池线程里迭代并关闭 WSGI 响应 (stream_with_context 推入的上下文必须在同一线程弹出)，
+        逐块交给事件循环；客户端断开后在下一块 (最迟一个心跳间隔) 读到时停止，close() 触发生成器的清理 (取消流、结算)"""
+        try:
+            # 排队期间客户端已断开时不再开始迭代，close() 时由 call_on_close 退还预扣点数
+            if not stop.is_set():
+                for chunk in result:
+                    if stop.is_set(): break
+                    if chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+        finally:
+            if hasattr(result, 'close'): result.close()
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    def prepare(self, environ):
+        """在线程池中完成鉴权、读取设置与计费，返回 (job, 响应头, None) 或 (None, None, 响应三元组)。
+        与 WSGI 路径一样经过 process_response (保存会话、after_request)，其产生的头随流式回复一起发送"""
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                if not current_user.is_authenticated:
+                    resp = app.make_response(app.login_manager.unauthorized())
+                else:
+                    job, error = prepare_chat(request.get_json(silent=True) or {})
+                    if not error:
+                        resp = app.process_response(app.response_class())
+                        # 去掉空响应自带的内容头，流式回复有自己的 Content-Type
+                        headers = [(k, v) for k, v in resp.headers.to_wsgi_list()
+                                   if k.lower() not in ('content-type', 'content-length')]
+                        return job, headers, None
+                    resp = app.make_response(error)
+            except HTTPException as e:
+                resp = e.get_response(environ)
+            resp = app.process_response(resp)
+            return None, None, (resp.status_code, resp.headers.to_wsgi_list(), resp.get_data())
+
+    async def send_cached(self, job, headers, send, received):
+        transcoder = new_transcoder(job, self.flask_app.config)
+        frames = await asyncio.get_running_loop().run_in_executor(
+            self.executor, replay_cached, job, transcoder, new_probe(job, received))
+        await self.send_response(send, 200, sse_headers(job, headers), ''.join(frames).encode('utf-8'))
+
+    async def watch_disconnect(self, receive, on_disconnect):
+        """请求体已读完，之后 receive() 只会返回 http.disconnect"""
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                on_disconnect()
+                return
+
+    async def stream_chat(self, job, headers, receive, send, received):
+        """异步转发，决策逻辑与 routes.chat.relay_upstream 共用 (relay_attempts / RelayAttempt)，这里只做 I/O"""
+        watcher = asyncio.create_task(self.watch_disconnect(receive, lambda: job['stream'].cancel('disconnect')))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': encode_headers(sse_headers(job, headers))})
+        transcoder = new_transcoder(job, self.flask_app.config)
+        probe = new_probe(job, received)
+        try:
+            for relay in relay_attempts(job, transcoder, probe):
+                if relay is None:
+                    await self.send_frames(send, [sse_error(BUSY_ERROR)])
+                    break
+                with relay:
+                    target = relay.target
+                    client = upstream_clients.get_async(target['url'])
+                    async with client.stream("POST", target['url'], json=job['payload'], headers=target['headers'],
+                                             timeout=upstream_clients.timeout(stream_registry.read_timeout)) as response:
+                        relay.connected(response.status_code)
+                        if response.status_code != 200:
+                            err_text = (await response.aread()).decode('utf-8')
+                            await self.send_frames(send, relay.rejected(response.status_code, err_text))
+                            continue
+                        async for line in stream_registry.apump(response, job['stream'], transcoder.flush_due):
+                            await self.send_frames(send, relay.relay(line))
+                        await self.send_frames(send, relay.finish())
+        except Exception as e:
+            await self.send_frames(send, relay_aborted(job, transcoder, probe, e))
+        finally:
+            watcher.cancel()
+            probe.close()
+            await asyncio.get_running_loop().run_in_executor(self.executor, settle_job, job, transcoder, probe)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def send_frames(self, send, frames):
+        if frames: await send({'type': 'http.response.body', 'body': ''.join(frames).encode('utf-8'), 'more_body': True})
+
+def __getattr__(name):
+    # uvicorn asgi:application 时才导入 app，避免 python app.py 启动时重复创建 Flask 实例
+    if name == 'application':
+        global application
+        from app import app
+        application = ChatASGI(app)
+        return application
+    raise AttributeError(name)
@@ -0,0 +1,134 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+from flask import request, render_template, Response, abort
+
+# brotli 为可选依赖 (pip install brotli)，缺失时只提供 gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ================= 静态资源管线 =================
+# 启动时读取 static/ 下的全部文件，预先压缩 (br / gzip) 并计算哈希；
+# /assets/<构建号>/<路径> 为带指纹的地址，可永久缓存。构建号由所有文件的哈希汇总得到，
+# 同一构建内的相对路径 (ES module 的 import './modules/x.js'、CSS 里的 url()) 仍然落在同一前缀下。
+# /static/<路径> 保留，改为每次协商缓存 (ETag / 304)。
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'application/xml')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+class Asset:
+    """一个文件 (或渲染好的页面) 的原文、预压缩版本与 ETag"""
+
+    def __init__(self, body, mimetype, mtime=None, min_size=512):
+        self.mimetype = mimetype
+        self.mtime = mtime
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body}
+        if len(body) >= min_size and mimetype.startswith(COMPRESSIBLE):
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body): self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body): self.variants['br'] = compressed
+
+    def choose(self, accept_encodings):
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]: return encoding
+        return 'identity'
+
+    def response(self, cache_control):
+        encoding = self.choose(request.accept_encodings)
+        response = Response(self.variants[encoding], mimetype=self.mimetype)
+        if encoding != 'identity': response.headers['Content-Encoding'] = encoding
+        if len(self.variants) > 1: response.vary.add('Accept-Encoding')
+        # 各编码的字节不同，ETag 需要区分
+        response.set_etag(self.digest if encoding == 'identity' else f"{self.digest}-{encoding}")
+        response.headers['Cache-Control'] = cache_control
+        return response.make_conditional(request)
+
+class AssetPipeline:
+    def __init__(self, app=None):
+        self.assets = {}
+        self.build = ''
+        self.folder = None
+        self.auto_reload = False
+        self.pages = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.static_folder
+        self.auto_reload = app.config.get('ASSETS_AUTO_RELOAD', False)
+        self.scan()
+        app.add_url_rule('/assets/<build>/<path:filename>', 'assets', self.serve_fingerprinted)
+        # 替换 Flask 默认的 static 视图，加上预压缩与协商缓存
+        app.view_functions['static'] = self.serve_static
+        app.jinja_env.globals['asset_url'] = self.url
+        app.extensions['assets'] = self
+
+    def scan(self):
+        assets = {}
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                assets[filename] = self.load(path)
+        digest = hashlib.sha256()
+        for filename in sorted(assets):
+            digest.update(f"{filename}:{assets[filename].digest}\n".encode('utf-8'))
+        with self._lock:
+            self.assets = assets
+            self.build = digest.hexdigest()[:12]
+            self.pages = {}
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            body = f.read()
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return Asset(body, mimetype, os.stat(path).st_mtime_ns)
+
+    def url(self, filename):
+        return f"/assets/{self.build}/{filename}"
+
+    def lookup(self, filename):
+        asset = self.assets.get(filename)
+        if asset is None or not self.auto_reload: return asset
+        # 开发模式：文件改动后重新读取 (构建号不变，开发模式下一律协商缓存)
+        path = os.path.join(self.folder, filename)
+        try:
+            if os.stat(path).st_mtime_ns != asset.mtime:
+                asset = self.assets[filename] = self.load(path)
+        except OSError:
+            return None
+        return asset
+
+    def serve_fingerprinted(self, build, filename):
+        asset = self.lookup(filename)
+        if asset is None: abort(404)
+        # 旧构建号的地址 (页面尚未刷新) 返回当前内容，但不允许长期缓存
+        immutable = build == self.build and not self.auto_reload
+        return asset.response(IMMUTABLE if immutable else REVALIDATE)
+
+    def serve_static(self, filename):
+        asset = self.lookup(filename)
+        if asset is None: abort(404)
+        return asset.response(REVALIDATE)
+
+    def render_page(self, name, version, template, **context):
+        """缓存渲染好的页面外壳 (含预压缩版本)，按 name 区分；version 变化 (如规则文件更新) 时重新渲染。
+        页面内容不能依赖当前用户。"""
+        cached = self.pages.get(name)
+        if cached is None or cached[0] != version or self.auto_reload:
+            html = render_template(template, **context).encode('utf-8')
+            cached = (version, Asset(html, 'text/html'))
+            with self._lock:
+                self.pages[name] = cached
+        return cached[1].response('private, no-cache')
+
+asset_pipeline = AssetPipeline()
@@ -0,0 +1,154 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ================= 本地假上游 (OpenAI 兼容) =================
+# 提供 GET /v1/models 与流式 POST /v1/chat/completions，用于压测时排除真实上游的波动。
+# 用法: python -m bench.fake_upstream --port 9000 --token-rate 50 --chunk-tokens 1
+
+class UpstreamProfile:
+    """假上游的行为参数"""
+
+    def __init__(self, token_rate=50.0, chunk_tokens=1, tokens=200, latency=0.2,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, models=None):
+        self.token_rate = token_rate          # 每个流每秒输出的 token 数，0 表示不限速
+        self.chunk_tokens = chunk_tokens      # 每个 SSE 块包含的 token 数
+        self.tokens = tokens                  # 每次回复的 token 总数
+        self.latency = latency                # 返回响应头前的等待 (秒)
+        self.error_rate = error_rate          # 直接返回 error_status 的概率
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate  # 输出一半后断开连接的概率
+        self.models = models or ['bench-model', 'bench-model-mini']
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.token_rate, args.chunk_tokens, args.tokens, args.latency,
+                   args.error_rate, args.error_status, args.disconnect_rate)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+def add_profile_args(parser):
+    parser.add_argument('--token-rate', type=float, default=50.0, help='每个流每秒 token 数 (0 为不限速)')
+    parser.add_argument('--chunk-tokens', type=int, default=1, help='每个 SSE 块的 token 数')
+    parser.add_argument('--tokens', type=int, default=200, help='每次回复的 token 总数')
+    parser.add_argument('--latency', type=float, default=0.2, help='响应头延迟 (秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回错误状态码的概率')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='流中途断开的概率')
+
+def chunk_frame(content):
+    body = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk',
+            'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]}
+    return f"data: {json.dumps(body)}\n\n".encode('utf-8')
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def profile(self):
+        return self.server.profile
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.server.count('models')
+            return self.send_json(200, {'object': 'list', 'data': [{'id': m, 'object': 'model'} for m in self.profile.models]})
+        self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self.send_json(404, {'error': 'not found'})
+        self.server.count('chat')
+        p = self.profile
+        if p.latency: time.sleep(p.latency)
+        if p.error_rate and random.random() < p.error_rate:
+            self.server.count('errors')
+            return self.send_json(p.error_status, {'error': {'message': 'injected failure'}})
+        if not payload.get('stream', True):
+            text = ' '.join(f"tok{i}" for i in range(p.tokens))
+            return self.send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': text}}]})
+        self.stream(p)
+
+    def stream(self, p):
+        # 分块传输编码，保持 keep-alive，贴近真实上游的连接复用情况
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunks = max(1, p.tokens // max(1, p.chunk_tokens))
+        interval = p.chunk_tokens / p.token_rate if p.token_rate else 0
+        cut = chunks // 2 if p.disconnect_rate and random.random() < p.disconnect_rate else None
+        next_at = time.monotonic()
+        for i in range(chunks):
+            if i == cut:
+                self.server.count('disconnects')
+                self.close_connection = True
+                return
+            self.write_chunk(chunk_frame(' '.join(['tok'] * p.chunk_tokens) + ' '))
+            if interval:
+                next_at += interval
+                delay = next_at - time.monotonic()
+                if delay > 0: time.sleep(delay)
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, profile=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), Handler)
+        self.profile = profile or UpstreamProfile()
+        self.counters = {'chat': 0, 'models': 0, 'errors': 0, 'disconnects': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地假 OpenAI 兼容上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    server = FakeUpstream(UpstreamProfile.from_args(args), args.host, args.port)
+    print(f" * Fake upstream listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,355 @@
+import io
+import os
+import math
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+import httpx
+from bench.fake_upstream import FakeUpstream, UpstreamProfile, add_profile_args
+
+# ================= 压测 =================
+# 用法 (在项目根目录):
+#   python -m bench.loadtest --users 20 --duration 20 --save bench/results/baseline.json
+#   python -m bench.loadtest --users 20 --duration 20 --compare bench/results/baseline.json
+# 默认以生产模式启动一个使用临时数据库的单进程服务端子进程 (--async 使用 ASGI 模式，--workers N 使用 prefork 多进程)，
+# 也可以用 --url 压测已在运行的实例 (需能访问其 /metrics 才有 CPU/内存数据)。
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('chat', 'models', 'parse_doc')
+PASSWORD = 'bench-password'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, pct):
+    if not values: return None
+    ordered = sorted(values)
+    # 最近秩法
+    index = min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered)))) - 1
+    return round(ordered[index], 4)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+# ================= 被测服务 =================
+class ServerProcess:
+    """以子进程方式启动 app.py，数据库与共享状态放在临时目录，压测时关闭限流；workers 为 WEB_WORKERS"""
+
+    def __init__(self, async_mode=False, keep_limits=False, workers=1):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='aihub-bench-')
+        env = dict(os.environ,
+                   FLASK_ENV='production',
+                   PORT=str(self.port),
+                   ASYNC_MODE='true' if async_mode else 'false',
+                   WEB_WORKERS=str(workers),
+                   DATABASE_URL='sqlite:///' + os.path.join(self.tmpdir.name, 'users.db'),
+                   SHARED_STATE_DB=os.path.join(self.tmpdir.name, 'shared.db'),
+                   LIMITER_DB=os.path.join(self.tmpdir.name, 'limits.db'),
+                   METRICS_TOKEN='')
+        if not keep_limits: env['RATE_LIMITS'] = '{}'
+        self.log = open(os.path.join(self.tmpdir.name, 'server.log'), 'w')
+        self.proc = subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=env,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None: break
+            try:
+                httpx.get(f"{self.url}/login", timeout=1.0)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        self.stop()
+        with open(self.log.name) as f:
+            raise RuntimeError(f"服务端未能启动:\n{f.read()[-2000:]}")
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.log.close()
+        self.tmpdir.cleanup()
+
+# ================= 资源采样 =================
+def scrape_process(client):
+    """从 /metrics 读取服务端进程的 CPU 时间与常驻内存"""
+    try:
+        resp = client.get('/metrics', timeout=5.0)
+        if resp.status_code != 200: return None
+    except httpx.HTTPError:
+        return None
+    values = {}
+    for line in resp.text.splitlines():
+        if line.startswith(('process_cpu_seconds_total ', 'process_resident_memory_bytes ')):
+            name, value = line.split()
+            values[name] = float(value)
+    return values
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, client, interval=1.0):
+        super().__init__(daemon=True)
+        self.client = client
+        self.interval = interval
+        self.peak_rss = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            sample = scrape_process(self.client)
+            if sample: self.peak_rss = max(self.peak_rss, sample['process_resident_memory_bytes'])
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+# ================= 虚拟用户 =================
+class VirtualUser:
+    def __init__(self, base_url, index, upstream_url, tag):
+        self.client = httpx.Client(base_url=base_url, timeout=httpx.Timeout(120.0, connect=10.0))
+        self.username = f"bench-{tag}-{index}"
+        self.upstream_url = upstream_url
+        self.sequence = 0
+
+    def login(self):
+        self.client.post('/api/register', json={'username': self.username, 'password': PASSWORD})
+        resp = self.client.post('/api/login', json={'username': self.username, 'password': PASSWORD})
+        if not resp.json().get('success'): raise RuntimeError(f"登录失败: {self.username}")
+        self.client.post('/api/settings', json={
+            'api_endpoint': self.upstream_url, 'api_key': 'sk-bench', 'model': 'bench-model',
+            'use_official_api': False, 'custom_request_template': '', 'custom_response_path': ''
+        })
+
+    def chat(self):
+        started = time.perf_counter()
+        ttft, chunks, error = None, 0, None
+        with self.client.stream('POST', '/api/chat', json={'messages': [{'role': 'user', 'content': 'ping'}]}) as resp:
+            if resp.status_code != 200:
+                resp.read()
+                return {'ok': False, 'latency': time.perf_counter() - started, 'error': f"http_{resp.status_code}"}
+            for line in resp.iter_lines():
+                if not line.startswith('data: ') or line == 'data: [DONE]': continue
+                if line.startswith('data: {"error"'):
+                    error = 'stream_error'
+                    continue
+                if ttft is None: ttft = time.perf_counter() - started
+                chunks += 1
+        return {'ok': error is None and chunks > 0, 'latency': time.perf_counter() - started,
+                'ttft': ttft, 'chunks': chunks, 'error': error or (None if chunks else 'empty')}
+
+    def models(self):
+        started = time.perf_counter()
+        resp = self.client.post('/api/fetch_models', json={'use_official': False})
+        ok = resp.status_code == 200 and resp.json().get('success', False)
+        return {'ok': ok, 'latency': time.perf_counter() - started, 'error': None if ok else f"http_{resp.status_code}"}
+
+    def parse_doc(self):
+        # 每次上传内容不同，避免全部命中服务端的解析缓存
+        self.sequence += 1
+        name, data = make_document(f"{self.username} #{self.sequence}")
+        started = time.perf_counter()
+        resp = self.client.post('/api/parse_doc', files={'file': (name, data)})
+        ok = resp.status_code == 200 and resp.json().get('success', False)
+        return {'ok': ok, 'latency': time.perf_counter() - started, 'error': None if ok else f"http_{resp.status_code}"}
+
+    def close(self):
+        self.client.close()
+
+def make_document(marker, paragraphs=200):
+    lines = [f"{marker} 第 {i} 段：用于压测文档解析的示例文本。" for i in range(paragraphs)]
+    try:
+        from docx import Document
+    except ImportError:
+        return 'bench.txt', "\n".join(lines).encode('utf-8')
+    doc = Document()
+    for line in lines: doc.add_paragraph(line)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return 'bench.docx', buf.getvalue()
+
+# ================= 场景 =================
+def run_scenario(name, users, duration, base_url):
+    metrics_client = httpx.Client(base_url=base_url)
+    before = scrape_process(metrics_client)
+    sampler = ResourceSampler(metrics_client)
+    sampler.start()
+    results, lock = [], threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(user):
+        action = getattr(user, name)
+        while time.monotonic() < deadline:
+            try:
+                result = action()
+            except Exception as e:
+                result = {'ok': False, 'latency': 0.0, 'error': type(e).__name__}
+            with lock:
+                results.append(result)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(u,), daemon=True) for u in users]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.monotonic() - started
+    sampler.stop()
+    after = scrape_process(metrics_client)
+    metrics_client.close()
+    return summarize(name, results, elapsed, before, after, sampler.peak_rss)
+
+def summarize(name, results, elapsed, before, after, peak_rss):
+    ok = [r for r in results if r['ok']]
+    errors = {}
+    for r in results:
+        if not r['ok']: errors[r['error']] = errors.get(r['error'], 0) + 1
+    latencies = [r['latency'] for r in ok]
+    summary = {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': errors,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99)
+    }
+    if name == 'chat':
+        ttfts = [r['ttft'] for r in ok if r.get('ttft') is not None]
+        chunks = sum(r['chunks'] for r in ok)
+        summary.update({
+            'ttft_p50': percentile(ttfts, 50),
+            'ttft_p95': percentile(ttfts, 95),
+            'ttft_p99': percentile(ttfts, 99),
+            'chunks_per_second': round(chunks / elapsed, 2) if elapsed else 0.0
+        })
+    if before and after:
+        cpu = after['process_cpu_seconds_total'] - before['process_cpu_seconds_total']
+        summary.update({
+            'server_cpu_seconds': round(cpu, 3),
+            'server_cpu_percent': round(100 * cpu / elapsed, 1) if elapsed else 0.0,
+            'server_rss_mb': round(after['process_resident_memory_bytes'] / 2**20, 1),
+            'server_peak_rss_mb': round(max(peak_rss, after['process_resident_memory_bytes']) / 2**20, 1)
+        })
+    return summary
+
+# ================= 报告与回归比较 =================
+# (指标, 越大越好?)
+COMPARED = (('throughput', True), ('ttft_p95', False), ('latency_p95', False), ('server_cpu_percent', False))
+
+def print_report(report):
+    print(f"\n== {report['meta']['timestamp']} (rev {report['meta']['revision']}, {report['meta']['users']} users) ==")
+    for name, s in report['scenarios'].items():
+        line = f"{name:<10} ok={s['ok']}/{s['requests']} rps={s['throughput']:<8} p50={s['latency_p50']} p95={s['latency_p95']} p99={s['latency_p99']}"
+        if 'ttft_p50' in s:
+            line += f" ttft p50/p95/p99={s['ttft_p50']}/{s['ttft_p95']}/{s['ttft_p99']} chunks/s={s['chunks_per_second']}"
+        if 'server_cpu_percent' in s:
+            line += f" cpu={s['server_cpu_percent']}% rss={s['server_rss_mb']}MB peak={s['server_peak_rss_mb']}MB"
+        if s['errors']: line += f" errors={s['errors']}"
+        print(line)
+
+def compare(report, baseline, tolerance):
+    """返回回归项列表：吞吐下降或延迟/CPU 上升超过 tolerance (比例)"""
+    regressions = []
+    for name, current in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous: continue
+        for key, higher_is_better in COMPARED:
+            old, new = previous.get(key), current.get(key)
+            if not old or new is None: continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            marker = 'REGRESSION' if worse > tolerance else ''
+            print(f"  {name:<10} {key:<20} {old:>10} -> {new:<10} ({change:+.1%}) {marker}")
+            if marker: regressions.append((name, key, old, new))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='AI Hub Pro 压测')
+    parser.add_argument('--users', type=int, default=10, help='并发虚拟用户数')
+    parser.add_argument('--duration', type=float, default=15.0, help='每个场景持续秒数')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔: ' + ','.join(SCENARIOS))
+    parser.add_argument('--url', help='压测已运行的实例，不再自动启动服务端')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='以 ASYNC_MODE (uvicorn) 启动服务端')
+    parser.add_argument('--workers', type=int, default=1, help='服务端 WEB_WORKERS (1 为单进程，>1 为 prefork 多进程)')
+    parser.add_argument('--keep-limits', action='store_true', help='保留 RATE_LIMITS 限流配置')
+    parser.add_argument('--save', help='把结果写入 JSON 文件 (作为基线)')
+    parser.add_argument('--compare', help='与基线 JSON 比较，出现回归时以退出码 1 结束')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='允许的回归比例')
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown: parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    profile = UpstreamProfile.from_args(args)
+    upstream = FakeUpstream(profile).start()
+    server = None
+    users = []
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            server = ServerProcess(args.async_mode, args.keep_limits, args.workers)
+            server.wait_ready()
+            base_url = server.url
+        tag = str(int(time.time()))
+        users = [VirtualUser(base_url, i, upstream.base_url, tag) for i in range(args.users)]
+        for user in users: user.login()
+
+        report = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'users': args.users,
+                'duration': args.duration,
+                'async_mode': args.async_mode,
+                'workers': None if args.url else args.workers,
+                'upstream': profile.to_dict()
+            },
+            'scenarios': {}
+        }
+        for name in scenarios:
+            print(f" * running {name} ({args.users} users, {args.duration}s)")
+            report['scenarios'][name] = run_scenario(name, users, args.duration, base_url)
+        report['meta']['upstream_counters'] = dict(upstream.counters)
+    finally:
+        for user in users: user.close()
+        if server: server.stop()
+        upstream.stop()
+
+    print_report(report)
+    status = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\n== compare with {args.compare} (rev {baseline['meta'].get('revision')}) ==")
+        if baseline['meta'].get('users') != args.users:
+            print(f"  warning: baseline used {baseline['meta'].get('users')} users, this run used {args.users}")
+        if baseline['meta'].get('workers', 1) != report['meta']['workers']:
+            print(f"  warning: baseline used {baseline['meta'].get('workers', 1)} workers, this run used {report['meta']['workers']}")
+        if compare(report, baseline, args.tolerance): status = 1
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n * saved to {args.save}")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
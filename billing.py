@@ -0,0 +1,143 @@
+import math
+import time
+import queue
+import atexit
+import threading
+from uuid import uuid4
+from datetime import datetime
+from sqlalchemy import text
+from extensions import db
+from models import User, PointsLedger
+from utils import TTLCache
+from identity import identity_cache
+
+# ================= 点数账本 =================
+# 余额变动全部走单条条件 UPDATE，由数据库保证原子性；流水异步批量写入，不占用请求线程。
+
+balance_cache = TTLCache(maxsize=4096, ttl=30.0)
+
+class LedgerWriter:
+    """后台线程批量写入 PointsLedger，按条数或时间间隔刷新"""
+
+    def __init__(self, batch_size=100, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self._app = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self._app = app
+        atexit.register(self.flush)
+
+    def record(self, app, user_id, kind, amount, reservation_id=None, model=''):
+        if self._app is None: self._app = app
+        self.queue.put({
+            'user_id': user_id, 'kind': kind, 'amount': amount,
+            'reservation_id': reservation_id, 'model': model or '',
+            'created_at': datetime.utcnow()
+        })
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+                self._thread.start()
+
+    def _drain(self, first=None):
+        batch = [] if first is None else [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if not batch: return
+        try:
+            with self._app.app_context():
+                db.session.execute(PointsLedger.__table__.insert(), batch)
+                db.session.commit()
+        except Exception as e:
+            print(f"Ledger write error ({len(batch)} entries): {e}")
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            # 给同一时刻的其他写入一点时间凑成一批
+            time.sleep(0.05)
+            self._write(self._drain(first))
+
+    def flush(self):
+        while not self.queue.empty():
+            self._write(self._drain())
+
+ledger_writer = LedgerWriter()
+
+class Reservation:
+    """一次官方通道请求的预扣记录，流结束时调用 settle() 结算或退款 (幂等)"""
+
+    def __init__(self, app, user_id, cost, model):
+        self.id = uuid4().hex
+        self.app = app
+        self.user_id = user_id
+        self.cost = cost
+        self.model = model
+        self.settled = False
+        self._lock = threading.Lock()
+
+    def settle(self, success, fraction=1.0, reason='cancel'):
+        """fraction < 1 时只按比例收取 (至少 1 点)，其余以 <reason>_refund 退还
+        (reason: cancel 中途取消 / timeout 上游空闲超时中断 / cache 命中回复缓存)"""
+        with self._lock:
+            if self.settled: return
+            self.settled = True
+        if not success:
+            credit_points(self.app, self.user_id, self.cost, 'refund', self.id, self.model)
+        elif fraction >= 1:
+            ledger_writer.record(self.app, self.user_id, 'commit', 0, self.id, self.model)
+        else:
+            charged = min(self.cost, max(1, math.ceil(self.cost * fraction)))
+            ledger_writer.record(self.app, self.user_id, 'commit', 0, self.id, self.model)
+            if charged < self.cost:
+                credit_points(self.app, self.user_id, self.cost - charged, f'{reason}_refund', self.id, self.model)
+
+def reserve_points(app, user_id, cost, model=''):
+    """原子预扣点数，余额不足时返回 None"""
+    with app.app_context():
+        result = db.session.execute(
+            text("UPDATE user SET points = points - :cost, version = version + 1 WHERE id = :uid AND points >= :cost"),
+            {'cost': cost, 'uid': user_id}
+        )
+        db.session.commit()
+    balance_cache.pop(user_id)
+    identity_cache.invalidate(user_id)
+    if result.rowcount != 1: return None
+    reservation = Reservation(app, user_id, cost, model)
+    ledger_writer.record(app, user_id, 'reserve', -cost, reservation.id, model)
+    return reservation
+
+def credit_points(app, user_id, amount, kind='topup', reservation_id=None, model=''):
+    with app.app_context():
+        db.session.execute(
+            text("UPDATE user SET points = points + :amount, version = version + 1 WHERE id = :uid"),
+            {'amount': amount, 'uid': user_id}
+        )
+        db.session.commit()
+    balance_cache.pop(user_id)
+    identity_cache.invalidate(user_id)
+    ledger_writer.record(app, user_id, kind, amount, reservation_id, model)
+
+def get_balance(user_id):
+    balance = balance_cache.get(user_id)
+    if balance is None:
+        balance = db.session.query(User.points).filter_by(id=user_id).scalar() or 0
+        balance_cache.set(user_id, balance)
+    return balance
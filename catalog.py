@@ -0,0 +1,181 @@
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from extensions import upstream_clients
+from upstream import DEFAULT_HEADERS
+
+def candidate_urls(base_url):
+    urls = []
+    if not base_url.endswith('/v1'): urls.append(f"{base_url}/v1/models")
+    urls.append(f"{base_url}/models")
+    return urls
+
+# 多个候选地址都失败时，选最能说明问题的那个结果展示给用户
+FAILURE_PRIORITY = {401: 0, 200: 1, 404: 2}
+
+# ================= 模型目录缓存 =================
+class ModelCatalog:
+    """按 (endpoint, key 哈希) 缓存上游模型列表
+
+    - 新鲜期内直接返回；过期但仍在 stale 窗口内时先返回旧值，后台刷新；
+    - 候选 URL 并发探测，取第一个成功结果；
+    - 失败结果短暂缓存，避免配置错误的地址反复占用工作线程。
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300.0
+        self.stale = 3600.0
+        self.negative_ttl = 15.0
+        self.timeout = 15.0
+        self.max_entries = 1024
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._store = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.ttl = conf.get('MODEL_CATALOG_TTL', self.ttl)
+        self.stale = conf.get('MODEL_CATALOG_STALE', self.stale)
+        self.negative_ttl = conf.get('MODEL_CATALOG_NEGATIVE_TTL', self.negative_ttl)
+        app.extensions['model_catalog'] = self
+
+    def share(self, store):
+        """多进程模式：条目改存到 shared.SharedStore (条目中的时间为 time.monotonic()，同一台机器上各进程一致)"""
+        self._store = store
+
+    def _get(self, key):
+        if self._store is not None: return self._store.get('catalog', '|'.join(key))
+        return self._entries.get(key)
+
+    def _put(self, key, entry):
+        if self._store is not None:
+            return self._store.set('catalog', '|'.join(key), entry, max(self.stale, self.negative_ttl))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='catalog')
+        return self._pool
+
+    def count(self, name):
+        """命中计数由各请求线程同时累加，在锁内更新避免计数丢失"""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def lookup(self, api_endpoint, api_key):
+        base_url = api_endpoint.strip().rstrip('/')
+        key = (base_url, hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16])
+        entry = self._get(key)
+        now = time.monotonic()
+        if entry is not None:
+            if now < entry['expires']:
+                self.count('hits')
+                return entry
+            if entry['ok'] and now < entry['stale_until']:
+                self.count('stale_hits')
+                self._refresh_async(key, base_url, api_key)
+                return entry
+        self.count('misses')
+        return self._refresh(key, base_url, api_key)
+
+    def invalidate(self, api_endpoint=None):
+        if self._store is not None:
+            if api_endpoint is None: return self._store.delete('catalog')
+            return self._store.delete_prefix('catalog', api_endpoint.strip().rstrip('/') + '|')
+        with self._lock:
+            if api_endpoint is None:
+                self._entries.clear()
+            else:
+                base_url = api_endpoint.strip().rstrip('/')
+                for key in [k for k in self._entries if k[0] == base_url]:
+                    del self._entries[key]
+
+    def _refresh_async(self, key, base_url, api_key):
+        if key in self._inflight: return
+        threading.Thread(target=self._refresh, args=(key, base_url, api_key), daemon=True).start()
+
+    def _refresh(self, key, base_url, api_key):
+        # 同一 key 只允许一个探测在飞，其余请求等待其结果
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner: event = self._inflight[key] = threading.Event()
+        if not owner:
+            event.wait(self.timeout + 1)
+            return self._get(key) or self._failure(None, '请求超时')
+        try:
+            entry = self._probe(base_url, api_key)
+            old = self._get(key)
+            # 后台刷新失败时继续使用仍在 stale 窗口内的旧结果
+            if not entry['ok'] and old is not None and old['ok'] and time.monotonic() < old['stale_until']:
+                return old
+            self._put(key, entry)
+            return entry
+        finally:
+            if owner:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+    def _probe(self, base_url, api_key):
+        headers = dict(DEFAULT_HEADERS, Authorization=f"Bearer {api_key}")
+        client = upstream_clients.get(base_url)
+        futures = [self.pool().submit(self._fetch, client, url, headers) for url in candidate_urls(base_url)]
+        failures = []
+        for future in as_completed(futures):
+            result = future.result()
+            if result['ok']: return result
+            failures.append(result)
+        failures.sort(key=lambda r: FAILURE_PRIORITY.get(r['status'], 3 if r['status'] else 4))
+        return failures[0]
+
+    def _fetch(self, client, url, headers):
+        try:
+            resp = client.get(url, headers=headers, timeout=upstream_clients.timeout(self.timeout))
+        except Exception as e:
+            return self._failure(None, str(e))
+        if resp.status_code != 200:
+            return self._failure(resp.status_code, f"HTTP {resp.status_code}")
+        try:
+            data = resp.json()
+        except ValueError:
+            return self._failure(200, "返回格式非标准 JSON")
+        if not isinstance(data, dict) or 'data' not in data:
+            return self._failure(200, "返回内容缺少 data 字段")
+        now = time.monotonic()
+        return {
+            'ok': True, 'status': 200, 'error': '',
+            'models': sorted([item['id'] for item in data['data']]),
+            'expires': now + self.ttl, 'stale_until': now + self.ttl + self.stale
+        }
+
+    def _failure(self, status, error):
+        now = time.monotonic()
+        return {
+            'ok': False, 'status': status, 'error': error, 'models': [],
+            'expires': now + self.negative_ttl, 'stale_until': now + self.negative_ttl
+        }
+
+    def stats(self):
+        return {
+            'entries': self._store.count('catalog') if self._store else len(self._entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses
+        }
+
+model_catalog = ModelCatalog()
@@ -30,19 +30,161 @@ def get_fixed_secret_key():
     return final_key
 
 class Config:
-    SECRET_KEY = get_fixed_secret_key()
+    # SECRET_KEY 以 key 文件为准，由 app.py 在创建应用时读取 (或生成)，导入本模块不做文件 I/O。
+    # 不读取环境变量：密钥一变，所有会话与加密保存的 API Key 都会失效
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     PAID_MODE = os.environ.get('PAID_MODE', 'False').lower() == 'true'
     
     # 数据库路径
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(base_dir, 'users.db')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(base_dir, 'users.db')
+    # 连接池按 waitress 线程数配置；PRAGMA (WAL / busy_timeout 等) 见 database.py
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 30,
+        'connect_args': {'timeout': 15, 'check_same_thread': False}
+    }
+
+    # 上游连接池 (按 API 地址复用长连接)
+    UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_MAX_CONNECTIONS', 100))
+    UPSTREAM_ASYNC_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_ASYNC_MAX_CONNECTIONS', 2000))
+    UPSTREAM_MAX_KEEPALIVE = int(os.environ.get('UPSTREAM_MAX_KEEPALIVE', 20))
+    UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get('UPSTREAM_KEEPALIVE_EXPIRY', 30))
+    UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10))
+    UPSTREAM_HTTP2 = os.environ.get('UPSTREAM_HTTP2', 'True').lower() == 'true'
+
+    # 模型列表缓存 (秒): 新鲜期、过期后仍可先返回旧值并后台刷新的窗口、失败结果缓存时长
+    MODEL_CATALOG_TTL = float(os.environ.get('MODEL_CATALOG_TTL', 300))
+    MODEL_CATALOG_STALE = float(os.environ.get('MODEL_CATALOG_STALE', 3600))
+    MODEL_CATALOG_NEGATIVE_TTL = float(os.environ.get('MODEL_CATALOG_NEGATIVE_TTL', 15))
+
+    # 流式转码: 解析路径下把细碎 delta 合并成帧 (任一阈值达到即发送，均为 0 时逐条发送)
+    STREAM_FLUSH_CHARS = int(os.environ.get('STREAM_FLUSH_CHARS', 256))
+    STREAM_FLUSH_INTERVAL = float(os.environ.get('STREAM_FLUSH_INTERVAL', 0.03))
+
+    # 流式超时 (秒): 等待上游首行、两行之间的最长空闲、无输出时向客户端发送心跳的间隔
+    STREAM_FIRST_BYTE_TIMEOUT = float(os.environ.get('STREAM_FIRST_BYTE_TIMEOUT', 120))
+    STREAM_IDLE_TIMEOUT = float(os.environ.get('STREAM_IDLE_TIMEOUT', 60))
+    STREAM_HEARTBEAT_INTERVAL = float(os.environ.get('STREAM_HEARTBEAT_INTERVAL', 15))
+    # 中途取消的官方通道对话按已输出上游块数比例扣点：上游已发完按全价，请求带 max_tokens 时相对 max_tokens，
+    # 否则达到此块数按全价 (0 表示总是全价)
+    CANCEL_FULL_CHUNKS = int(os.environ.get('CANCEL_FULL_CHUNKS', 500))
+    # /api/chat/multi 单次最多并行的模型数
+    MULTI_MAX_MODELS = int(os.environ.get('MULTI_MAX_MODELS', 4))
+    # 各 lane 共用的线程池大小 (每条进行中的 lane 占用一个线程，满载时新的 lane 排队)
+    MULTI_LANE_THREADS = int(os.environ.get('MULTI_LANE_THREADS', 32))
+
+    # 文档解析: 字符预算、进程池大小、单任务超时 (秒) 与内存上限 (MB)
+    DOC_TEXT_LIMIT = int(os.environ.get('DOC_TEXT_LIMIT', 15000))
+    DOC_PARSE_WORKERS = int(os.environ.get('DOC_PARSE_WORKERS', 2))
+    DOC_PARSE_TIMEOUT = float(os.environ.get('DOC_PARSE_TIMEOUT', 10))
+    DOC_PARSE_MEMORY_MB = int(os.environ.get('DOC_PARSE_MEMORY_MB', 512))
+    # 解析结果缓存 (按内容哈希) 的总字符数上限；整篇文档最多 DOC_INDEX_LIMIT 字符，只按条数限制时可能占用数百 MB
+    DOC_CACHE_CHARS = int(os.environ.get('DOC_CACHE_CHARS', 8000000))
+
+    # 文档检索: 建索引时的字符上限、分块大小与重叠、每轮注入的块数与字符上限
+    DOC_INDEX_LIMIT = int(os.environ.get('DOC_INDEX_LIMIT', 1000000))
+    DOC_CHUNK_CHARS = int(os.environ.get('DOC_CHUNK_CHARS', 1200))
+    DOC_CHUNK_OVERLAP = int(os.environ.get('DOC_CHUNK_OVERLAP', 150))
+    DOC_RETRIEVAL_TOP_K = int(os.environ.get('DOC_RETRIEVAL_TOP_K', 6))
+    DOC_CONTEXT_CHARS = int(os.environ.get('DOC_CONTEXT_CHARS', 8000))
+
+    # 官方通道: 单次请求最多尝试的上游数、熔断阈值与冷却时间 (秒)
+    OFFICIAL_MAX_ATTEMPTS = int(os.environ.get('OFFICIAL_MAX_ATTEMPTS', 3))
+    OFFICIAL_BREAKER_FAILURES = int(os.environ.get('OFFICIAL_BREAKER_FAILURES', 5))
+    OFFICIAL_BREAKER_COOLDOWN = float(os.environ.get('OFFICIAL_BREAKER_COOLDOWN', 30))
+
+    # 对话限流: 按档位设置每用户令牌桶 (rate 个/秒，容量 burst) 与最大并发流，0 表示不限制。
+    # free: 未开启 PAID_MODE；own_key / official: PAID_MODE 下使用自有 Key / 官方通道。
+    # 官方上游的限额写在 official_key.json 的 rpm / max_concurrency 中。
+    # 默认关闭 (升级后已有部署的行为不变)，通过环境变量 RATE_LIMITS 以 JSON 开启，推荐值见 README，例如
+    #   RATE_LIMITS='{"free": {"rate": 0.5, "burst": 10, "concurrency": 3}}'
+    # 未列出的档位不限制
+    RATE_LIMITS = json.loads(os.environ.get('RATE_LIMITS') or '{}')
+    # memory: 单进程计数；sqlite: 多个 worker 进程通过 LIMITER_DB 共享计数
+    LIMITER_BACKEND = os.environ.get('LIMITER_BACKEND', 'memory')
+    LIMITER_DB = os.environ.get('LIMITER_DB', os.path.join(base_dir, 'limits.db'))
+    LIMITER_MAX_WAIT = float(os.environ.get('LIMITER_MAX_WAIT', 5))
+    LIMITER_MAX_QUEUE = int(os.environ.get('LIMITER_MAX_QUEUE', 20))
+    # 并发租约有效期 (秒)：默认为上游读超时 (首行 / 空闲超时的较大者加心跳间隔) 再加 30 秒余量。
+    # 进行中的流会定期续期，这个值只决定崩溃的 worker 遗留的名额多久后回收
+    LIMITER_LEASE_TTL = (float(os.environ.get('LIMITER_LEASE_TTL', 0))
+                         or max(STREAM_FIRST_BYTE_TIMEOUT, STREAM_IDLE_TIMEOUT) + STREAM_HEARTBEAT_INTERVAL + 30)
+
+    # 服务端会话上下文: 按模型名关键词 (子串，按顺序匹配) 设置 token 预算，default 为兜底；
+    # 预算中预留 CONTEXT_REPLY_RESERVE 给回复。策略: truncate (丢弃最早消息) / condense (早期消息压缩为摘录)
+    CONTEXT_TOKEN_BUDGETS = {
+        'gpt-4o': 100000, 'gpt-4.1': 100000, 'claude': 150000, 'gemini': 150000,
+        'deepseek': 48000, 'qwen': 24000, 'gpt-3.5': 12000, 'default': 8000
+    }
+    CONTEXT_REPLY_RESERVE = int(os.environ.get('CONTEXT_REPLY_RESERVE', 1024))
+    CONTEXT_POLICY = os.environ.get('CONTEXT_POLICY', 'truncate')
+
+    # 回复缓存: off / deterministic (仅 temperature 为 0 的请求) / all；
+    # 内存 LRU 条数、磁盘目录与容量上限 (MB，0 关闭磁盘层)、有效期 (秒)；PAID_MODE 下命中按原价的 COST_FACTOR 倍计费
+    RESPONSE_CACHE_MODE = os.environ.get('RESPONSE_CACHE_MODE', 'off')
+    RESPONSE_CACHE_MEMORY_ITEMS = int(os.environ.get('RESPONSE_CACHE_MEMORY_ITEMS', 256))
+    RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', os.path.join(base_dir, 'cache', 'responses'))
+    RESPONSE_CACHE_DISK_MB = int(os.environ.get('RESPONSE_CACHE_DISK_MB', 256))
+    RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 86400))
+    RESPONSE_CACHE_COST_FACTOR = float(os.environ.get('RESPONSE_CACHE_COST_FACTOR', 0.1))
+
+    # 登录用户快照缓存: 条数上限与有效期 (秒)；写入时主动失效，有效期只是兜底
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 4096))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+
+    # /metrics (Prometheus 文本格式): 设置令牌后凭 Authorization: Bearer <令牌> 抓取 (本机也需要)；
+    # 未设置时仅允许本机直接访问，带 X-Forwarded-For 等代理头的请求被拒绝。部署在反向代理之后时请设置令牌
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+    # 静态资源: 开发环境下文件改动后自动重新读取，且不缓存页面外壳
+    ASSETS_AUTO_RELOAD = os.environ.get('FLASK_ENV', 'development') != 'production'
+
+    # 异步模式: /api/chat 运行在事件循环上 (需要 uvicorn)，其余路由交给线程池
+    ASYNC_MODE = os.environ.get('ASYNC_MODE', 'False').lower() == 'true'
+    ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', 16))
+    # 逐块转发其余路由的流式响应 (如 /api/chat/multi) 的独立线程池：每条流占用一个线程直到结束，
+    # 与 ASYNC_WSGI_THREADS 分开，流再多也不会挡住普通请求；满载时新的流排队等待
+    ASYNC_STREAM_THREADS = int(os.environ.get('ASYNC_STREAM_THREADS', 64))
+
+    # 启动: 打印导入与各组件初始化耗时报告；后台预热按需导入的依赖 (Pillow、cryptography、文档解析子进程)
+    STARTUP_REPORT = os.environ.get('STARTUP_REPORT', 'False').lower() == 'true'
+    STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'False').lower() == 'true'
+    # 导入阶段的耗时预算 (毫秒)，设置后超出时打印启动报告与警告；默认 0 为不检查
+    STARTUP_IMPORT_BUDGET_MS = float(os.environ.get('STARTUP_IMPORT_BUDGET_MS', 0))
+
+    # 多进程 (prefork.py，仅 Linux / macOS): worker 数，默认 1 为单进程 Waitress，0 表示按 CPU 核数；每个 worker 的线程数
+    WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 6))
+    # 平滑重启 / 停止时等待在途请求 (含流式回复) 结束的最长秒数
+    GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', 60))
+    # memory: 进程内状态；sqlite: 余额、模型目录缓存与活动流登记通过 SHARED_STATE_DB 在 worker 间共享
+    # (prefork 启动的 worker 在未设置时默认使用 sqlite，LIMITER_BACKEND 同理)
+    SHARED_STATE_BACKEND = os.environ.get('SHARED_STATE_BACKEND', 'memory')
+    SHARED_STATE_DB = os.environ.get('SHARED_STATE_DB', os.path.join(base_dir, 'shared.db'))
+    # 跨 worker 取消请求的轮询间隔 (秒)
+    SHARED_CANCEL_POLL = float(os.environ.get('SHARED_CANCEL_POLL', 0.25))
+
+# official_key.json 按 mtime 缓存，文件修改后自动重新加载。解析失败 (如热更新时读到写了一半的文件) 时
+# 继续使用上一份有效配置，并记下该 mtime，同一版本的坏文件只解析、报错一次；文件不存在时返回共享的空配置，
+# 保证 OfficialPool 只在配置真正变化时重建上游列表
+EMPTY_OFFICIAL_CONFIG = {}
+_official_cache = {'mtime': None, 'data': EMPTY_OFFICIAL_CONFIG}
 
 def load_official_config():
     try:
-        if os.path.exists('official_key.json'):
+        mtime = os.stat('official_key.json').st_mtime_ns
+    except OSError:
+        return EMPTY_OFFICIAL_CONFIG
+    if mtime != _official_cache['mtime']:
+        _official_cache['mtime'] = mtime
+        try:
             with open('official_key.json', 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"Error loading official_key.json: {e}")
-    return {}
\ No newline at end of file
+                data = json.load(f)
+            if not isinstance(data, dict): raise ValueError('top level must be a JSON object')
+        except Exception as e:
+            print(f"Error loading official_key.json, keeping the previous config: {e}")
+        else:
+            _official_cache['data'] = data
+    return _official_cache['data']
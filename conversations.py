@@ -0,0 +1,157 @@
+import re
+from uuid import uuid4
+from datetime import datetime
+from sqlalchemy import text
+from extensions import db
+from models import Conversation, ConversationMessage
+
+# 与前端 estimateTokens 相同的粗略估算：中文约 1.6 token/字，其余约 4 字符/token
+CJK_PATTERN = re.compile(r'[\u4e00-\u9fa5]')
+THINK_PATTERN = re.compile(r'<think>.*?(</think>|$)', re.S)
+
+def estimate_tokens(content):
+    if not content: return 0
+    cjk = len(CJK_PATTERN.findall(content))
+    return int(cjk * 1.6 + (len(content) - cjk) * 0.25 + 0.999)
+
+def message_text(content):
+    """多模态消息只保留文本部分 (历史消息本来就只以文本形式发送)"""
+    if isinstance(content, str): return content
+    if isinstance(content, list):
+        return "\n".join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+    return ''
+
+def strip_think(content):
+    # 推理过程不回传给上游
+    return THINK_PATTERN.sub('', content).strip()
+
+# ================= 上下文策略 =================
+# assemble(history, budget) 接收按时间倒序惰性读取的历史消息，返回按时间正序的 [{'role', 'content'}]。
+# 策略一旦停止迭代，就不会再从数据库读取更早的消息。
+
+class TruncatePolicy:
+    """保留预算内最近的完整消息，其余丢弃"""
+
+    def assemble(self, history, budget):
+        kept, used = [], 0
+        for message in history:
+            if kept and used + message.tokens > budget: break
+            used += message.tokens
+            kept.append({'role': message.role, 'content': message.content})
+        kept.reverse()
+        return kept
+
+class CondensePolicy:
+    """最近的消息完整保留 (占预算的 full_share)，更早的消息压缩为开头片段，
+    合并成一条 system 摘要放在最前面；不额外调用模型"""
+
+    def __init__(self, full_share=0.75, excerpt_chars=160):
+        self.full_share = full_share
+        self.excerpt_chars = excerpt_chars
+
+    def assemble(self, history, budget):
+        kept, used = [], 0
+        full_budget = int(budget * self.full_share)
+        excerpts = []
+        for message in history:
+            # 最新一条 (本轮用户消息) 总是完整保留
+            if not kept or (not excerpts and used + message.tokens <= full_budget):
+                used += message.tokens
+                kept.append({'role': message.role, 'content': message.content})
+                continue
+            excerpt = f"{message.role}: {message.content[:self.excerpt_chars]}"
+            cost = estimate_tokens(excerpt)
+            if used + cost > budget: break
+            used += cost
+            excerpts.append(excerpt)
+        kept.reverse()
+        if excerpts:
+            excerpts.reverse()
+            kept.insert(0, {'role': 'system', 'content': "Earlier conversation (condensed):\n" + "\n".join(excerpts)})
+        return kept
+
+CONTEXT_POLICIES = {
+    'truncate': TruncatePolicy,
+    'condense': CondensePolicy
+}
+
+# ================= 会话存储 =================
+class ConversationStore:
+    BATCH = 50
+
+    def __init__(self, app=None):
+        self.budgets = {'default': 8000}
+        self.reply_reserve = 1024
+        self.policy = TruncatePolicy()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.budgets = conf.get('CONTEXT_TOKEN_BUDGETS', self.budgets)
+        self.reply_reserve = conf.get('CONTEXT_REPLY_RESERVE', self.reply_reserve)
+        self.policy = CONTEXT_POLICIES[conf.get('CONTEXT_POLICY', 'truncate')]()
+        app.extensions['conversation_store'] = self
+
+    def budget_for(self, model_name):
+        """按模型名关键词 (子串，按配置顺序) 取上下文预算"""
+        name = (model_name or '').lower()
+        for keyword, budget in self.budgets.items():
+            if keyword != 'default' and keyword in name: return budget
+        return self.budgets.get('default', 8000)
+
+    def create(self, user_id, title=''):
+        conversation = Conversation(id=uuid4().hex, user_id=user_id, title=title[:200])
+        db.session.add(conversation)
+        return conversation
+
+    def get(self, user_id, conversation_id):
+        conversation = db.session.get(Conversation, conversation_id) if conversation_id else None
+        if conversation is None or conversation.user_id != user_id: return None
+        return conversation
+
+    def append(self, conversation_id, role, content, model='', reply_to=None):
+        message = ConversationMessage(conversation_id=conversation_id, role=role, content=content,
+                                      tokens=estimate_tokens(content), model=model or '', reply_to=reply_to)
+        db.session.add(message)
+        db.session.execute(text("UPDATE conversation SET updated_at = :now WHERE id = :cid"),
+                           {'now': datetime.utcnow(), 'cid': conversation_id})
+        return message
+
+    def append_reply(self, app, conversation_id, content, model, reply_to):
+        """流结束后保存助手回复 (可在请求上下文之外调用)"""
+        with app.app_context():
+            self.append(conversation_id, 'assistant', content, model, reply_to)
+            db.session.commit()
+
+    def last_user_message(self, conversation_id):
+        return (ConversationMessage.query
+                .filter_by(conversation_id=conversation_id, role='user')
+                .order_by(ConversationMessage.id.desc()).first())
+
+    def history(self, conversation_id, before_id, max_messages=None):
+        """按时间倒序分批读取 before_id (含) 之前的消息；每条用户消息只保留最新的一条回复"""
+        answered = set()
+        yielded = 0
+        cursor = before_id + 1
+        while True:
+            batch = (ConversationMessage.query
+                     .filter(ConversationMessage.conversation_id == conversation_id, ConversationMessage.id < cursor)
+                     .order_by(ConversationMessage.id.desc()).limit(self.BATCH).all())
+            for message in batch:
+                if message.role == 'assistant' and message.reply_to is not None:
+                    if message.reply_to in answered: continue
+                    answered.add(message.reply_to)
+                if max_messages is not None and yielded >= max_messages: return
+                yielded += 1
+                yield message
+            if len(batch) < self.BATCH: return
+            cursor = batch[-1].id
+
+    def build_context(self, conversation_id, user_message, model_name, system_prompt='', max_messages=None):
+        """以 user_message (已写入) 为最后一条，在模型预算内组装上下文"""
+        budget = self.budget_for(model_name) - self.reply_reserve - estimate_tokens(system_prompt)
+        history = self.history(conversation_id, user_message.id, max_messages)
+        return self.policy.assemble(history, max(budget, user_message.tokens))
+
+conversation_store = ConversationStore()
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import base64
+import sqlite3
+from sqlalchemy import event, text, make_url
+from sqlalchemy.engine import Engine
+from extensions import db
+from models import UserSettings, UserAvatar
+from metrics import DB_QUERY
+
+# fcntl 仅 Unix 可用；其他平台不加锁 (单进程运行)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ================= SQLite 连接调优 =================
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',        # 读写并发：读不阻塞写
+    'synchronous': 'NORMAL',      # WAL 下足够安全，大幅减少 fsync
+    'busy_timeout': 5000,         # 锁冲突时等待而不是立刻报 database is locked
+    'mmap_size': 268435456,       # 256MB 内存映射读
+    'temp_store': 'MEMORY',
+}
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_conn, connection_record):
+    if not isinstance(dbapi_conn, sqlite3.Connection): return
+    cursor = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+# ================= 语句计时 =================
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    # 只按语句类型 (SELECT / INSERT / UPDATE ...) 分类
+    DB_QUERY.observe(time.perf_counter() - started, statement.lstrip().split(None, 1)[0].upper())
+
+# ================= 版本化迁移 =================
+# 版本号记录在 PRAGMA user_version 中。db.create_all() 每次启动都会执行 (只建缺失的表)，
+# 这里只放改列与数据搬迁；每个步骤必须幂等，多个进程同时启动时重复执行也不会出错。
+
+def column_names(table):
+    return [c['name'] for c in db.inspect(db.engine).get_columns(table)]
+
+def add_points_column():
+    if 'points' not in column_names('user'):
+        db.session.execute(text("ALTER TABLE user ADD COLUMN points INTEGER DEFAULT 1000"))
+
+def migrate_legacy_settings():
+    """把旧版 user.settings JSON 拆分为 user_settings 行与二进制头像"""
+    if 'settings' not in column_names('user'): return
+    rows = db.session.execute(text(
+        "SELECT id, settings FROM user WHERE settings IS NOT NULL AND settings != ''"
+    )).fetchall()
+    for user_id, raw in rows:
+        try:
+            data = json.loads(raw or '{}')
+        except ValueError:
+            data = {}
+        avatar = data.pop('user_avatar', '')
+        if db.session.get(UserSettings, user_id) is None:
+            row = UserSettings.from_dict(data)
+            row.user_id = user_id
+            db.session.add(row)
+        if avatar and ',' in avatar and db.session.get(UserAvatar, user_id) is None:
+            header, encoded = avatar.split(',', 1)
+            mime_type = header[5:].split(';')[0] if header.startswith('data:') else 'image/jpeg'
+            item = UserAvatar(user_id=user_id)
+            item.set_image(base64.b64decode(encoded), mime_type or 'image/jpeg')
+            db.session.add(item)
+    # 旧列无法在所有 SQLite 版本上删除，清空内容释放空间
+    db.session.execute(text("UPDATE user SET settings = NULL"))
+
+def add_ledger_indexes():
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_points_ledger_user_created ON points_ledger (user_id, created_at)"
+    ))
+
+def add_user_version_column():
+    if 'version' not in column_names('user'):
+        db.session.execute(text("ALTER TABLE user ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+MIGRATIONS = [
+    (1, 'add user.points', add_points_column),
+    (2, 'split legacy user.settings', migrate_legacy_settings),
+    (3, 'points ledger indexes', add_ledger_indexes),
+    (4, 'add user.version', add_user_version_column),
+]
+
+def schema_version():
+    return db.session.execute(text("PRAGMA user_version")).scalar() or 0
+
+def run_migrations():
+    db.create_all()
+    current = schema_version()
+    for version, name, step in MIGRATIONS:
+        if version <= current: continue
+        try:
+            step()
+            db.session.execute(text(f"PRAGMA user_version = {int(version)}"))
+            db.session.commit()
+            print(f"Database migrated to v{version}: {name}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Migration v{version} ({name}) failed: {e}")
+            return schema_version()
+    return max(current, MIGRATIONS[-1][0])
+
+def migrate_lock_path(app):
+    """迁移锁文件放在 SQLite 数据库文件旁边，其他数据库放在应用目录"""
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:':
+        return url.database + '.migrate.lock'
+    return os.path.join(app.root_path, 'migrate.lock')
+
+def init_database(app):
+    # 多个 worker 进程同时启动时用文件锁串行执行建表与迁移
+    lock = open(migrate_lock_path(app), 'a') if fcntl is not None else None
+    try:
+        if lock is not None: fcntl.flock(lock, fcntl.LOCK_EX)
+        with app.app_context():
+            run_migrations()
+    finally:
+        if lock is not None: lock.close()
@@ -0,0 +1,180 @@
+import io
+import os
+import time
+import hashlib
+import importlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from utils import TTLCache
+from metrics import DOC_PARSE
+from startup import PARSER_IMPORTS
+
+try:
+    import resource
+    import signal
+    POSIX_LIMITS = hasattr(signal, 'SIGALRM')
+except ImportError:
+    POSIX_LIMITS = False
+
+TEXT_SUFFIXES = ('.txt', '.md', '.py', '.js')
+
+# ================= 提取器 (在子进程中运行) =================
+# 每种格式都按字符预算逐段读取，预算用完立即停止，不再解析剩余页面。
+
+def extract_pdf(data, limit):
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    parts, total = [], 0
+    for page in reader.pages:
+        text = page.extract_text()
+        if not text: continue
+        parts.append(text)
+        total += len(text) + 1
+        if total >= limit: break
+    return "\n".join(parts)[:limit]
+
+def extract_docx(data, limit):
+    from docx import Document
+    doc = Document(io.BytesIO(data))
+    parts, total = [], 0
+    for para in doc.paragraphs:
+        parts.append(para.text)
+        total += len(para.text) + 1
+        if total >= limit: break
+    return "\n".join(parts)[:limit]
+
+def extract_plain(data, limit):
+    # UTF-8 单字符最多 4 字节，只解码预算范围内的字节
+    return data[:limit * 4].decode('utf-8', errors='replace')[:limit]
+
+def extract_bytes(filename, data, limit):
+    if filename.endswith('.pdf'): return extract_pdf(data, limit)
+    if filename.endswith('.docx'): return extract_docx(data, limit)
+    if filename.endswith(TEXT_SUFFIXES): return extract_plain(data, limit)
+    return None
+
+class ParseTimeout(Exception):
+    pass
+
+def _raise_timeout(signum, frame):
+    raise ParseTimeout("解析超时")
+
+def _init_worker(memory_mb):
+    """子进程初始化：在当前地址空间基础上追加内存预算"""
+    if not POSIX_LIMITS or not memory_mb: return
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = current + memory_mb * 1024 * 1024
+    if hard != resource.RLIM_INFINITY: limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def _preload():
+    """预热：在子进程中提前导入解析库"""
+    for module in PARSER_IMPORTS:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    return os.getpid()
+
+def _run_job(filename, data, limit, timeout):
+    if POSIX_LIMITS and timeout:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(max(1, int(timeout)))
+    try:
+        return extract_bytes(filename, data, limit)
+    finally:
+        if POSIX_LIMITS and timeout: signal.alarm(0)
+
+# ================= 解析服务 =================
+class DocumentParser:
+    """在进程池中解析上传文档，结果按内容哈希缓存 (总字符数不超过 DOC_CACHE_CHARS)"""
+
+    def __init__(self, app=None):
+        self.limit = 15000
+        self.workers = 2
+        self.timeout = 10.0
+        self.memory_mb = 512
+        self.cache = TTLCache(maxsize=256, ttl=3600.0, max_weight=8000000)
+        self._pool = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.limit = conf.get('DOC_TEXT_LIMIT', self.limit)
+        self.workers = conf.get('DOC_PARSE_WORKERS', self.workers)
+        self.timeout = conf.get('DOC_PARSE_TIMEOUT', self.timeout)
+        self.memory_mb = conf.get('DOC_PARSE_MEMORY_MB', self.memory_mb)
+        self.cache.max_weight = conf.get('DOC_CACHE_CHARS', self.cache.max_weight)
+        app.extensions['document_parser'] = self
+
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        initializer=_init_worker,
+                        initargs=(self.memory_mb,)
+                    )
+        return self._pool
+
+    def warm_up(self):
+        """启动全部解析子进程并导入解析库，首次上传文档时不再等待"""
+        futures = [self.pool().submit(_preload) for _ in range(self.workers)]
+        return {future.result(timeout=60) for future in futures}
+
+    def reset_pool(self):
+        # 子进程卡死或崩溃时整体替换进程池，后续任务不受影响
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def parse(self, filename, data, limit=None):
+        """limit 为本次的字符上限，默认 DOC_TEXT_LIMIT；建立检索索引时使用更大的 DOC_INDEX_LIMIT"""
+        filename = filename.lower()
+        limit = limit or self.limit
+        if not filename.endswith(('.pdf', '.docx') + TEXT_SUFFIXES): return None
+        started = time.perf_counter()
+        suffix = os.path.splitext(filename)[1]
+        key = (hashlib.sha256(data).hexdigest(), suffix, limit)
+        text = self.cache.get(key)
+        if text is not None:
+            DOC_PARSE.observe(time.perf_counter() - started, suffix, 'hit')
+            return text
+        if filename.endswith(TEXT_SUFFIXES):
+            # 纯文本只需截断解码，不值得跨进程
+            text = extract_plain(data, limit)
+        else:
+            text = self._parse_in_pool(filename, data, limit)
+        self.cache.set(key, text)
+        DOC_PARSE.observe(time.perf_counter() - started, suffix, 'miss')
+        return text
+
+    def _parse_in_pool(self, filename, data, limit):
+        try:
+            future = self.pool().submit(_run_job, filename, data, limit, self.timeout)
+        except Exception:
+            self.reset_pool()
+            future = self.pool().submit(_run_job, filename, data, limit, self.timeout)
+        try:
+            return future.result(timeout=self.timeout + 5)
+        except FutureTimeout:
+            self.reset_pool()
+            raise ParseTimeout("解析超时")
+
+document_parser = DocumentParser()
+
+def extract_text_from_file(file_storage, limit=None):
+    filename = file_storage.filename.lower()
+    try:
+        return document_parser.parse(filename, file_storage.stream.read(), limit)
+    except Exception as e:
+        return f"[System Error: Failed to parse file {filename}. Reason: {str(e) or type(e).__name__}]"
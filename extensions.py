@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from upstream import UpstreamClients
 
 db = SQLAlchemy()
 login_manager = LoginManager()
-login_manager.login_view = 'auth.login_page' # 注意这里变成了 blueprint.view
\ No newline at end of file
+login_manager.login_view = 'auth.login_page' # 注意这里变成了 blueprint.view
+upstream_clients = UpstreamClients()
\ No newline at end of file
@@ -0,0 +1,99 @@
+from flask_login import UserMixin
+from sqlalchemy import text
+from extensions import db, login_manager
+from models import User, UserSettings, UserAvatar, DEFAULT_SETTINGS
+from utils import TTLCache
+
+# ================= 登录用户缓存 =================
+# Flask-Login 每个请求都要加载 current_user。这里缓存用户行的只读快照 (含设置与头像 etag)，命中时不访问数据库。
+# 所有写入 (设置、头像、点数) 在同一事务中把 user.version 加一，提交后调用 invalidate()；
+# 多进程模式下缓存由 shared.SharedState 切换到共享后端，失效对所有 worker 生效。
+# 需要修改用户数据的接口通过 current_user.row() 取得会话内的 ORM 对象。
+
+class SettingsSnapshot:
+    """UserSettings 的只读副本：FIELDS 为属性，to_dict() 与 ORM 版本一致"""
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+
+    def __getattr__(self, name):
+        if name in UserSettings.FIELDS: return self._data.get(name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"settings snapshot is read-only ({name})")
+
+    def to_dict(self):
+        return dict(self._data)
+
+class UserSnapshot(UserMixin):
+    """与会话分离的只读用户快照 (不含密码哈希)"""
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, 'prefs', SettingsSnapshot(data['settings']))
+
+    def __getattr__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"current_user is a read-only snapshot; use current_user.row() to modify {name}")
+
+    def row(self):
+        """当前会话中的 User ORM 对象，用于写入"""
+        return db.session.get(User, self.id)
+
+def bump_version(user_id):
+    """在当前事务中递增 user.version，随写入一起提交"""
+    db.session.execute(text("UPDATE user SET version = version + 1 WHERE id = :uid"), {'uid': user_id})
+
+class IdentityCache:
+    def __init__(self, app=None):
+        self.cache = TTLCache(maxsize=4096, ttl=60.0)
+        # 每个用户的失效次数；加载期间发生失效时不写入缓存，避免旧快照覆盖新数据
+        self._generations = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.cache = TTLCache(maxsize=conf.get('USER_CACHE_SIZE', 4096), ttl=conf.get('USER_CACHE_TTL', 60.0))
+        login_manager.user_loader(self.load)
+        app.extensions['identity_cache'] = self
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def fetch(self, user_id):
+        user = db.session.get(User, user_id)
+        if user is None: return None
+        settings = user.settings_row or UserSettings.from_dict(DEFAULT_SETTINGS)
+        etag = db.session.query(UserAvatar.etag).filter_by(user_id=user_id).scalar()
+        return {'id': user.id, 'username': user.username, 'points': user.points, 'version': user.version or 0,
+                'avatar_etag': etag or '', 'settings': settings.to_dict()}
+
+    def load(self, user_id):
+        user_id = int(user_id)
+        data = self.cache.get(user_id)
+        if data is None:
+            generation = self._generations.get(user_id, 0)
+            data = self.fetch(user_id)
+            if data is None: return None
+            if self._generations.get(user_id, 0) == generation: self.cache.set(user_id, data)
+        return UserSnapshot(data)
+
+    def invalidate(self, user_id):
+        """写入提交后调用"""
+        if len(self._generations) > 65536: self._generations.clear()
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        self.cache.pop(user_id)
+
+identity_cache = IdentityCache()
@@ -0,0 +1,239 @@
+import time
+import sqlite3
+import threading
+from uuid import uuid4
+from collections import deque, defaultdict
+
+# ================= 限流规则 =================
+class LimitRule:
+    """令牌桶 (rate 个/秒，容量 burst) + 最大并发 concurrency；取 0 表示不限制该项"""
+
+    def __init__(self, rate=0.0, burst=0, concurrency=0):
+        self.rate = float(rate or 0)
+        self.burst = float(burst or max(1.0, self.rate))
+        self.concurrency = int(concurrency or 0)
+
+    @classmethod
+    def from_dict(cls, conf):
+        return cls(conf.get('rate', 0), conf.get('burst', 0), conf.get('concurrency', 0))
+
+    @property
+    def unlimited(self):
+        return not self.rate and not self.concurrency
+
+    def refill(self, tokens, updated, now):
+        if not self.rate: return self.burst
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def wait_time(self, tokens):
+        return (1 - tokens) / self.rate if self.rate and tokens < 1 else 0.0
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+# ================= 后端 =================
+# try_acquire 必须原子地完成：补充令牌 -> 检查并发与令牌 -> 扣令牌并登记租约。
+# 租约带过期时间 (ttl)，持有方在流进行中定期续期 (renew)；进程崩溃未释放的并发名额过期后自动回收。
+
+class MemoryBackend:
+    """单进程内存后端"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._leases = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key, rule, now, ttl):
+        with self._lock:
+            leases = self._leases[key]
+            for lease_id in [i for i, expires in leases.items() if expires < now]:
+                del leases[lease_id]
+            if rule.concurrency and len(leases) >= rule.concurrency:
+                return None, 0.0
+            tokens, updated = self._buckets.get(key, (rule.burst, now))
+            tokens = rule.refill(tokens, updated, now)
+            if rule.rate and tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return None, rule.wait_time(tokens)
+            self._buckets[key] = (tokens - 1 if rule.rate else tokens, now)
+            lease_id = uuid4().hex
+            leases[lease_id] = now + ttl
+            return lease_id, 0.0
+
+    def renew(self, key, lease_id, expires):
+        with self._lock:
+            leases = self._leases.get(key)
+            if leases and lease_id in leases: leases[lease_id] = expires
+
+    def release(self, key, lease_id):
+        with self._lock:
+            leases = self._leases[key]
+            leases.pop(lease_id, None)
+            if not leases: del self._leases[key]
+
+class SqliteBackend:
+    """基于 SQLite 的跨进程后端，多个 worker 进程共享同一份计数"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS limiter_buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS limiter_leases (id TEXT PRIMARY KEY, key TEXT, expires REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_limiter_leases_key ON limiter_leases (key, expires)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def try_acquire(self, key, rule, now, ttl):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM limiter_leases WHERE key = ? AND expires < ?", (key, now))
+            if rule.concurrency:
+                inflight = conn.execute("SELECT COUNT(*) FROM limiter_leases WHERE key = ?", (key,)).fetchone()[0]
+                if inflight >= rule.concurrency:
+                    conn.execute("COMMIT")
+                    return None, 0.0
+            row = conn.execute("SELECT tokens, updated FROM limiter_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = rule.refill(*(row or (rule.burst, now)), now)
+            granted = not rule.rate or tokens >= 1
+            if granted and rule.rate: tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO limiter_buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            lease_id = None
+            if granted:
+                lease_id = uuid4().hex
+                conn.execute("INSERT INTO limiter_leases (id, key, expires) VALUES (?, ?, ?)", (lease_id, key, now + ttl))
+            conn.execute("COMMIT")
+            return lease_id, (0.0 if granted else rule.wait_time(tokens))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def renew(self, key, lease_id, expires):
+        self._conn().execute("UPDATE limiter_leases SET expires = ? WHERE id = ?", (expires, lease_id))
+
+    def release(self, key, lease_id):
+        self._conn().execute("DELETE FROM limiter_leases WHERE id = ?", (lease_id,))
+
+# ================= 限流器 =================
+class Lease:
+    def __init__(self, limiter, key, lease_id):
+        self.limiter = limiter
+        self.key = key
+        self.lease_id = lease_id
+        self.released = False
+        self.renew_at = time.time() + limiter.lease_ttl / 3
+
+    def renew(self):
+        """流进行中调用 (可以很频繁)，每 lease_ttl/3 秒才真正写一次后端"""
+        now = time.time()
+        if self.released or not self.lease_id or now < self.renew_at: return
+        self.renew_at = now + self.limiter.lease_ttl / 3
+        self.limiter.backend.renew(self.key, self.lease_id, now + self.limiter.lease_ttl)
+
+    def release(self):
+        if self.released: return
+        self.released = True
+        if self.lease_id: self.limiter.release(self)
+
+class Limiter:
+    """按 key 排队的限流器：同一队列先到先得，等待有上限，超时或排队过长抛出 RateLimited"""
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, app=None):
+        self.backend = MemoryBackend()
+        self.max_wait = 5.0
+        self.max_queue = 20
+        self.lease_ttl = 165.0
+        self.tiers = {}
+        self.rejected = 0
+        self._queues = defaultdict(deque)
+        self._cond = threading.Condition()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        if conf.get('LIMITER_BACKEND', 'memory') == 'sqlite':
+            self.backend = SqliteBackend(conf['LIMITER_DB'])
+        self.max_wait = conf.get('LIMITER_MAX_WAIT', self.max_wait)
+        self.max_queue = conf.get('LIMITER_MAX_QUEUE', self.max_queue)
+        self.lease_ttl = conf.get('LIMITER_LEASE_TTL', self.lease_ttl)
+        self.tiers = {name: LimitRule.from_dict(rule) for name, rule in conf.get('RATE_LIMITS', {}).items()}
+        app.extensions['limiter'] = self
+
+    def rule_for(self, tier):
+        return self.tiers.get(tier) or LimitRule()
+
+    def acquire(self, key, rule):
+        return self.acquire_any(key, [(key, rule)])
+
+    def try_acquire(self, key, rule):
+        """不排队：有名额时返回租约，否则返回 None"""
+        lease, _ = self._try_candidates([(key, rule)])
+        return lease
+
+    def acquire_any(self, queue_name, candidates):
+        """依次尝试 candidates 中的 (key, rule)，返回第一个拿到的租约；都没有名额时排队等待
+
+        不限流的 key 直接得到一个空租约 (lease_id 为 None)，调用方据 lease.key 得知选中了谁。
+        """
+        ticket = object()
+        with self._cond:
+            queue = self._queues[queue_name]
+            if len(queue) >= self.max_queue:
+                self.rejected += 1
+                raise RateLimited("排队请求过多，请稍后再试", self.max_wait)
+            queue.append(ticket)
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while True:
+                retry_after = self.max_wait
+                if self._queues[queue_name][0] is ticket:
+                    lease, retry_after = self._try_candidates(candidates)
+                    if lease: return lease
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise RateLimited("请求过于频繁或并发过多，请稍后再试", retry_after)
+                with self._cond:
+                    self._cond.wait(min(remaining, self.POLL_INTERVAL, retry_after))
+        finally:
+            with self._cond:
+                self._queues[queue_name].remove(ticket)
+                if not self._queues[queue_name]: del self._queues[queue_name]
+                self._cond.notify_all()
+
+    def _try_candidates(self, candidates):
+        """返回 (租约, None) 或 (None, 最早可能有令牌的等待秒数；仅受并发限制时为 max_wait)"""
+        now = time.time()
+        retry_after = None
+        for key, rule in candidates:
+            if rule.unlimited: return Lease(self, key, None), None
+            lease_id, wait = self.backend.try_acquire(key, rule, now, self.lease_ttl)
+            if lease_id: return Lease(self, key, lease_id), None
+            if wait: retry_after = min(retry_after or wait, wait)
+        return None, retry_after or self.max_wait
+
+    def release(self, lease):
+        self.backend.release(lease.key, lease.lease_id)
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'waiting': sum(len(q) for q in self._queues.values()),
+            'rejected': self.rejected
+        }
+
+limiter = Limiter()
@@ -0,0 +1,277 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+import httpx
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# ================= 指标注册表 =================
+# 每个线程写自己的分片 (普通 dict)，热路径上没有锁；抓取 /metrics 时再把所有分片求和。
+# 线程退出后其分片并入 retired 再丢弃，计数不会丢失，短命线程也不会让分片无限增长。
+
+def merge(into, shard):
+    for key, value in list(shard.items()):
+        if isinstance(value, list):
+            total = into.get(key)
+            into[key] = value[:] if total is None else [a + b for a, b in zip(total, value)]
+        else:
+            into[key] = into.get(key, 0) + value
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._local = threading.local()
+        self._shards = []  # (线程, 分片)
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        """调用方持有 _lock：已退出线程不会再写分片，可以安全合并"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive(): live.append((thread, shard))
+            else: merge(self._retired, shard)
+        self._shards = live
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(self, name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(self, name, help_text, labelnames))
+
+    def histogram(self, name, help_text, buckets, labelnames=()):
+        return self.register(Histogram(self, name, help_text, buckets, labelnames))
+
+    def gauge_func(self, name, help_text, fn, labelnames=(), kind='gauge'):
+        """抓取时调用 fn()，返回数值或 {标签值元组: 数值}"""
+        return self.register(CallbackMetric(name, help_text, fn, labelnames, kind))
+
+    def snapshot(self):
+        """把所有线程分片按 (metric, labels) 合并"""
+        merged = {}
+        with self._lock:
+            self._retire()
+            merge(merged, self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards: merge(merged, shard)
+        return merged
+
+    def render(self):
+        merged = self.snapshot()
+        grouped = {}
+        for (metric, labels), value in merged.items():
+            grouped.setdefault(metric, []).append((labels, value))
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                metric.render(lines, sorted(grouped.get(metric, ())))
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {type(e).__name__}")
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_str(names, values, extra=''):
+    parts = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra: parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def fmt(value):
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name, help_text, labelnames):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def render(self, lines, samples):
+        for labels, value in samples:
+            lines.append(f"{self.name}{label_str(self.labelnames, labels)} {fmt(value)}")
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self.registry.shard()
+        key = (self, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, buckets, labelnames):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        shard = self.registry.shard()
+        key = (self, labels)
+        slots = shard.get(key)
+        if slots is None:
+            # 每个桶的非累计计数 + (+Inf) + sum
+            slots = shard[key] = [0] * (len(self.buckets) + 2)
+        slots[bisect_left(self.buckets, value)] += 1
+        slots[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def render(self, lines, samples):
+        for labels, slots in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), slots):
+                cumulative += count
+                le = 'le="%s"' % fmt(bound)
+                lines.append(f"{self.name}_bucket{label_str(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_str(self.labelnames, labels)} {fmt(slots[-1])}")
+            lines.append(f"{self.name}_count{label_str(self.labelnames, labels)} {cumulative}")
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class CallbackMetric(Metric):
+    def __init__(self, name, help_text, fn, labelnames, kind):
+        super().__init__(None, name, help_text, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self, lines, samples):
+        value = self.fn()
+        if not isinstance(value, dict): value = {(): value}
+        super().render(lines, sorted(value.items()))
+
+registry = Registry()
+
+# ================= 指标定义 =================
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320, 640)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+UPSTREAM_CONNECT = registry.histogram(
+    'aihub_upstream_connect_seconds', '从发起上游请求到收到响应头的时间', LATENCY_BUCKETS, ('provider',))
+STREAM_TTFT = registry.histogram(
+    'aihub_stream_ttft_seconds', '从收到对话请求到向客户端输出首个内容帧的时间', LATENCY_BUCKETS, ('provider',))
+STREAM_DURATION = registry.histogram(
+    'aihub_stream_duration_seconds', '对话流总时长', DURATION_BUCKETS, ('provider',))
+STREAM_CHUNK_RATE = registry.histogram(
+    'aihub_stream_chunks_per_second', '上游每秒推送的数据块数 (OpenAI 兼容接口约等于 token/s)', RATE_BUCKETS, ('provider',))
+STREAM_CHUNKS = registry.counter(
+    'aihub_stream_chunks_total', '上游推送的数据块总数', ('provider',))
+STREAM_BYTES = registry.counter(
+    'aihub_stream_bytes_total', '转发给客户端的字节数', ('provider',))
+STREAMS = registry.counter(
+    'aihub_streams_total', '结束的对话流数量', ('provider', 'outcome'))
+STREAMS_ACTIVE = registry.gauge(
+    'aihub_streams_active', '正在进行的对话流', ('channel',))
+UPSTREAM_ERRORS = registry.counter(
+    'aihub_upstream_errors_total', '上游错误 (按类别)', ('provider', 'class'))
+DB_QUERY = registry.histogram(
+    'aihub_db_query_seconds', '数据库语句耗时', FAST_BUCKETS, ('statement',))
+DOC_PARSE = registry.histogram(
+    'aihub_doc_parse_seconds', '上传文档解析耗时', FAST_BUCKETS + (2.5, 5, 10), ('format', 'cache'))
+
+def error_class(error):
+    """把 HTTP 状态码或异常归为少量类别，避免标签基数膨胀"""
+    if isinstance(error, int): return f"http_{error}"
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)): return 'connect'
+    if isinstance(error, (httpx.TimeoutException, TimeoutError)): return 'timeout'
+    if isinstance(error, httpx.HTTPError): return 'network'
+    return 'internal'
+
+class StreamProbe:
+    """一次对话流的计时与计数 (同步 generate() 与 ASGI 流共用)"""
+
+    def __init__(self, provider, channel, started=None):
+        self.provider = provider
+        self.channel = channel
+        self.started = started or time.perf_counter()
+        self.first_frame = None
+        self.chunks = 0
+        self.bytes = 0
+        self.outcome = 'error'
+        STREAMS_ACTIVE.inc(channel)
+
+    def connected(self, latency):
+        UPSTREAM_CONNECT.observe(latency, self.provider)
+
+    def error(self, error):
+        UPSTREAM_ERRORS.inc(self.provider, error_class(error))
+
+    def relay(self, frames):
+        """记录即将发送给客户端的帧，原样返回"""
+        if frames:
+            if self.first_frame is None:
+                self.first_frame = time.perf_counter()
+                STREAM_TTFT.observe(self.first_frame - self.started, self.provider)
+            self.bytes += sum(len(f) for f in frames)
+        return frames
+
+    def close(self):
+        now = time.perf_counter()
+        STREAMS_ACTIVE.dec(self.channel)
+        STREAM_DURATION.observe(now - self.started, self.provider)
+        STREAMS.inc(self.provider, self.outcome)
+        STREAM_BYTES.inc(self.provider, amount=self.bytes)
+        if self.chunks:
+            STREAM_CHUNKS.inc(self.provider, amount=self.chunks)
+            if self.first_frame is not None and now > self.first_frame:
+                STREAM_CHUNK_RATE.observe(self.chunks / (now - self.first_frame), self.provider)
+
+# ================= 进程指标 =================
+def process_cpu_seconds():
+    if resource is None: return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def process_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None: return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+registry.gauge_func('process_cpu_seconds_total', '进程累计 CPU 时间', process_cpu_seconds, kind='counter')
+registry.gauge_func('process_resident_memory_bytes', '进程常驻内存', process_rss_bytes)
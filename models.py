@@ -1,13 +1,151 @@
+import json
+import hashlib
+from datetime import datetime
 from flask_login import UserMixin
-from extensions import db, login_manager
+from sqlalchemy.orm import deferred
+from extensions import db
+
+DEFAULT_SETTINGS = {
+    "api_endpoint": "https://api.openai.com/v1",
+    "api_key": "",
+    "model": "gpt-3.5-turbo",
+    "system_prompt": "You are a helpful assistant.",
+    "dark_mode": False
+}
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(150), nullable=False)
-    settings = db.Column(db.Text, default='{}')
     points = db.Column(db.Integer, default=1000)
+    # 行版本：设置、头像、点数的每次写入都加一 (见 identity.py)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # 设置与头像拆到独立表，仅在访问时才加载 (load_user 不再携带大字段)
+    settings_row = db.relationship('UserSettings', uselist=False, lazy='select', cascade='all, delete-orphan')
+    avatar = db.relationship('UserAvatar', uselist=False, lazy='select', cascade='all, delete-orphan')
+
+    @property
+    def prefs(self):
+        if self.settings_row is None:
+            self.settings_row = UserSettings.from_dict(DEFAULT_SETTINGS)
+        return self.settings_row
+
+class UserSettings(db.Model):
+    # 热路径 (chat / fetch_models) 只读这些类型化字段
+    FIELDS = ('api_endpoint', 'api_key', 'model', 'system_prompt', 'use_official_api',
+              'custom_request_template', 'custom_response_path')
+    # 前端回传但不属于设置的字段
+    IGNORED = ('new_password', 'account_username', 'user_avatar')
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    api_endpoint = db.Column(db.String(500), default='')
+    api_key = db.Column(db.Text, default='')
+    model = db.Column(db.String(200), default='gpt-3.5-turbo')
+    system_prompt = db.Column(db.Text, default='')
+    use_official_api = db.Column(db.Boolean, default=False)
+    custom_request_template = db.Column(db.Text, default='')
+    custom_response_path = db.Column(db.String(500), default='')
+    # 其余界面偏好 (dark_mode, context_length 等) 以 JSON 保存，延迟加载
+    extra = deferred(db.Column(db.Text, default='{}'))
+
+    @classmethod
+    def from_dict(cls, data):
+        row = cls(extra='{}')
+        row.update(data)
+        return row
+
+    def update(self, data):
+        extra = json.loads(self.extra or '{}')
+        for key, value in data.items():
+            if key in self.IGNORED: continue
+            if key == 'use_official_api': value = bool(value)
+            if key in self.FIELDS: setattr(self, key, value)
+            else: extra[key] = value
+        self.extra = json.dumps(extra)
+
+    def to_dict(self):
+        result = json.loads(self.extra or '{}')
+        for key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not None: result[key] = value
+        return result
+
+class UserAvatar(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    mime_type = db.Column(db.String(50), default='image/jpeg')
+    etag = db.Column(db.String(64), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    data = deferred(db.Column(db.LargeBinary, nullable=False))
+
+    def set_image(self, data, mime_type='image/jpeg'):
+        self.data = data
+        self.mime_type = mime_type
+        self.etag = hashlib.sha1(data).hexdigest()[:16]
+        self.updated_at = datetime.utcnow()
+
+class PointsLedger(db.Model):
+    """点数流水 (只追加)：reserve 为预扣，commit/refund 为结算，topup 为充值"""
+    __table_args__ = (db.Index('ix_points_ledger_user_created', 'user_id', 'created_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    reservation_id = db.Column(db.String(32), index=True)
+    kind = db.Column(db.String(16), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    model = db.Column(db.String(200), default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Conversation(db.Model):
+    """服务端会话：消息只追加，客户端每轮只需发送会话 ID 与新消息"""
+    __table_args__ = (db.Index('ix_conversation_user_updated', 'user_id', 'updated_at'),)
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(200), default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {'id': self.id, 'title': self.title,
+                'created_at': self.created_at.isoformat(), 'updated_at': self.updated_at.isoformat()}
+
+class ConversationMessage(db.Model):
+    """会话消息 (只追加)：tokens 在写入时估算一次；reply_to 指向助手回复所回答的用户消息，
+    重新生成时追加新回复，旧回复在组装上下文时被跳过"""
+    __table_args__ = (db.Index('ix_conversation_message_conv', 'conversation_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.String(32), db.ForeignKey('conversation.id'), nullable=False)
+    role = db.Column(db.String(16), nullable=False)
+    content = db.Column(db.Text, nullable=False, default='')
+    tokens = db.Column(db.Integer, nullable=False, default=0)
+    reply_to = db.Column(db.Integer)
+    model = db.Column(db.String(200), default='')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {'id': self.id, 'role': self.role, 'content': self.content, 'reply_to': self.reply_to,
+                'model': self.model, 'created_at': self.created_at.isoformat()}
+
+class Document(db.Model):
+    """用户上传并已建立检索索引的文档 (同一用户按内容哈希去重)"""
+    __table_args__ = (db.Index('ix_document_user_sha', 'user_id', 'sha256'),)
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(300), default='')
+    sha256 = db.Column(db.String(64), nullable=False)
+    chars = db.Column(db.Integer, default=0)
+    chunk_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {'id': self.id, 'filename': self.filename, 'chars': self.chars, 'chunks': self.chunk_count}
+
+class DocumentChunk(db.Model):
+    document_id = db.Column(db.String(32), db.ForeignKey('document.id'), primary_key=True)
+    ordinal = db.Column(db.Integer, primary_key=True)
+    length = db.Column(db.Integer, nullable=False)  # 词项数，BM25 的文档长度
+    content = db.Column(db.Text, nullable=False)
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
\ No newline at end of file
+class DocumentTerm(db.Model):
+    """倒排索引：每个 (文档, 词项) 一行，postings 为 "块序号:词频" 空格分隔"""
+    document_id = db.Column(db.String(32), db.ForeignKey('document.id'), primary_key=True)
+    term = db.Column(db.String(64), primary_key=True)
+    postings = db.Column(db.Text, nullable=False)
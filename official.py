@@ -0,0 +1,164 @@
+import time
+import hashlib
+import threading
+from collections import deque
+from config import load_official_config
+from limits import LimitRule
+
+# ================= 官方通道上游池 =================
+# official_key.json 兼容两种写法：
+#   单上游: {"api_endpoint": "...", "api_key": "..."}
+#   多上游: {"upstreams": [{"name": "ds-1", "api_endpoint": "...", "api_key": "...",
+#                           "weight": 2, "models": ["deepseek"]}, ...]}
+# models 为模型名关键词 (子串匹配)，留空表示所有模型均可使用该上游。
+# 可选的 rpm (每分钟请求数) 与 max_concurrency (最大并发流) 用于按上游限流。
+
+RETRYABLE_STATUS = {401, 403, 408, 429, 500, 502, 503, 504}
+
+def chat_url(api_endpoint):
+    clean_endpoint = api_endpoint.strip().rstrip('/')
+    return clean_endpoint if clean_endpoint.endswith('/chat/completions') else f"{clean_endpoint}/chat/completions"
+
+class UpstreamHealth:
+    """上游的运行统计与熔断状态；热加载后同一上游继续共用同一个对象"""
+    WINDOW = 60.0
+
+    def __init__(self):
+        self.outstanding = 0
+        self.latency = 1.0
+        self.results = deque()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def error_rate(self, now):
+        while self.results and now - self.results[0][0] > self.WINDOW:
+            self.results.popleft()
+        if not self.results: return 0.0
+        return sum(1 for _, ok in self.results if not ok) / len(self.results)
+
+class Upstream:
+    def __init__(self, conf, index):
+        self.name = conf.get('name') or f"upstream-{index}"
+        self.api_endpoint = (conf.get('api_endpoint') or '').strip()
+        self.api_key = (conf.get('api_key') or '').strip()
+        self.weight = max(float(conf.get('weight', 1) or 1), 0.01)
+        self.models = [m.lower() for m in conf.get('models', []) or []]
+        rpm = float(conf.get('rpm', 0) or 0)
+        self.rule = LimitRule(rpm / 60, max(1, rpm / 6), conf.get('max_concurrency', 0))
+        self.health = UpstreamHealth()
+
+    @property
+    def identity(self):
+        return (self.api_endpoint, hashlib.sha256(self.api_key.encode('utf-8')).hexdigest()[:16])
+
+    @property
+    def limit_key(self):
+        return f"official:{self.identity[0]}:{self.identity[1]}"
+
+    def eligible(self, model_name):
+        if not self.api_endpoint or not self.api_key: return False
+        if not self.models or not model_name: return True
+        name = model_name.lower()
+        return any(keyword in name for keyword in self.models)
+
+    def score(self, now):
+        # 最少在途请求优先，再按延迟与错误率加权
+        h = self.health
+        return (h.outstanding + 1) * h.latency * (1 + 4 * h.error_rate(now)) / self.weight
+
+    def snapshot(self, now):
+        h = self.health
+        return {
+            'name': self.name,
+            'outstanding': h.outstanding,
+            'latency': round(h.latency, 4),
+            'error_rate': round(h.error_rate(now), 4),
+            'state': 'open' if h.opened_at is not None else 'closed'
+        }
+
+class OfficialPool:
+    """官方通道的多上游负载均衡与熔断"""
+
+    def __init__(self, app=None):
+        self.max_attempts = 3
+        self.breaker_failures = 5
+        self.breaker_cooldown = 30.0
+        self._source = None
+        self._upstreams = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.max_attempts = conf.get('OFFICIAL_MAX_ATTEMPTS', self.max_attempts)
+        self.breaker_failures = conf.get('OFFICIAL_BREAKER_FAILURES', self.breaker_failures)
+        self.breaker_cooldown = conf.get('OFFICIAL_BREAKER_COOLDOWN', self.breaker_cooldown)
+        app.extensions['official_pool'] = self
+
+    def upstreams(self):
+        conf = load_official_config()
+        if conf is not self._source:
+            with self._lock:
+                if conf is not self._source:
+                    entries = conf.get('upstreams') or [conf]
+                    fresh = [Upstream(entry, i) for i, entry in enumerate(entries)]
+                    previous = {u.identity: u for u in self._upstreams}
+                    for upstream in fresh:
+                        if upstream.identity in previous: upstream.health = previous[upstream.identity].health
+                    self._upstreams = fresh
+                    self._source = conf
+        return self._upstreams
+
+    def _available(self, upstream, now):
+        h = upstream.health
+        if h.opened_at is None: return True
+        # 冷却结束后进入半开状态，只放行一个探测请求
+        return now - h.opened_at >= self.breaker_cooldown and not h.trial
+
+    def plan(self, model_name=None):
+        """按优先级返回本次请求可依次尝试的上游；全部熔断时仍按打开先后返回，避免完全不可用"""
+        now = time.monotonic()
+        candidates = [u for u in self.upstreams() if u.eligible(model_name)]
+        with self._lock:
+            healthy = sorted((u for u in candidates if self._available(u, now)), key=lambda u: u.score(now))
+            tripped = sorted((u for u in candidates if not self._available(u, now)), key=lambda u: u.health.opened_at or 0)
+        return (healthy + tripped)[:self.max_attempts]
+
+    def primary(self, model_name=None):
+        plan = self.plan(model_name)
+        return plan[0] if plan else None
+
+    def begin(self, upstream):
+        with self._lock:
+            h = upstream.health
+            h.outstanding += 1
+            if h.opened_at is not None: h.trial = True
+
+    def finish(self, upstream, ok, latency=None):
+        now = time.monotonic()
+        with self._lock:
+            h = upstream.health
+            h.outstanding = max(0, h.outstanding - 1)
+            h.results.append((now, ok))
+            if latency is not None:
+                h.latency = 0.7 * h.latency + 0.3 * latency
+            if ok:
+                h.failures = 0
+                h.opened_at = None
+                h.trial = False
+            else:
+                h.failures += 1
+                if h.trial or h.failures >= self.breaker_failures:
+                    if h.opened_at is None:
+                        print(f"Official upstream '{upstream.name}' ejected after {h.failures} failures")
+                    h.opened_at = now
+                    h.trial = False
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [u.snapshot(now) for u in self._upstreams]
+
+official_pool = OfficialPool()
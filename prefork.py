@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+
+# ================= 多进程预派生模式 =================
+# 仅 Linux / macOS (依赖 SIGHUP 与 pass_fds)。
+# 用法: FLASK_ENV=production WEB_WORKERS=4 python app.py     (WEB_WORKERS=0 按 CPU 核数；默认 1 为单进程)
+#   或: python prefork.py --port 5000 --workers 4
+# 主进程只持有监听套接字并管理 worker，不处理请求。经 python prefork.py 启动时主进程不导入应用；
+# 经 python app.py 启动时主进程已导入 app 并执行过建表迁移，但不会把它交给 worker。
+# worker 是继承该套接字的全新解释器，启动后才导入 app，因此平滑重启会加载新代码，也没有 fork 后共享连接 / 线程的问题。
+#   SIGHUP          平滑重启：先起一批新 worker，再让旧 worker 停止接受连接、处理完在途请求后退出
+#   SIGTERM/SIGINT  平滑停止
+# worker 意外退出时自动补起。跨进程状态见 shared.py (SHARED_STATE_BACKEND=sqlite) 与 limits.SqliteBackend，
+# 两者未设置时 worker 默认使用 sqlite；显式设置的值保持不变。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def default_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def bind_socket(host, port, backlog=2048):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+class Arbiter:
+    """主进程：启动、补起与平滑替换 worker"""
+    RESPAWN_BACKOFF = 2.0  # worker 启动后很快退出 (如配置错误) 时，补起前等待的秒数
+
+    def __init__(self, host='0.0.0.0', port=5000, workers=0, threads=6, graceful_timeout=60.0):
+        self.host = host
+        self.port = port
+        self.count = workers or default_workers()
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.sock = None
+        self.workers = {}  # pid -> (Popen, 代数, 启动时间)
+        self.generation = 0
+        self.signals = []
+        self.stopping = False
+
+    def spawn(self):
+        env = dict(os.environ, FLASK_ENV='production')
+        env.setdefault('SHARED_STATE_BACKEND', 'sqlite')
+        env.setdefault('LIMITER_BACKEND', 'sqlite')
+        fd = self.sock.fileno()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'worker', '--fd', str(fd),
+             '--threads', str(self.threads), '--graceful-timeout', str(self.graceful_timeout)],
+            pass_fds=(fd,), env=env, cwd=BASE_DIR
+        )
+        self.workers[proc.pid] = (proc, self.generation, time.monotonic())
+
+    def run(self):
+        self.sock = bind_socket(self.host, self.port)
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: self.signals.append(signum))
+        for _ in range(self.count): self.spawn()
+        for name in ('SHARED_STATE_BACKEND', 'LIMITER_BACKEND'):
+            if self.count > 1 and os.environ.get(name, 'sqlite') != 'sqlite':
+                print(f" * WARNING: {name}={os.environ[name]}, state is not shared between workers")
+        print(f" * Prefork master {os.getpid()}: {self.count} workers x {self.threads} threads on http://{self.host}:{self.port}")
+        while True:
+            time.sleep(0.5)
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    return self.stop()
+            self.reap()
+
+    def reap(self):
+        for pid, (proc, generation, started) in list(self.workers.items()):
+            if proc.poll() is None: continue
+            del self.workers[pid]
+            if self.stopping or generation != self.generation: continue
+            print(f" * Worker {pid} exited with {proc.returncode}, respawning")
+            if time.monotonic() - started < 5: time.sleep(self.RESPAWN_BACKOFF)
+            self.spawn()
+
+    def reload(self):
+        old = [proc for proc, _, _ in self.workers.values()]
+        self.generation += 1
+        for _ in range(self.count): self.spawn()
+        # 监听套接字一直由主进程持有，新旧交替期间的连接在 backlog 中排队，不会被拒绝
+        for proc in old: proc.send_signal(signal.SIGTERM)
+        print(f" * Graceful reload: generation {self.generation}")
+
+    def stop(self):
+        self.stopping = True
+        procs = [proc for proc, _, _ in self.workers.values()]
+        for proc in procs: proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        for proc in procs:
+            try:
+                proc.wait(max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.sock.close()
+
+# ================= worker =================
+def run_worker(fd, threads, graceful_timeout):
+    from waitress import create_server
+    from app import app
+    sock = socket.socket(fileno=fd)
+    server = create_server(app, sockets=[sock], threads=threads)
+    stopping = threading.Event()
+
+    def drained():
+        dispatcher = server.task_dispatcher
+        if dispatcher.active_count or dispatcher.queue: return False
+        return not any(getattr(channel, 'total_outbufs_len', 0) for channel in list(server._map.values()))
+
+    def stop_accepting():
+        # 只关闭本进程持有的监听副本，其他 worker 与主进程的监听不受影响；
+        # 不用 server.close()，它会同时关闭下面还要用的 trigger
+        server.del_channel()
+        server.socket.close()
+
+    def drain():
+        # 关闭与退出都经 trigger 交给事件循环线程执行，避免在 select 等待中的套接字被其他线程关闭
+        server.trigger.pull_trigger(stop_accepting)
+        deadline = time.monotonic() + graceful_timeout
+        while time.monotonic() < deadline and not drained():
+            time.sleep(0.1)
+        # 清空事件循环的 map 后 server.run() 返回
+        server.trigger.pull_trigger(server._map.clear)
+
+    def stop(signum, frame):
+        if stopping.is_set(): return
+        stopping.set()
+        threading.Thread(target=drain, name='graceful-drain', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.run()
+    server.task_dispatcher.shutdown(timeout=5)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='多进程预派生模式')
+    sub = parser.add_subparsers(dest='role')
+    worker = sub.add_parser('worker')
+    worker.add_argument('--fd', type=int, required=True)
+    worker.add_argument('--threads', type=int, default=6)
+    worker.add_argument('--graceful-timeout', type=float, default=60.0)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', 0)), help='0 为 CPU 核数')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 6)))
+    parser.add_argument('--graceful-timeout', type=float, default=float(os.environ.get('GRACEFUL_TIMEOUT', 60)))
+    args = parser.parse_args()
+    if args.role == 'worker':
+        run_worker(args.fd, args.threads, args.graceful_timeout)
+    else:
+        Arbiter(args.host, args.port, args.workers, args.threads, args.graceful_timeout).run()
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from utils import TTLCache
+
+# ================= 回复缓存 =================
+# 对完全相同的最终 payload (build_dynamic_payload 的输出) + 上游身份，直接回放上次的完整回复。
+# 两级：进程内 LRU (TTLCache) + 磁盘目录 (按总大小淘汰最久未用的文件，多进程共享)。
+# 缓存的是转码后的文本 (含 <think>…</think>)，回放时重新切成 SSE 帧。
+
+CACHE_MODES = ('off', 'deterministic', 'all')
+
+def canonical_key(payload, endpoint):
+    """payload 规范化 (键排序、紧凑分隔) 后与上游身份一起哈希"""
+    body = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(f"{endpoint}\n{body}".encode('utf-8')).hexdigest()
+
+class DiskTier:
+    """每条缓存一个文件 (<dir>/<key[:2]>/<key>.json)；读取时更新 mtime，超出 max_bytes 时删除最旧的文件"""
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizes = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _index(self):
+        # 首次使用时扫描目录，之后增量维护
+        if self._sizes is None:
+            sizes = {}
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith('.json'):
+                        try:
+                            sizes[name[:-5]] = os.path.getsize(os.path.join(root, name))
+                        except OSError:
+                            pass
+            self._sizes = sizes
+        return self._sizes
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl:
+            self._remove(key)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get('text')
+
+    def set(self, key, text):
+        path = self.path(key)
+        data = json.dumps({'text': text, 'created': time.time()}, ensure_ascii=False).encode('utf-8')
+        if len(data) > self.max_bytes: return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            sizes = self._index()
+            sizes[key] = len(data)
+            if sum(sizes.values()) > self.max_bytes: self._evict(sizes)
+
+    def _evict(self, sizes):
+        """删到 max_bytes 的 90%，留出余量避免每次写入都触发"""
+        def mtime(key):
+            try:
+                return os.path.getmtime(self.path(key))
+            except OSError:
+                return 0
+        total = sum(sizes.values())
+        for key in sorted(sizes, key=mtime):
+            if total <= self.max_bytes * 0.9: break
+            total -= sizes.pop(key)
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def _remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+        with self._lock:
+            if self._sizes is not None: self._sizes.pop(key, None)
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(self._index().values())
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self.mode = 'off'
+        self.cost_factor = 0.1
+        self.replay_chars = 256
+        self.memory = TTLCache(maxsize=256, ttl=86400.0)
+        self.disk = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.mode = conf.get('RESPONSE_CACHE_MODE', self.mode)
+        if self.mode not in CACHE_MODES: raise ValueError(f"RESPONSE_CACHE_MODE must be one of {CACHE_MODES}")
+        self.cost_factor = conf.get('RESPONSE_CACHE_COST_FACTOR', self.cost_factor)
+        ttl = conf.get('RESPONSE_CACHE_TTL', 86400.0)
+        self.memory = TTLCache(maxsize=conf.get('RESPONSE_CACHE_MEMORY_ITEMS', 256), ttl=ttl)
+        directory = conf.get('RESPONSE_CACHE_DIR')
+        disk_mb = conf.get('RESPONSE_CACHE_DISK_MB', 256)
+        self.disk = DiskTier(directory, disk_mb * 1024 * 1024, ttl) if directory and disk_mb else None
+        app.extensions['response_cache'] = self
+
+    def accepts(self, payload):
+        """deterministic 模式只缓存 temperature 为 0 的请求"""
+        if self.mode == 'off' or not isinstance(payload, dict): return False
+        if self.mode == 'all': return True
+        return payload.get('temperature') == 0
+
+    def key_for(self, payload, endpoint):
+        return canonical_key(payload, endpoint) if self.accepts(payload) else None
+
+    def get(self, key):
+        text = self.memory.get(key)
+        if text is None and self.disk is not None:
+            text = self.disk.get(key)
+            if text is not None: self.memory.set(key, text)
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    def set(self, key, text):
+        if not text: return
+        self.memory.set(key, text)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, text)
+            except OSError as e:
+                print(f"Response cache write error: {e}")
+
+response_cache = ResponseCache()
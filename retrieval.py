@@ -0,0 +1,162 @@
+import re
+import math
+import hashlib
+from uuid import uuid4
+from collections import Counter
+from sqlalchemy import insert
+from extensions import db
+from models import Document, DocumentChunk, DocumentTerm
+from utils import TTLCache
+
+# ================= 分词与分块 =================
+# 英文/数字按词切分，中文按相邻二字 (bigram) 切分，不依赖分词库。
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[一-龥]+')
+
+def tokenize(text):
+    terms = []
+    for run in TOKEN_PATTERN.findall(text.lower()):
+        if run[0] < '一':
+            if len(run) > 1 or run.isdigit(): terms.append(run[:64])
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def chunk_text(text, size=1200, overlap=150):
+    """按段落累积到约 size 字符一块，相邻块重叠 overlap 字符；超长段落硬切"""
+    chunks, current = [], ''
+    for para in text.split('\n'):
+        while len(para) > size:
+            head, para = para[:size], para[size:]
+            if current: chunks.append(current)
+            chunks.append(head)
+            current = ''
+        if current and len(current) + len(para) + 1 > size:
+            chunks.append(current)
+            current = current[-overlap:] if overlap else ''
+        current = f"{current}\n{para}" if current else para
+    if current.strip(): chunks.append(current)
+    return [c.strip() for c in chunks if c.strip()]
+
+# ================= 检索索引 =================
+class DocumentIndex:
+    """文档分块 + BM25 倒排索引，持久化在 SQLite；查询时只读取问题中出现的词项"""
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, app=None):
+        self.chunk_chars = 1200
+        self.chunk_overlap = 150
+        self.top_k = 6
+        self.context_chars = 8000
+        self.lengths = TTLCache(maxsize=256, ttl=3600.0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.chunk_chars = conf.get('DOC_CHUNK_CHARS', self.chunk_chars)
+        self.chunk_overlap = conf.get('DOC_CHUNK_OVERLAP', self.chunk_overlap)
+        self.top_k = conf.get('DOC_RETRIEVAL_TOP_K', self.top_k)
+        self.context_chars = conf.get('DOC_CONTEXT_CHARS', self.context_chars)
+        app.extensions['document_index'] = self
+
+    def add(self, user_id, filename, text):
+        """切块并写入倒排索引；同一用户重复上传相同内容时复用已有文档"""
+        sha = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        existing = Document.query.filter_by(user_id=user_id, sha256=sha).first()
+        if existing is not None: return existing
+
+        chunks = chunk_text(text, self.chunk_chars, self.chunk_overlap)
+        document = Document(id=uuid4().hex, user_id=user_id, filename=filename[:300], sha256=sha,
+                            chars=len(text), chunk_count=len(chunks))
+        db.session.add(document)
+        db.session.flush()
+        postings = {}
+        chunk_rows = []
+        for ordinal, content in enumerate(chunks):
+            terms = Counter(tokenize(content))
+            chunk_rows.append({'document_id': document.id, 'ordinal': ordinal,
+                               'length': sum(terms.values()), 'content': content})
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append(f"{ordinal}:{tf}")
+        if chunk_rows:
+            db.session.execute(insert(DocumentChunk), chunk_rows)
+        if postings:
+            db.session.execute(insert(DocumentTerm), [
+                {'document_id': document.id, 'term': term, 'postings': ' '.join(items)}
+                for term, items in postings.items()
+            ])
+        db.session.commit()
+        return document
+
+    def owned(self, user_id, document_ids):
+        if not document_ids: return []
+        return Document.query.filter(Document.user_id == user_id, Document.id.in_(list(document_ids)[:20])).all()
+
+    def chunk_lengths(self, document_id):
+        lengths = self.lengths.get(document_id)
+        if lengths is None:
+            rows = (db.session.query(DocumentChunk.ordinal, DocumentChunk.length)
+                    .filter_by(document_id=document_id).order_by(DocumentChunk.ordinal).all())
+            lengths = [length for _, length in rows]
+            self.lengths.set(document_id, lengths)
+        return lengths
+
+    def search(self, documents, query, k=None):
+        """在给定文档的所有分块中按 BM25 取前 k 块；返回 [(Document, ordinal)]，按文档与块顺序排列"""
+        k = k or self.top_k
+        lengths = {d.id: self.chunk_lengths(d.id) for d in documents}
+        total = sum(len(v) for v in lengths.values())
+        if total == 0: return []
+        by_id = {d.id: d for d in documents}
+        if total <= k:
+            return [(by_id[doc_id], i) for doc_id, items in lengths.items() for i in range(len(items))]
+
+        terms = set(tokenize(query))
+        scores = {}
+        if terms:
+            avgdl = sum(sum(v) for v in lengths.values()) / total or 1.0
+            rows = DocumentTerm.query.filter(DocumentTerm.document_id.in_(list(lengths)),
+                                             DocumentTerm.term.in_(list(terms))).all()
+            df = Counter()
+            parsed = []
+            for row in rows:
+                items = [tuple(map(int, item.split(':'))) for item in row.postings.split()]
+                df[row.term] += len(items)
+                parsed.append((row.document_id, row.term, items))
+            for doc_id, term, items in parsed:
+                idf = math.log(1 + (total - df[term] + 0.5) / (df[term] + 0.5))
+                doc_lengths = lengths[doc_id]
+                for ordinal, tf in items:
+                    norm = self.K1 * (1 - self.B + self.B * doc_lengths[ordinal] / avgdl)
+                    key = (doc_id, ordinal)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+        # 没有命中的词项时退回每个文档的开头部分
+        ranked = sorted(scores, key=scores.get, reverse=True)[:k] or \
+            [(doc_id, i) for doc_id, items in lengths.items() for i in range(min(len(items), k))][:k]
+        ranked.sort(key=lambda key: (list(lengths).index(key[0]), key[1]))
+        return [(by_id[doc_id], ordinal) for doc_id, ordinal in ranked]
+
+    def context_for(self, user_id, document_ids, query):
+        """返回要注入上下文的摘录文本 (受 context_chars 限制)，没有可用文档时返回空串"""
+        documents = self.owned(user_id, document_ids)
+        if not documents: return ''
+        hits = self.search(documents, query)
+        if not hits: return ''
+        wanted = {}
+        for document, ordinal in hits: wanted.setdefault(document.id, []).append(ordinal)
+        contents = {}
+        for doc_id, ordinals in wanted.items():
+            for row in DocumentChunk.query.filter(DocumentChunk.document_id == doc_id, DocumentChunk.ordinal.in_(ordinals)):
+                contents[(doc_id, row.ordinal)] = row.content
+        parts, used = [], 0
+        for document, ordinal in hits:
+            content = contents.get((document.id, ordinal), '')
+            if used + len(content) > self.context_chars and parts: break
+            used += len(content)
+            parts.append(f"--- Document: {document.filename} (part {ordinal + 1}/{document.chunk_count}) ---\n{content}")
+        return "\n\n".join(parts)
+
+document_index = DocumentIndex()
@@ -1,9 +1,8 @@
-import json
 from flask import Blueprint, request, jsonify, redirect, url_for
 from flask_login import login_user, login_required, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from extensions import db
-from models import User
+from models import User, UserSettings, DEFAULT_SETTINGS
 
 bp = Blueprint('auth', __name__)
 
@@ -21,15 +20,7 @@ def register():
     
     hashed_pw = generate_password_hash(data.get('password'), method='pbkdf2:sha256')
     new_user = User(username=data.get('username'), password=hashed_pw)
-    
-    default_settings = {
-        "api_endpoint": "https://api.openai.com/v1",
-        "api_key": "",
-        "model": "gpt-3.5-turbo",
-        "system_prompt": "You are a helpful assistant.",
-        "dark_mode": False
-    }
-    new_user.settings = json.dumps(default_settings)
+    new_user.settings_row = UserSettings.from_dict(DEFAULT_SETTINGS)
     
     db.session.add(new_user)
     db.session.commit()
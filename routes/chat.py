@@ -1,10 +1,25 @@
 import json
-import httpx
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
 from flask_login import login_required, current_user
+from extensions import upstream_clients
+from catalog import model_catalog
+from billing import reserve_points, get_balance
+from streaming import StreamTranscoder, sse_error, DONE_FRAME
+from streams import stream_registry, StreamCancelled, UpstreamIdle, HEARTBEAT_FRAME
+from response_cache import response_cache
+from official import official_pool, chat_url, RETRYABLE_STATUS
+from limits import limiter, RateLimited
+from metrics import StreamProbe
 from extensions import db
-from config import load_official_config
-from utils import decrypt_val, calculate_cost, build_dynamic_payload, extract_by_path, extract_text_from_file
+from conversations import conversation_store, message_text, strip_think
+from documents import extract_text_from_file, document_parser
+from retrieval import document_index
+from utils import decrypt_user_key, calculate_cost, identify_provider, build_dynamic_payload
 
 bp = Blueprint('chat', __name__)
 
@@ -16,195 +31,647 @@ def test_connection():
     paid_mode = current_app.config.get('PAID_MODE', False)
 
     if use_official and paid_mode:
-        off_conf = load_official_config()
-        api_endpoint = off_conf.get('api_endpoint', '').strip()
-        api_key = off_conf.get('api_key', '').strip()
-        if not api_endpoint or not api_key:
+        upstream = official_pool.primary()
+        if upstream is None:
             return jsonify({'success': False, 'message': '测试失败：服务器端官方配置缺失'})
+        api_endpoint, api_key = upstream.api_endpoint, upstream.api_key
     else:
         api_endpoint = data.get('api_endpoint', '').strip()
         api_key = data.get('api_key', '').strip()
         if not api_endpoint: return jsonify({'success': False, 'message': 'API Endpoint 不能为空'})
         if not api_key:
-            settings = json.loads(current_user.settings)
-            saved_key = settings.get('api_key', '')
-            if saved_key: api_key = decrypt_val(saved_key)
+            saved_key = current_user.prefs.api_key or ''
+            if saved_key: api_key = decrypt_user_key(current_user.id, saved_key)
         if not api_key: return jsonify({'success': False, 'message': 'API Key 不能为空'})
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
-    base_url = api_endpoint.rstrip('/')
-    test_url = f"{base_url}/models"
-    try:
-        with httpx.Client(timeout=10.0) as client:
-            resp = client.get(test_url, headers=headers)
-            if resp.status_code == 200:
-                try:
-                    data = resp.json()
-                    count = len(data.get('data', [])) if 'data' in data else 0
-                    msg = f"连接成功！{'官方通道' if use_official else ''}返回了 {count} 个可用模型。"
-                    return jsonify({'success': True, 'message': msg})
-                except:
-                    return jsonify({'success': True, 'message': "连接成功！(但返回格式非标准 JSON，请检查是否缺少 /v1)"})
-            elif resp.status_code == 401:
-                return jsonify({'success': False, 'message': "连接失败：API Key 无效或过期 (401)"})
-            elif resp.status_code == 404:
-                return jsonify({'success': False, 'message': "连接失败：接口路径不存在 (404)，请尝试在 Endpoint 后加上 /v1"})
-            else:
-                return jsonify({'success': False, 'message': f"连接失败：HTTP 状态码 {resp.status_code}"})
-    except Exception as e:
-        return jsonify({'success': False, 'message': f"网络请求错误: {str(e)}"})
+    entry = model_catalog.lookup(api_endpoint, api_key)
+    if entry['ok']:
+        msg = f"连接成功！{'官方通道' if use_official else ''}返回了 {len(entry['models'])} 个可用模型。"
+        return jsonify({'success': True, 'message': msg})
+    elif entry['status'] == 200:
+        return jsonify({'success': True, 'message': "连接成功！(但返回格式非标准 JSON，请检查是否缺少 /v1)"})
+    elif entry['status'] == 401:
+        return jsonify({'success': False, 'message': "连接失败：API Key 无效或过期 (401)"})
+    elif entry['status'] == 404:
+        return jsonify({'success': False, 'message': "连接失败：接口路径不存在 (404)，请尝试在 Endpoint 后加上 /v1"})
+    elif entry['status']:
+        return jsonify({'success': False, 'message': f"连接失败：HTTP 状态码 {entry['status']}"})
+    return jsonify({'success': False, 'message': f"网络请求错误: {entry['error']}"})
 
 @bp.route('/api/parse_doc', methods=['POST'])
 @login_required
 def parse_doc():
     if 'file' not in request.files: return jsonify({'success': False, 'message': 'No file'})
     file = request.files['file']
-    text = extract_text_from_file(file)
-    if text: return jsonify({'success': True, 'text': text})
-    return jsonify({'success': False, 'message': '无法解析文件内容或文件不支持'})
+    text = extract_text_from_file(file, current_app.config.get('DOC_INDEX_LIMIT'))
+    if not text: return jsonify({'success': False, 'message': '无法解析文件内容或文件不支持'})
+    if text.startswith('[System Error'): return jsonify({'success': True, 'text': text})
+    # 全文建立检索索引，对话时只注入与问题相关的分块；text 仍按 DOC_TEXT_LIMIT 截断返回，兼容旧客户端
+    document = document_index.add(current_user.id, file.filename, text)
+    return jsonify({'success': True, 'text': text[:document_parser.limit], 'document_id': document.id,
+                    'chunks': document.chunk_count, 'chars': document.chars})
 
 @bp.route('/api/fetch_models', methods=['POST'])
 @login_required
 def fetch_models():
     data = request.json or {}
-    saved_settings = json.loads(current_user.settings)
-    use_official = data.get('use_official', saved_settings.get('use_official_api', False))
+    prefs = current_user.prefs
+    use_official = data.get('use_official', prefs.use_official_api or False)
     
     api_key = ""
     api_endpoint = ""
 
     if current_app.config['PAID_MODE'] and use_official:
-        off_conf = load_official_config()
-        api_key = off_conf.get('api_key')
-        api_endpoint = off_conf.get('api_endpoint')
+        upstream = official_pool.primary()
+        if upstream is not None:
+            api_endpoint, api_key = upstream.api_endpoint, upstream.api_key
     else:
         api_endpoint = data.get('api_endpoint')
         api_key = data.get('api_key')
-        if not api_endpoint: api_endpoint = saved_settings.get('api_endpoint')
+        if not api_endpoint: api_endpoint = prefs.api_endpoint
         if not api_key:
-            encrypted_key = saved_settings.get('api_key')
-            if encrypted_key: api_key = decrypt_val(encrypted_key)
+            encrypted_key = prefs.api_key
+            if encrypted_key: api_key = decrypt_user_key(current_user.id, encrypted_key)
 
     if not api_key or not api_endpoint:
         return jsonify({'success': False, 'message': '请先配置 API Key 和 Endpoint'})
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
-    base_url = api_endpoint.rstrip('/')
-    urls_to_try = []
-    if not base_url.endswith('/v1'): urls_to_try.append(f"{base_url}/v1/models")
-    urls_to_try.append(f"{base_url}/models")
-
-    error_msg = ""
-    with httpx.Client(timeout=15.0) as client:
-        for url in urls_to_try:
-            try:
-                resp = client.get(url, headers=headers)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    if 'data' in data:
-                        model_ids = sorted([item['id'] for item in data['data']])
-                        return jsonify({'success': True, 'models': model_ids})
-            except Exception as e:
-                error_msg = str(e)
-                continue
-    return jsonify({'success': False, 'message': f'获取失败 (请检查Key或Endpoint格式): {error_msg or "无法连接"}'})
+    entry = model_catalog.lookup(api_endpoint, api_key)
+    if entry['ok']:
+        return jsonify({'success': True, 'models': entry['models']})
+    return jsonify({'success': False, 'message': f'获取失败 (请检查Key或Endpoint格式): {entry["error"] or "无法连接"}'})
 
-@bp.route('/api/chat', methods=['POST'])
-@login_required
-def chat(): 
-    data = request.json
+def rate_limited(e):
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
+
+def prepare_chat(data):
+    """解析设置、限流、计费并构建上游请求；返回 (job, None) 或 (None, 错误响应)
+
+    拿到的限流租约与预扣记录分别记在 job['leases'] / job['reservation'] 中，由 settle_job 在流结束时处理；
+    中途出错时这里负责释放租约并全额退还预扣的点数。
+    """
+    leases, reservations = [], []
+    try:
+        return acquire_and_prepare(data, leases, reservations)
+    except RateLimited as e:
+        abandon(leases, reservations)
+        return None, rate_limited(e)
+    except Exception:
+        # 先回滚请求会话中未提交的写入 (新建会话等)，否则退款的 UPDATE 会等待它的写锁
+        db.session.rollback()
+        abandon(leases, reservations)
+        raise
+
+def release_leases(leases):
+    for lease in leases: lease.release()
+
+def abandon(leases, reservations):
+    """请求未到达上游就失败：释放租约，退还预扣点数"""
+    release_leases(leases)
+    for reservation in reservations: reservation.settle(False)
+
+def discard_job(job):
+    """已准备好的 job 没有开始输出就被丢弃 (客户端在首次读取前断开)：释放租约、全额退款、注销流"""
+    abandon(job['leases'], [job['reservation']] if job['reservation'] else [])
+    stream_registry.close(job['stream'])
+
+def acquire_and_prepare(data, leases, reservations):
     messages = data.get('messages', [])
-    settings = json.loads(current_user.settings)
+    prefs = current_user.prefs
+
+    # 不带 messages 时为服务端会话模式：客户端只发送 conversation_id 与本轮新消息。
+    # 这里只做校验；新会话在预扣点数之后才写入，请求会话持有 SQLite 写事务时另一个连接上的预扣会被锁住
+    server_side = 'messages' not in data
+    conversation = None
+    if server_side:
+        conversation, error = resolve_conversation(data)
+        if error: return None, error
     
-    use_official = settings.get('use_official_api', False)
+    use_official = prefs.use_official_api or False
     paid_mode_on = current_app.config.get('PAID_MODE', False)
-    
-    api_key = ""
-    api_endpoint = ""
     using_official_channel = paid_mode_on and use_official
 
+    model_name = prefs.model or 'gpt-3.5-turbo'
+
+    tier = ('official' if using_official_channel else 'own_key') if paid_mode_on else 'free'
+    leases.append(limiter.acquire(f"user:{current_user.id}", limiter.rule_for(tier)))
+
+    targets, cache_scope, error = channel_targets(model_name, using_official_channel, leases)
+    if error:
+        release_leases(leases)
+        return None, error
+
+    reservation = None
     if using_official_channel:
-        off_conf = load_official_config()
-        api_key = off_conf.get('api_key')
-        api_endpoint = off_conf.get('api_endpoint')
-        if not api_key: return jsonify({'error': 'Server Official Config Missing'}), 500
-    else:
-        raw_key = settings.get('api_key')
-        api_key = decrypt_val(raw_key)
-        if not api_key and raw_key: api_key = raw_key
-        api_endpoint = settings.get('api_endpoint')
+        reservation, error = reserve_for(model_name)
+        if error:
+            release_leases(leases)
+            return None, error
+        reservations.append(reservation)
+
+    turn = None
+    if server_side:
+        if conversation is None: conversation = create_conversation(data)
+        messages, turn = record_turn(conversation, data, model_name, prefs)
 
-    if not api_key: return jsonify({'error': 'No API Key Configured'}), 400
+    documents = ''
+    if data.get('documents') and messages:
+        documents = document_index.context_for(current_user.id, data['documents'], message_text(messages[-1]['content']))
 
-    model_name = settings.get('model', 'gpt-3.5-turbo')
+    payload = build_dynamic_payload(prefs.custom_request_template or '', model_name, messages, prefs.system_prompt or '', documents)
+    return new_job(targets, payload, cache_scope, reservation, leases, model_name, using_official_channel, turn), None
 
+def channel_targets(model_name, using_official_channel, leases):
+    """上游目标列表与回复缓存作用域；返回 (targets, cache_scope, None) 或 (None, None, 错误响应)"""
     if using_official_channel:
-        cost = calculate_cost(model_name)
-        if current_user.points < cost:
-            return jsonify({'error': f'点数不足！官方通道需要 {cost} 点，您仅有 {current_user.points} 点。'}), 402
-        current_user.points -= cost
-        db.session.commit()
+        plan = official_pool.plan(model_name)
+        if not plan: return None, None, (jsonify({'error': 'Server Official Config Missing'}), 500)
+        # 按计划顺序取第一个仍有名额的上游作为首选，其余保持原顺序作为故障转移备选
+        lease = limiter.acquire_any('official', [(u.limit_key, u.rule) for u in plan])
+        leases.append(lease)
+        plan.sort(key=lambda u: u.limit_key != lease.key)
+        targets = [make_target(u.api_endpoint, u.api_key, u) for u in plan]
+        targets[0]['lease'] = lease
+        # 官方池内各上游对同一 payload 视为等价，共用缓存
+        return targets, 'official', None
+    prefs = current_user.prefs
+    raw_key = prefs.api_key
+    api_key = decrypt_user_key(current_user.id, raw_key)
+    if not api_key and raw_key: api_key = raw_key
+    if not api_key: return None, None, (jsonify({'error': 'No API Key Configured'}), 400)
+    targets = [make_target(prefs.api_endpoint, api_key)]
+    return targets, f"{targets[0]['url']}#{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]}", None
+
+def reserve_for(model_name):
+    """官方通道按 calculate_cost 预扣点数；返回 (reservation, None) 或 (None, 错误响应)"""
+    cost = calculate_cost(model_name)
+    reservation = reserve_points(current_app._get_current_object(), current_user.id, cost, model_name)
+    if reservation is None:
+        return None, (jsonify({'error': f'点数不足！官方通道需要 {cost} 点，您仅有 {get_balance(current_user.id)} 点。'}), 402)
+    return reservation, None
+
+def new_job(targets, payload, cache_scope, reservation, leases, model_name, using_official_channel, turn=None):
+    cache_key = response_cache.key_for(payload, cache_scope)
+    cached = response_cache.get(cache_key) if cache_key else None
+    return {'targets': targets, 'payload': payload, 'response_path': current_user.prefs.custom_response_path or '',
+            'cache_key': cache_key, 'cached': cached,
+            'reservation': reservation, 'leases': leases, 'conversation': turn,
+            'provider': identify_provider(model_name), 'channel': 'official' if using_official_channel else 'custom',
+            'stream': stream_registry.open(current_user.id)}
+
+def resolve_conversation(data):
+    """校验并取已有会话；新会话 (不带 conversation_id) 返回 (None, None)，之后由 create_conversation 创建"""
+    conversation_id = data.get('conversation_id')
+    has_message = bool((data.get('message') or {}).get('content')) and not data.get('regenerate')
+    if conversation_id:
+        conversation = conversation_store.get(current_user.id, conversation_id)
+        if conversation is None: return None, (jsonify({'error': 'Conversation Not Found'}), 404)
+        if not has_message and conversation_store.last_user_message(conversation.id) is None:
+            return None, (jsonify({'error': 'Empty Message'}), 400)
+        return conversation, None
+    if not has_message: return None, (jsonify({'error': 'Empty Message'}), 400)
+    return None, None
+
+def create_conversation(data):
+    """新建会话并导入 seed (客户端本地已有的历史，仅文本)；随 record_turn 一起提交"""
+    content = message_text(data['message']['content'])
+    conversation = conversation_store.create(current_user.id, content[:30])
+    db.session.flush()
+    last_user = None
+    for item in data.get('seed') or []:
+        role = item.get('role')
+        if role not in ('user', 'assistant'): continue
+        message = conversation_store.append(conversation.id, role, message_text(item.get('content')),
+                                            item.get('model', ''), last_user if role == 'assistant' else None)
+        if role == 'user':
+            db.session.flush()
+            last_user = message.id
+    return conversation
+
+def record_turn(conversation, data, model_name, prefs):
+    """写入本轮用户消息 (重新生成时沿用最后一条) 并组装上下文；返回 (messages, turn)"""
+    content = (data.get('message') or {}).get('content')
+    if data.get('regenerate') or not content:
+        user_message = conversation_store.last_user_message(conversation.id)
+    else:
+        user_message = conversation_store.append(conversation.id, 'user', message_text(content), model_name)
+    db.session.commit()
+
+    # 沿用前端的 context_length (最近消息条数，0 表示只发本轮)
+    context_length = prefs.to_dict().get('context_length')
+    max_messages = None if context_length is None else max(int(context_length), 1)
+    messages = conversation_store.build_context(conversation.id, user_message, model_name,
+                                                prefs.system_prompt or '', max_messages)
+    # 本轮的图片等多模态内容只随本次请求发送，不入库
+    if isinstance(content, list) and not data.get('regenerate'):
+        messages[-1] = {'role': 'user', 'content': content}
+    turn = {'id': conversation.id, 'reply_to': user_message.id, 'model': model_name,
+            'app': current_app._get_current_object()}
+    return messages, turn
+
+def make_target(api_endpoint, api_key, upstream=None):
+    return {
+        'url': chat_url(api_endpoint),
+        'headers': {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        'upstream': upstream,
+        'lease': None  # 该上游的并发名额，故障转移到它时才占用 (claim_target)
+    }
+
+def claim_target(job, attempt):
+    """故障转移到第 attempt 个官方上游前，释放之前上游的名额并 (不排队) 占用这个上游的名额；
+    没有空闲名额时返回 False。首个上游的名额已在 channel_targets 中占用"""
+    target = job['targets'][attempt]
+    upstream = target['upstream']
+    if not attempt or upstream is None: return True
+    release_leases([t['lease'] for t in job['targets'][:attempt] if t['lease']])
+    target['lease'] = limiter.try_acquire(upstream.limit_key, upstream.rule)
+    if target['lease'] is None: return False
+    job['leases'].append(target['lease'])
+    return True
 
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    request_template = settings.get('custom_request_template', '')
-    response_path = settings.get('custom_response_path', '')
-    if not response_path: response_path = "choices[0].delta.content"
+def renew_leases(leases):
+    """流进行中续期限流租约，避免长回复的名额在结束前过期"""
+    for lease in leases: lease.renew()
 
-    payload = build_dynamic_payload(request_template, model_name, messages, settings.get('system_prompt', ''))
-    clean_endpoint = api_endpoint.strip().rstrip('/')
-    url = clean_endpoint if clean_endpoint.endswith('/chat/completions') else f"{clean_endpoint}/chat/completions"
+def should_failover(job, attempt, status=None):
+    """仅在尚未向客户端输出任何内容、且还有备用上游时切换"""
+    if attempt >= len(job['targets']) - 1: return False
+    return status is None or status in RETRYABLE_STATUS
+
+def new_transcoder(job, conf):
+    record = job.get('conversation') is not None or (job.get('cache_key') is not None and job.get('cached') is None)
+    return StreamTranscoder(job['response_path'], conf.get('STREAM_FLUSH_CHARS', 0), conf.get('STREAM_FLUSH_INTERVAL', 0.0),
+                            record=record)
+
+def new_probe(job, received):
+    """received 为收到请求的时刻 (perf_counter)，首字延迟包含限流排队与预处理时间"""
+    return StreamProbe(job['provider'], job['channel'], received)
+
+def stream_headers(job):
+    headers = {'X-Stream-Id': job['stream'].id}
+    turn = job.get('conversation')
+    if turn: headers['X-Conversation-Id'] = turn['id']
+    return headers
+
+def cancel_outcome(job):
+    """StreamProbe 的 outcome 标签：client 取消记为 cancelled，连接断开记为 disconnected"""
+    return 'cancelled' if job['stream'].reason == 'client' else 'disconnected'
+
+def requested_tokens(payload):
+    """请求的回复长度上限 (自定义模板可能不是 dict，或不带该字段)"""
+    if not isinstance(payload, dict): return None
+    return payload.get('max_tokens') or payload.get('max_completion_tokens')
+
+def settle_job(job, transcoder, probe):
+    """流结束时结算预扣点数 (有内容送达则确认扣费，否则全额退还；中途取消或上游空闲超时中断的按已输出比例收取；
+    缓存命中按 RESPONSE_CACHE_COST_FACTOR 收取)、释放限流名额、注销活动流、写入回复缓存并保存会话回复"""
+    release_leases(job.get('leases', []))
+    stream = job['stream']
+    stream_registry.close(stream)
+    if job.get('cached') is not None:
+        if job.get('reservation'): job['reservation'].settle(True, response_cache.cost_factor, 'cache')
+    else:
+        if job.get('reservation'):
+            fraction, reason = 1.0, 'cancel'
+            if stream.cancelled or probe.outcome == 'timeout':
+                fraction = stream_registry.billed_fraction(probe.chunks, requested_tokens(job['payload']), transcoder.finished)
+                if not stream.cancelled: reason = 'timeout'
+            job['reservation'].settle(transcoder.has_content, fraction, reason)
+        # 只缓存完整结束的回复
+        if job.get('cache_key') and probe.outcome == 'ok': response_cache.set(job['cache_key'], transcoder.recorded_text)
+    turn = job.get('conversation')
+    if turn and transcoder.has_content:
+        reply = strip_think(transcoder.recorded_text)
+        if not reply: return
+        try:
+            conversation_store.append_reply(turn['app'], turn['id'], reply, turn['model'], turn['reply_to'])
+        except Exception as e:
+            print(f"Failed to save reply for conversation {turn['id']}: {e}")
+
+def replay_cached(job, transcoder, probe):
+    """缓存命中：不访问上游，直接回放为完整的 SSE 帧列表并结算"""
+    try:
+        frames = probe.relay(transcoder.replay(job['cached'], response_cache.replay_chars))
+        probe.outcome = 'cached'
+        return frames
+    finally:
+        probe.close()
+        settle_job(job, transcoder, probe)
+
+# ================= 上游转发 =================
+# 同步 (relay_upstream) 与异步 (asgi.ChatASGI.stream_chat) 两条转发路径共用下面的决策逻辑：
+# relay_attempts 决定请求哪个上游、何时故障转移，RelayAttempt 负责健康统计、租约续期与帧转码，
+# relay_aborted 给出中止时的收尾帧；两边只负责发起请求与读写。
+
+BUSY_ERROR = '官方通道繁忙，请稍后再试'
+IDLE_ERROR = '上游长时间无响应，回复已中断'
+
+class RelayAttempt:
+    """对 job['targets'][attempt] 的一次请求，用作 with 块包住请求与读取：
+    未向客户端输出内容前失败且还有备用上游时吞掉异常并标记 failover，由 relay_attempts 给出下一个上游"""
+
+    def __init__(self, job, attempt, transcoder, probe):
+        self.job, self.attempt = job, attempt
+        self.transcoder, self.probe = transcoder, probe
+        self.target = job['targets'][attempt]
+        self.upstream = self.target['upstream']
+        self.ok, self.latency, self.streamed = False, None, False
+        self.failover = False
+
+    def __enter__(self):
+        if self.upstream: official_pool.begin(self.upstream)
+        self.started = time.monotonic()
+        return self
+
+    def connected(self, status):
+        self.latency = time.monotonic() - self.started
+        self.probe.connected(self.latency)
+        self.streamed = status == 200
+
+    def rejected(self, status, err_text):
+        """上游返回非 200：需要故障转移时返回空列表，否则返回给客户端的错误帧"""
+        self.probe.error(status)
+        self.ok = status not in RETRYABLE_STATUS
+        if should_failover(self.job, self.attempt, status):
+            self.failover = True
+            return []
+        return [sse_error(f'API Error {status}: {err_text}')]
+
+    def relay(self, line):
+        """pump / apump 产出的一项转为帧并续期租约；None (上游暂无输出) 时发出缓冲中已到期的文本，
+        没有时发送心跳，客户端断开会在这次写入时暴露出来"""
+        renew_leases(self.job['leases'])
+        if line is None: return self.probe.relay(self.transcoder.flush()) or [HEARTBEAT_FRAME]
+        if line: self.probe.chunks += 1
+        return self.probe.relay(self.transcoder.feed(line))
+
+    def finish(self):
+        """上游正常结束：返回缓冲中剩余的帧"""
+        frames = self.probe.relay(self.transcoder.flush())
+        self.ok = True
+        self.probe.outcome = 'ok'
+        return frames
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None: return False
+            # 取消、客户端断开 (GeneratorExit / CancelledError) 不算上游故障，也不做故障转移
+            if issubclass(exc_type, StreamCancelled) or not issubclass(exc_type, Exception):
+                self.ok = True
+                return False
+            self.probe.error(exc)
+            if not self.streamed and should_failover(self.job, self.attempt):
+                self.failover = True
+                return True
+            return False
+        finally:
+            if self.upstream: official_pool.finish(self.upstream, self.ok, self.latency)
+
+def relay_attempts(job, transcoder, probe):
+    """按 job['targets'] 顺序给出要请求的 RelayAttempt，上一个需要故障转移时才给出下一个；
+    剩余上游都没有空闲名额时给出 None，调用方发送 BUSY_ERROR"""
+    for attempt in range(len(job['targets'])):
+        if not claim_target(job, attempt):
+            if should_failover(job, attempt): continue
+            yield None
+            return
+        relay = RelayAttempt(job, attempt, transcoder, probe)
+        yield relay
+        if not relay.failover: return
+
+def relay_aborted(job, transcoder, probe, error):
+    """转发因取消、上游空闲超时或异常中止时发给客户端的收尾帧"""
+    if isinstance(error, UpstreamIdle):
+        # 回复被上游截断：已收到的部分照常发出 (结算时按比例计费，见 settle_job)，再告知客户端
+        probe.outcome = 'timeout'
+        return probe.relay(transcoder.flush()) + [sse_error(IDLE_ERROR)]
+    if isinstance(error, StreamCancelled):
+        probe.outcome = cancel_outcome(job)
+        # 连接已断开时没有接收方
+        if job['stream'].reason == 'disconnect': return []
+        return probe.relay(transcoder.flush())
+    return [sse_error(f'Server Error: {str(error)}')]
+
+def relay_upstream(job, transcoder, probe):
+    """同步转发：逐个返回转码后的帧，上游暂无输出时返回 HEARTBEAT_FRAME。取消时抛出 StreamCancelled"""
+    for relay in relay_attempts(job, transcoder, probe):
+        if relay is None:
+            yield sse_error(BUSY_ERROR)
+            return
+        with relay:
+            target = relay.target
+            client = upstream_clients.get(target['url'])
+            with client.stream("POST", target['url'], json=job['payload'], headers=target['headers'],
+                               timeout=upstream_clients.timeout(stream_registry.read_timeout)) as response:
+                relay.connected(response.status_code)
+                if response.status_code != 200:
+                    yield from relay.rejected(response.status_code, response.read().decode('utf-8'))
+                    continue
+                for line in stream_registry.pump(response, job['stream'], transcoder.flush_due):
+                    yield from relay.relay(line)
+                yield from relay.finish()
+
+@bp.route('/api/chat', methods=['POST'])
+@login_required
+def chat(): 
+    received = time.perf_counter()
+    job, error = prepare_chat(request.json)
+    if error: return error
+    transcoder = new_transcoder(job, current_app.config)
+    if job['cached'] is not None:
+        frames = replay_cached(job, transcoder, new_probe(job, received))
+        return Response(frames, mimetype='text/event-stream', headers=stream_headers(job))
+
+    started = []
 
     def generate():
+        started.append(True)
+        probe = new_probe(job, received)
         try:
-            thinking_state = {'has_started': False, 'has_ended': False}
-            with httpx.Client(timeout=120.0) as client:
-                with client.stream("POST", url, json=payload, headers=headers) as response:
-                    if response.status_code != 200:
-                        err_text = response.read().decode('utf-8')
-                        yield f"data: {json.dumps({'error': f'API Error {response.status_code}: {err_text}'})}\n\n"
-                        return
-
-                    for line in response.iter_lines():
-                        if line:
-                            decoded_line = line
-                            if decoded_line.startswith("data: "): json_str = decoded_line[6:]
-                            elif decoded_line.startswith("{"): json_str = decoded_line
-                            else: continue
-
-                            if json_str.strip() == "[DONE]":
-                                if thinking_state['has_started'] and not thinking_state['has_ended']:
-                                     yield f"data: {json.dumps({'choices': [{'delta': {'content': '</think>'}}]})}\n\n"
-                                yield "data: [DONE]\n\n"
-                                continue
-                                
-                            try:
-                                json_data = json.loads(json_str)
-                                choices = json_data.get('choices', [])
-                                delta = choices[0].get('delta', {}) if choices else {}
-                                reasoning = delta.get('reasoning_content', '')
-                                if reasoning:
-                                    if not thinking_state['has_started']:
-                                        yield f"data: {json.dumps({'choices': [{'delta': {'content': '<think>'}}]})}\n\n"
-                                        thinking_state['has_started'] = True
-                                    yield f"data: {json.dumps({'choices': [{'delta': {'content': reasoning}}]})}\n\n"
-                                    continue
-
-                                content = extract_by_path(json_data, response_path)
-                                if content:
-                                    if thinking_state['has_started'] and not thinking_state['has_ended']:
-                                        yield f"data: {json.dumps({'choices': [{'delta': {'content': '</think>'}}]})}\n\n"
-                                        thinking_state['has_ended'] = True
-                                    yield f"data: {json.dumps({'choices': [{'delta': {'content': content}}]})}\n\n"
-                            except Exception as e: pass
+            yield from relay_upstream(job, transcoder, probe)
+        except GeneratorExit:
+            # 客户端已断开：退出 with 块时关闭上游连接，读取线程随之结束
+            job['stream'].cancel('disconnect')
+            probe.outcome = cancel_outcome(job)
+            raise
         except Exception as e:
-             yield f"data: {json.dumps({'error': f'Server Error: {str(e)}'})}\n\n"
+            yield from relay_aborted(job, transcoder, probe, e)
+        finally:
+            probe.close()
+            settle_job(job, transcoder, probe)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=stream_headers(job))
+    # 客户端在首次读取前断开时生成器不会开始执行，finally 中的结算也不会运行
+    response.call_on_close(lambda: started or discard_job(job))
+    return response
+
+# ================= 多模型并行 =================
+# /api/chat/multi: 同一组消息同时发给多个模型 (每个模型一个 lane，结构同 /api/chat 的 job)，
+# 各 lane 在有界线程池 (MULTI_LANE_THREADS) 中读取上游，帧经队列汇合到同一条 SSE 连接：
+#   data: {"models": [{"model": ..., "stream_id": ...}]}      开始，stream_id 可单独取消某个模型
+#   data: {"model": ..., "chunk": </api/chat 的帧>}          某个模型的增量或错误
+#   data: {"model": ..., "done": true, "outcome": ..., "ttft": 秒, "reserved": 点数}
+#   data: [DONE]
+# X-Stream-Id 为整组的流 ID，取消时所有模型一起停止。整组只占用一个用户级限流名额。
+
+def prepare_multi(data):
+    """返回 (lanes, 整组的限流租约, None) 或 (None, None, 错误响应)；中途失败时退还已预扣的点数"""
+    leases, lanes = [], []
+    try:
+        error = acquire_lanes(data, leases, lanes)
+    except RateLimited as e:
+        error = rate_limited(e)
+    except Exception:
+        abort_lanes(lanes, leases)
+        raise
+    if error:
+        abort_lanes(lanes, leases)
+        return None, None, error
+    return lanes, leases, None
 
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
\ No newline at end of file
+def abort_lanes(lanes, leases):
+    release_leases(leases)
+    for lane in lanes: discard_job(lane)
+
+_lane_lock = threading.Lock()
+
+def lane_executor(app):
+    """各 lane 共用的有界线程池，首次使用时按 MULTI_LANE_THREADS 创建；满载时新的 lane 排队等待"""
+    executor = app.extensions.get('multi_lane_executor')
+    if executor is None:
+        with _lane_lock:
+            executor = app.extensions.get('multi_lane_executor')
+            if executor is None:
+                executor = app.extensions['multi_lane_executor'] = ThreadPoolExecutor(
+                    max_workers=app.config.get('MULTI_LANE_THREADS', 32), thread_name_prefix='multi-lane')
+    return executor
+
+def acquire_lanes(data, leases, lanes):
+    messages = data.get('messages') or []
+    models = list(dict.fromkeys(m.strip() for m in data.get('models') or [] if isinstance(m, str) and m.strip()))
+    max_models = current_app.config.get('MULTI_MAX_MODELS', 4)
+    if not messages: return jsonify({'error': 'Empty Message'}), 400
+    if not models or len(models) > max_models:
+        return jsonify({'error': f'models 需包含 1 到 {max_models} 个模型'}), 400
+
+    prefs = current_user.prefs
+    paid_mode_on = current_app.config.get('PAID_MODE', False)
+    using_official_channel = paid_mode_on and (prefs.use_official_api or False)
+    tier = ('official' if using_official_channel else 'own_key') if paid_mode_on else 'free'
+    leases.append(limiter.acquire(f"user:{current_user.id}", limiter.rule_for(tier)))
+
+    # 设置、Key 解密与文档检索只做一次；自有 Key 时所有模型共用同一上游
+    if not using_official_channel:
+        targets, cache_scope, error = channel_targets(models[0], False, leases)
+        if error: return error
+    documents = ''
+    if data.get('documents'):
+        documents = document_index.context_for(current_user.id, data['documents'], message_text(messages[-1]['content']))
+    template, system_prompt = prefs.custom_request_template or '', prefs.system_prompt or ''
+
+    for model_name in models:
+        lane_leases, reservation = [], None
+        if using_official_channel:
+            targets, cache_scope, error = channel_targets(model_name, True, lane_leases)
+            if not error: reservation, error = reserve_for(model_name)
+            if error:
+                release_leases(lane_leases)
+                return error
+        payload = build_dynamic_payload(template, model_name, messages, system_prompt, documents)
+        lane = new_job(targets, payload, cache_scope, reservation, lane_leases, model_name, using_official_channel)
+        lane['model'] = model_name
+        lanes.append(lane)
+    return None
+
+def tagged(model, frame):
+    """/api/chat 的帧 (data: <JSON>) 原样嵌入，不重新解析"""
+    return f'data: {{"model": {json.dumps(model, ensure_ascii=False)}, "chunk": {frame[6:].rstrip()}}}\n\n'
+
+def lane_summary(lane, probe):
+    ttft = round(probe.first_frame - probe.started, 3) if probe.first_frame else None
+    reserved = lane['reservation'].cost if lane['reservation'] else 0
+    return f"data: {json.dumps({'model': lane['model'], 'done': True, 'outcome': probe.outcome, 'ttft': ttft, 'reserved': reserved}, ensure_ascii=False)}\n\n"
+
+def run_lane(lane, transcoder, probe, out):
+    """在线程池中转发一个模型的回复：帧以 (model, frame) 放入 out，结束 (已结算) 时放入 (model, None)"""
+    model = lane['model']
+    if lane['cached'] is not None:
+        for frame in replay_cached(lane, transcoder, probe): out.put((model, frame))
+        out.put((model, None))
+        return
+    try:
+        # 排队期间已被取消 (整组取消或客户端断开) 的 lane 不再请求上游
+        if lane['stream'].cancelled: raise StreamCancelled(lane['stream'].reason)
+        for frame in relay_upstream(lane, transcoder, probe):
+            # 各 lane 的心跳不转发，由汇合方在整条连接空闲时统一发送
+            if frame != HEARTBEAT_FRAME: out.put((model, frame))
+    except Exception as e:
+        for frame in relay_aborted(lane, transcoder, probe, e): out.put((model, frame))
+    finally:
+        probe.close()
+        settle_job(lane, transcoder, probe)
+        out.put((model, None))
+
+@bp.route('/api/chat/multi', methods=['POST'])
+@login_required
+def chat_multi():
+    received = time.perf_counter()
+    lanes, leases, error = prepare_multi(request.json or {})
+    if error: return error
+    conf = current_app.config
+    executor = lane_executor(current_app._get_current_object())
+    group = stream_registry.open(current_user.id)
+    # 取消整组 (客户端取消或断开) 时逐个取消各模型的流
+    group.on_cancel(lambda: [lane['stream'].cancel(group.reason) for lane in lanes])
+    started = []
+
+    def generate():
+        started.append(True)
+        runs = {lane['model']: (lane, new_transcoder(lane, conf), new_probe(lane, received)) for lane in lanes}
+        out = queue.Queue()
+        for lane, transcoder, probe in runs.values():
+            executor.submit(run_lane, lane, transcoder, probe, out)
+        pending = len(runs)
+        try:
+            yield f"data: {json.dumps({'models': [{'model': m, 'stream_id': r[0]['stream'].id} for m, r in runs.items()]}, ensure_ascii=False)}\n\n"
+            while pending:
+                renew_leases(leases)
+                try:
+                    model, frame = out.get(timeout=stream_registry.heartbeat_interval)
+                except queue.Empty:
+                    yield HEARTBEAT_FRAME
+                    continue
+                if frame is None:
+                    pending -= 1
+                    lane, _, probe = runs[model]
+                    yield lane_summary(lane, probe)
+                elif frame != DONE_FRAME:
+                    yield tagged(model, frame)
+            yield DONE_FRAME
+        except GeneratorExit:
+            # 客户端已断开：取消全部 lane，各自在线程中关闭上游并结算
+            group.cancel('disconnect')
+            raise
+        finally:
+            release_leases(leases)
+            stream_registry.close(group)
+
+    def discard():
+        abort_lanes(lanes, leases)
+        stream_registry.close(group)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'X-Stream-Id': group.id})
+    # 客户端在首次读取前断开时生成器不会开始执行，由这里释放各 lane 的名额并退还预扣点数
+    response.call_on_close(lambda: started or discard())
+    return response
+
+@bp.route('/api/chat/cancel', methods=['POST'])
+@login_required
+def cancel_chat():
+    """按 X-Stream-Id 取消正在进行的对话：立即断开上游，已输出部分按比例计费"""
+    stream_id = (request.json or {}).get('stream_id', '')
+    if not stream_registry.cancel(current_user.id, stream_id):
+        return jsonify({'success': False, 'message': '对话不存在或已结束'}), 404
+    return jsonify({'success': True})
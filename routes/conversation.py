@@ -0,0 +1,38 @@
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from extensions import db
+from models import Conversation, ConversationMessage
+from conversations import conversation_store
+
+bp = Blueprint('conversation', __name__)
+
+@bp.route('/api/conversations', methods=['GET'])
+@login_required
+def list_conversations():
+    rows = (Conversation.query.filter_by(user_id=current_user.id)
+            .order_by(Conversation.updated_at.desc()).limit(200).all())
+    return jsonify({'success': True, 'conversations': [c.to_dict() for c in rows]})
+
+@bp.route('/api/conversations/<conversation_id>/messages', methods=['GET'])
+@login_required
+def conversation_messages(conversation_id):
+    conversation = conversation_store.get(current_user.id, conversation_id)
+    if conversation is None: return jsonify({'success': False, 'message': '会话不存在'}), 404
+    # 按 id 倒序分页：?before=<id>&limit=<n>
+    query = ConversationMessage.query.filter_by(conversation_id=conversation.id)
+    before = request.args.get('before', type=int)
+    if before: query = query.filter(ConversationMessage.id < before)
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    rows = query.order_by(ConversationMessage.id.desc()).limit(limit).all()
+    rows.reverse()
+    return jsonify({'success': True, 'conversation': conversation.to_dict(), 'messages': [m.to_dict() for m in rows]})
+
+@bp.route('/api/conversations/<conversation_id>', methods=['DELETE'])
+@login_required
+def delete_conversation(conversation_id):
+    conversation = conversation_store.get(current_user.id, conversation_id)
+    if conversation is None: return jsonify({'success': False, 'message': '会话不存在'}), 404
+    ConversationMessage.query.filter_by(conversation_id=conversation.id).delete()
+    db.session.delete(conversation)
+    db.session.commit()
+    return jsonify({'success': True})
@@ -1,7 +1,7 @@
-import json
-from flask import Blueprint, render_template, redirect, url_for
+from flask import Blueprint, redirect, url_for
 from flask_login import current_user
-from utils import load_match_rules
+from utils import provider_matcher
+from assets import asset_pipeline
 
 bp = Blueprint('main', __name__)
 
@@ -9,9 +9,10 @@ bp = Blueprint('main', __name__)
 def index():
     if not current_user.is_authenticated:
         return redirect(url_for('main.login_page'))
-    rules_json = json.dumps(load_match_rules())
-    return render_template('index.html', rules_json=rules_json)
+    # 页面外壳只在规则文件变化时重新渲染，规则 JSON 直接嵌入
+    rules = provider_matcher.current()
+    return asset_pipeline.render_page('index', rules.mtimes, 'index.html', rules_json=rules.rules_json)
 
 @bp.route('/login')
 def login_page():
-    return render_template('index.html', view='login', rules_json='[]')
\ No newline at end of file
+    return asset_pipeline.render_page('login', None, 'index.html', view='login', rules_json='[]')
\ No newline at end of file
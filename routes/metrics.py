@@ -0,0 +1,61 @@
+import hmac
+from flask import Blueprint, Response, request, current_app, abort
+from extensions import upstream_clients
+from catalog import model_catalog
+from official import official_pool
+from limits import limiter
+from billing import balance_cache, ledger_writer
+from identity import identity_cache
+from documents import document_parser
+from utils import credential_cache
+from response_cache import response_cache
+from metrics import registry
+from startup import startup_profile
+
+bp = Blueprint('metrics', __name__)
+
+LOCAL_ADDRS = ('127.0.0.1', '::1')
+# 同机反向代理转发的请求 remote_addr 也是本机地址，带这些头的请求不按本机处理
+PROXY_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded')
+
+# ================= 现有组件的运行状态 (抓取时读取) =================
+CACHES = {
+    'balance': balance_cache,
+    'user': identity_cache,
+    'credential': credential_cache,
+    'document': document_parser.cache,
+    'response': response_cache
+}
+
+registry.gauge_func('aihub_cache_hits_total', '进程内缓存命中次数',
+                    lambda: {(name,): c.hits for name, c in CACHES.items()}, ('cache',), kind='counter')
+registry.gauge_func('aihub_cache_misses_total', '进程内缓存未命中次数',
+                    lambda: {(name,): c.misses for name, c in CACHES.items()}, ('cache',), kind='counter')
+registry.gauge_func('aihub_upstream_pools', '已建立的上游连接池数量',
+                    lambda: {('sync',): upstream_clients.stats()['pools'], ('async',): upstream_clients.stats()['async_pools']}, ('mode',))
+registry.gauge_func('aihub_model_catalog_lookups_total', '模型列表缓存查询次数',
+                    lambda: {('hit',): model_catalog.hits, ('stale',): model_catalog.stale_hits, ('miss',): model_catalog.misses},
+                    ('result',), kind='counter')
+registry.gauge_func('aihub_official_outstanding', '官方上游在途请求数',
+                    lambda: {(u['name'],): u['outstanding'] for u in official_pool.stats()}, ('upstream',))
+registry.gauge_func('aihub_official_breaker_open', '官方上游熔断状态 (1 为已熔断)',
+                    lambda: {(u['name'],): int(u['state'] == 'open') for u in official_pool.stats()}, ('upstream',))
+registry.gauge_func('aihub_limiter_waiting', '正在排队等待限流名额的请求', lambda: limiter.stats()['waiting'])
+registry.gauge_func('aihub_limiter_rejected_total', '因限流被拒绝的请求', lambda: limiter.rejected, kind='counter')
+registry.gauge_func('aihub_response_cache_disk_bytes', '回复缓存磁盘层占用',
+                    lambda: response_cache.disk.size if response_cache.disk else 0)
+registry.gauge_func('aihub_ledger_queue', '等待写入的点数流水', lambda: ledger_writer.queue.qsize())
+registry.gauge_func('aihub_startup_seconds', '启动各阶段耗时 (导入、配置、各组件初始化、建表迁移)',
+                    lambda: {(name,): seconds for name, seconds in startup_profile.phases.items()}, ('phase',))
+
+@bp.route('/metrics')
+def metrics():
+    # 配置了 METRICS_TOKEN 时任何来源 (包括本机) 都需 Bearer 令牌；未配置时只允许本机直接抓取，经反向代理转发的请求一律拒绝
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        header = request.headers.get('Authorization', '')
+        supplied = (header[7:] if header.startswith('Bearer ') else header).strip()
+        if not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')): abort(401)
+    elif request.remote_addr not in LOCAL_ADDRS or any(h in request.headers for h in PROXY_HEADERS):
+        abort(403)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
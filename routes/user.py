@@ -1,12 +1,12 @@
-import json
 import io
-import base64
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, url_for
 from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
-from PIL import Image
 from extensions import db
-from utils import encrypt_val, decrypt_val
+from models import UserAvatar
+from billing import credit_points, get_balance
+from identity import identity_cache, bump_version
+from utils import encrypt_val, decrypt_user_key, forget_user_key, compile_template
 
 bp = Blueprint('user', __name__)
 
@@ -15,7 +15,7 @@ bp = Blueprint('user', __name__)
 def get_user_status():
     return jsonify({
         'paid_mode': current_app.config['PAID_MODE'],
-        'points': current_user.points
+        'points': get_balance(current_user.id)
     })
 
 @bp.route('/api/add_points', methods=['POST'])
@@ -26,9 +26,8 @@ def add_points():
     data = request.json
     amount = int(data.get('amount', 0))
     if amount > 0:
-        current_user.points += amount
-        db.session.commit()
-        return jsonify({'success': True, 'new_balance': current_user.points})
+        credit_points(current_app._get_current_object(), current_user.id, amount)
+        return jsonify({'success': True, 'new_balance': get_balance(current_user.id)})
     return jsonify({'success': False, 'message': '无效金额'})
 
 @bp.route('/api/settings', methods=['GET', 'POST'])
@@ -36,35 +35,74 @@ def add_points():
 def handle_settings():
     if request.method == 'POST':
         data = request.json
+        template = data.get('custom_request_template')
+        if template:
+            try:
+                compile_template(template)
+            except ValueError as e:
+                return jsonify({'success': False, 'message': f'自定义请求模板无效: {e}'})
+
+        # current_user 是只读快照，写入使用会话中的 ORM 对象
+        user = current_user.row()
         if 'new_password' in data and data['new_password']:
-            current_user.password = generate_password_hash(data['new_password'], method='pbkdf2:sha256')
+            user.password = generate_password_hash(data['new_password'], method='pbkdf2:sha256')
         
-        current_settings = json.loads(current_user.settings)
+        prefs = user.prefs
+        old_key = prefs.api_key or ''
+        updates = {}
         for key, value in data.items():
             if key == 'api_key':
                 if value is None: value = ""
                 value = value.strip()
                 if value.startswith('gAAAA'):
-                    current_settings[key] = value
+                    updates[key] = value
                 elif value:
-                    current_settings[key] = encrypt_val(value)
+                    updates[key] = encrypt_val(value)
                 else:
-                    current_settings[key] = ""
+                    updates[key] = ""
             elif key != 'new_password':
-                current_settings[key] = value
+                updates[key] = value
         
-        current_user.settings = json.dumps(current_settings)
+        prefs.update(updates)
+        user.version = (user.version or 0) + 1
         db.session.commit()
+        identity_cache.invalidate(user.id)
+        if (prefs.api_key or '') != old_key:
+            forget_user_key(user.id)
         return jsonify({'success': True})
     
-    settings = json.loads(current_user.settings)
+    settings = current_user.prefs.to_dict()
     if settings.get('api_key'):
-        decrypted = decrypt_val(settings['api_key'])
+        decrypted = decrypt_user_key(current_user.id, settings['api_key'])
         if not decrypted: decrypted = settings['api_key']
         settings['api_key'] = decrypted
     settings['account_username'] = current_user.username
+    settings['user_avatar'] = avatar_url(current_user.avatar_etag)
     return jsonify(settings)
 
+def avatar_url(etag):
+    # etag 随用户快照缓存，不加载图片字节；作为版本号拼进 URL 以便长期缓存
+    return url_for('user.get_avatar', v=etag) if etag else ''
+
+@bp.route('/api/avatar', methods=['GET'])
+@login_required
+def get_avatar():
+    row = db.session.query(UserAvatar.etag, UserAvatar.mime_type).filter_by(user_id=current_user.id).first()
+    if row is None: return jsonify({'success': False, 'message': '未设置头像'}), 404
+    etag, mime_type = row
+    if request.args.get('v') == etag:
+        cache_control = 'private, max-age=31536000, immutable'
+    else:
+        cache_control = 'private, no-cache'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        data = db.session.query(UserAvatar.data).filter_by(user_id=current_user.id).scalar()
+        response = Response(data, mimetype=mime_type)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
 @bp.route('/api/upload_avatar', methods=['POST'])
 @login_required
 def upload_avatar():
@@ -73,18 +111,22 @@ def upload_avatar():
     if file.filename == '': return jsonify({'success': False, 'message': '未选择文件'})
 
     try:
+        # Pillow 只有这里用到，首次上传时才导入 (可由 STARTUP_WARMUP 提前在后台导入)
+        from PIL import Image
         img = Image.open(file.stream)
         if img.mode != 'RGB': img = img.convert('RGB')
         img.thumbnail((128, 128))
         buffered = io.BytesIO()
         img.save(buffered, format="JPEG", quality=85)
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        avatar_data = f"data:image/jpeg;base64,{img_str}"
         
-        settings = json.loads(current_user.settings)
-        settings['user_avatar'] = avatar_data
-        current_user.settings = json.dumps(settings)
+        avatar = db.session.get(UserAvatar, current_user.id)
+        if avatar is None:
+            avatar = UserAvatar(user_id=current_user.id)
+            db.session.add(avatar)
+        avatar.set_image(buffered.getvalue(), 'image/jpeg')
+        bump_version(current_user.id)
         db.session.commit()
-        return jsonify({'success': True, 'avatar': avatar_data})
+        identity_cache.invalidate(current_user.id)
+        return jsonify({'success': True, 'avatar': avatar_url(avatar.etag)})
     except Exception as e:
         return jsonify({'success': False, 'message': f"Image Error: {str(e)}"})
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from billing import balance_cache
+from identity import identity_cache
+from catalog import model_catalog
+from streams import stream_registry
+
+# ================= 跨进程共享状态 =================
+# 多进程 (prefork) 模式下各 worker 的进程内缓存会互相不一致，这里用本机的一个 SQLite (WAL) 文件
+# 作为共享后端，不依赖外部服务：
+#   - shared_kv: 带过期时间的键值 (点数余额、登录用户快照、模型目录缓存)
+#   - shared_streams: 活动流登记，跨 worker 取消 (/api/chat/cancel 可能落到另一个进程)
+# 限流计数由 limits.SqliteBackend 负责；价格与匹配规则以文件为准，各进程按 mtime 热加载。
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class SharedStore:
+    """值以 JSON 保存；过期时间为 time.time() 绝对时间，读取时判断，写入时顺带清理"""
+    SWEEP_INTERVAL = 60.0
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS shared_kv (ns TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (ns, key))")
+        conn.execute("CREATE TABLE IF NOT EXISTS shared_streams (id TEXT PRIMARY KEY, user_id INTEGER, pid INTEGER, cancel_reason TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_shared_streams_pid ON shared_streams (pid)")
+        # 清理已退出 worker 留下的流登记
+        for (pid,) in conn.execute("SELECT DISTINCT pid FROM shared_streams").fetchall():
+            if not pid_alive(pid): conn.execute("DELETE FROM shared_streams WHERE pid = ?", (pid,))
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ----- 键值 -----
+    def get(self, ns, key):
+        row = self._conn().execute("SELECT value, expires FROM shared_kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        if row is None or row[1] < time.time(): return None
+        return json.loads(row[0])
+
+    def set(self, ns, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO shared_kv (ns, key, value, expires) VALUES (?, ?, ?, ?)",
+                     (ns, key, json.dumps(value, ensure_ascii=False), now + ttl))
+        if now - self._last_sweep > self.SWEEP_INTERVAL:
+            self._last_sweep = now
+            conn.execute("DELETE FROM shared_kv WHERE expires < ?", (now,))
+
+    def delete(self, ns, key=None):
+        if key is None:
+            self._conn().execute("DELETE FROM shared_kv WHERE ns = ?", (ns,))
+        else:
+            self._conn().execute("DELETE FROM shared_kv WHERE ns = ? AND key = ?", (ns, key))
+
+    def delete_prefix(self, ns, prefix):
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        self._conn().execute("DELETE FROM shared_kv WHERE ns = ? AND key LIKE ? ESCAPE '\\'", (ns, escaped + '%'))
+
+    def count(self, ns):
+        return self._conn().execute("SELECT COUNT(*) FROM shared_kv WHERE ns = ? AND expires >= ?", (ns, time.time())).fetchone()[0]
+
+    # ----- 活动流 -----
+    def register_stream(self, stream_id, user_id):
+        self._conn().execute("INSERT OR REPLACE INTO shared_streams (id, user_id, pid) VALUES (?, ?, ?)",
+                             (stream_id, user_id, os.getpid()))
+
+    def unregister_stream(self, stream_id):
+        self._conn().execute("DELETE FROM shared_streams WHERE id = ?", (stream_id,))
+
+    def request_cancel(self, user_id, stream_id, reason):
+        cursor = self._conn().execute(
+            "UPDATE shared_streams SET cancel_reason = ? WHERE id = ? AND user_id = ? AND cancel_reason IS NULL",
+            (reason, stream_id, user_id))
+        return cursor.rowcount == 1
+
+    def cancelled_streams(self):
+        """本进程中已被其他进程请求取消的流 [(id, reason)]"""
+        return self._conn().execute("SELECT id, cancel_reason FROM shared_streams WHERE pid = ? AND cancel_reason IS NOT NULL",
+                                    (os.getpid(),)).fetchall()
+
+class SharedState:
+    """SHARED_STATE_BACKEND=sqlite 时把各组件的进程内状态切换到 SharedStore"""
+
+    def __init__(self, app=None):
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        if conf.get('SHARED_STATE_BACKEND', 'memory') == 'sqlite':
+            self.store = SharedStore(conf['SHARED_STATE_DB'])
+            balance_cache.share(self.store, 'balance')
+            identity_cache.cache.share(self.store, 'user')
+            model_catalog.share(self.store)
+            stream_registry.share(self.store, conf.get('SHARED_CANCEL_POLL', 0.25))
+        app.extensions['shared_state'] = self
+
+shared_state = SharedState()
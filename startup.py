@@ -0,0 +1,82 @@
+import sys
+import time
+import threading
+import importlib
+from contextlib import contextmanager
+
+# ================= 启动耗时 =================
+# app.py 最先导入本模块，记录导入与各组件 init_app 的耗时；启动时可打印报告 (STARTUP_REPORT)，
+# /metrics 中为 aihub_startup_seconds。重量级依赖只在首次使用时导入，可选在后台线程预热 (STARTUP_WARMUP)。
+# 更细的逐模块耗时可用: python -X importtime app.py
+
+# 按需导入的重量级模块及其用途；启动阶段就被导入说明有模块级 import 回归
+DEFERRED_IMPORTS = (
+    ('PIL.Image', '头像处理'),
+    ('cryptography.fernet', 'API Key 加解密'),
+)
+# 只应在文档解析子进程中导入
+PARSER_IMPORTS = ('pypdf', 'docx')
+
+class StartupProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = {}   # 阶段名 -> 秒，按发生顺序
+        self.warmed = {}   # 预热的模块 -> 秒 (None 为未安装)
+        self.budget = 0.0  # 导入阶段预算 (秒)，0 为不检查
+
+    def mark(self, name):
+        """记录从上一个标记到现在的耗时"""
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+
+    @contextmanager
+    def phase(self, name):
+        self._last = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(name)
+
+    def init(self, component, app):
+        with self.phase(f"init {type(component).__name__}"):
+            component.init_app(app)
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+    def over_budget(self):
+        imports = self.phases.get('imports', 0.0)
+        return bool(self.budget) and imports > self.budget
+
+    def report(self):
+        lines = [f" * Startup {self.total * 1000:.0f} ms"]
+        for name, seconds in self.phases.items():
+            lines.append(f"   {name:<28} {seconds * 1000:8.1f} ms")
+        deferred = [module for module, _ in DEFERRED_IMPORTS] + list(PARSER_IMPORTS)
+        loaded = [module for module in deferred if module in sys.modules and module not in self.warmed]
+        if loaded: lines.append(f"   loaded at import time: {', '.join(loaded)}")
+        if self.over_budget():
+            lines.append(f"   WARNING: imports exceeded budget of {self.budget * 1000:.0f} ms")
+        return "\n".join(lines)
+
+    def warm_up(self, document_parser=None):
+        """后台导入按需模块，并预先启动文档解析子进程 (在子进程中导入 pypdf / python-docx)"""
+        def run():
+            for module, _ in DEFERRED_IMPORTS:
+                started = time.perf_counter()
+                try:
+                    importlib.import_module(module)
+                    self.warmed[module] = time.perf_counter() - started
+                except ImportError:
+                    self.warmed[module] = None
+            if document_parser is not None:
+                try:
+                    document_parser.warm_up()
+                except Exception as e:
+                    print(f"Document parser warm-up error: {e}")
+        threading.Thread(target=run, name='startup-warmup', daemon=True).start()
+
+startup_profile = StartupProfile()
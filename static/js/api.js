@@ -64,29 +64,40 @@ const AppAPI = {
     },
 
     // [新增] 解析文档 (PDF/Docx/Txt)
+    // 返回 { text, document_id, chunks, chars }；有 document_id 时服务端已建立检索索引
     async parseDocument(fileObj) {
         const formData = new FormData();
         formData.append('file', fileObj);
         try {
             const res = await fetch('/api/parse_doc', { method: 'POST', body: formData });
             const data = await res.json();
-            return data.success ? data.text : null;
+            return data.success ? data : null;
         } catch (e) {
             console.error("Doc Parse Fail:", e);
             return null;
         }
     },
 
+    // 停止生成：服务端立即断开上游，已输出部分保留
+    async cancelChat(streamId) {
+        return this.request('/api/chat/cancel', 'POST', { stream_id: streamId });
+    },
+
+    // 删除服务端会话
+    async deleteConversation(conversationId) {
+        return this.request(`/api/conversations/${conversationId}`, 'DELETE');
+    },
+
     // [核心] 流式对话请求 (修复了长数据截断 bug)
+    // params 为 { messages } (完整历史) 或服务端会话模式 { conversation_id, message, seed, regenerate }
     async chatStream(params, callbacks) {
-        const { messages } = params;
-        const { onChunk, onDone, onError } = callbacks;
+        const { onChunk, onDone, onError, onConversation, onStream } = callbacks;
 
         try {
             const response = await fetch('/api/chat', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ messages })
+                body: JSON.stringify(params)
             });
 
             if (response.status !== 200) {
@@ -94,6 +105,11 @@ const AppAPI = {
                 throw new Error(`Server Error: ${response.status} ${err}`);
             }
 
+            const conversationId = response.headers.get('X-Conversation-Id');
+            if (conversationId && onConversation) onConversation(conversationId);
+            const streamId = response.headers.get('X-Stream-Id');
+            if (streamId && onStream) onStream(streamId);
+
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
 
@@ -66,7 +66,11 @@ export const authMethods = {
 
     async saveSettings() {
         this.settings.dark_mode = this.isDarkMode;
-        await AppAPI.saveSettings(this.settings);
+        const res = await AppAPI.saveSettings(this.settings);
+        if (res && res.success === false) {
+            AppUI.toast(res.message, 'error');
+            return;
+        }
         this.showSettings = false;
     },
 
@@ -43,6 +43,8 @@ export const chatMethods = {
     async deleteSession(id) {
         const isConfirmed = await AppUI.confirm(this.t('del_session_title'), this.t('del_session_desc'));
         if (!isConfirmed) return;
+        const session = this.sessions.find(s => s.id === id);
+        if (session && session.server_id) AppAPI.deleteConversation(session.server_id).catch(() => {});
         await AppDB.deleteSession(id);
         AppUI.toast('删除成功', 'success');
         this.sessions = this.sessions.filter(s => s.id !== id);
@@ -71,6 +73,7 @@ export const chatMethods = {
         const confirmed = await AppUI.confirm(this.t('delete_confirm_title'), this.t('del_msg_confirm'));
         if (!confirmed) return;
         this.messages.splice(index, 1);
+        this.detachServerConversation();
         await this.saveCurrentSessionData();
     },
 
@@ -79,6 +82,7 @@ export const chatMethods = {
         const newContent = await AppUI.input(this.t('edit_msg_title'), msg.content, this.t('edit_msg_ph'));
         if (newContent !== null) {
             msg.content = newContent;
+            this.detachServerConversation();
             await this.saveCurrentSessionData();
             AppUI.toast(this.t('msg_edited'), 'success');
         }
@@ -88,8 +92,20 @@ export const chatMethods = {
         if (this.isThinking || this.isStreaming) return;
         let targetIndex = aiIndex !== undefined ? aiIndex : this.messages.length - 1;
         if (targetIndex < 0 || this.messages[targetIndex].role === 'user') return;
+        // 只有重新生成最后一条回复时服务端历史仍与本地一致
+        const isLast = targetIndex === this.messages.length - 1;
         this.messages.splice(targetIndex, 1);
-        await this.streamResponse();
+        if (!isLast) this.detachServerConversation();
+        await this.streamResponse({ regenerate: isLast });
+    },
+
+    // 本地历史被删改后与服务端会话不再一致，下次发送时重新导入 (seed)
+    detachServerConversation() {
+        const session = this.sessions.find(s => s.id === this.currentSessionId);
+        if (session && session.server_id) {
+            AppAPI.deleteConversation(session.server_id).catch(() => {});
+            session.server_id = null;
+        }
     },
 
     async saveCurrentSessionData() {
@@ -130,6 +146,8 @@ export const chatMethods = {
 
         // 【新增变量】专门用来存解析后的长文本
         let fullDocText = "";
+        // 服务端已索引的文档 [{ id, name }]
+        const documents = [];
 
         const docFiles = currentFiles.filter(f => f.type === 'doc');
 
@@ -139,10 +157,14 @@ export const chatMethods = {
             this.smartScrollToBottom();
 
             for (let fileObj of docFiles) {
-                const extractedText = await AppAPI.parseDocument(fileObj.raw);
-                if (extractedText) {
+                const parsed = await AppAPI.parseDocument(fileObj.raw);
+                if (!parsed) continue;
+                if (parsed.document_id) {
+                    // 已在服务端建立索引：每轮只按问题检索相关片段注入
+                    documents.push({ id: parsed.document_id, name: fileObj.name });
+                } else if (parsed.text) {
                     // 【修改点】不再拼接到 finalPrompt，而是拼接到 fullDocText
-                    fullDocText += `\n\n--- Document: ${fileObj.name} ---\n${extractedText}\n----------------\n`;
+                    fullDocText += `\n\n--- Document: ${fileObj.name} ---\n${parsed.text}\n----------------\n`;
                 }
             }
             // 移除临时提示
@@ -156,6 +178,7 @@ export const chatMethods = {
 
             // 【新增字段】这里存放不显示的文档全文，Saved in DB automatically
             parsed_context: fullDocText,
+            documents,
 
             files: currentFiles,
             model: this.settings.model
@@ -169,7 +192,16 @@ export const chatMethods = {
         // 4. 调用核心流式请求
         await this.streamResponse();
     },
-    async streamResponse() {
+    // 停止生成：服务端结束流后照常走 onDone，已输出的内容保留
+    async stopGeneration() {
+        if (!this.activeStreamId) return;
+        try {
+            await AppAPI.cancelChat(this.activeStreamId);
+        } catch (e) {
+            console.warn("Cancel failed:", e);
+        }
+    },
+    async streamResponse(options = {}) {
         if (this.isThinking) return;
 
         // ================= [新增] 发送前余额检查 =================
@@ -236,10 +268,37 @@ export const chatMethods = {
             return { role: msg.role, content: contentToSend };
         });
 
-        // 2. 准备接收回复
+        // 3. 服务端会话模式：只发送本轮消息，历史由服务端按模型预算组装
+        //    首次发送时把本地已有历史作为 seed 导入；最后一条不是用户消息时退回完整历史模式
+        const session = this.sessions.find(s => s.id === this.currentSessionId);
+        const lastMsg = messagesToSend[messagesToSend.length - 1];
+        let request = { messages: apiMessages };
+        if (session && lastMsg && lastMsg.role === 'user') {
+            const newMessage = apiMessages[apiMessages.length - 1];
+            if (session.server_id) {
+                request = options.regenerate
+                    ? { conversation_id: session.server_id, regenerate: true }
+                    : { conversation_id: session.server_id, message: newMessage };
+            } else {
+                const seed = apiMessages.slice(0, -1).filter((m, i) => messagesToSend[i].model !== 'System');
+                request = { message: newMessage, seed };
+            }
+        }
+
+        // 本会话中所有已索引的文档都参与检索
+        const documentIds = [...new Set(this.messages.flatMap(m => (m.documents || []).map(d => d.id)))];
+        if (documentIds.length > 0) request.documents = documentIds;
+
+        // 4. 准备接收回复
         let aiMsgIndex = -1; // 标记 AI 消息在数组中的位置
 
-        await AppAPI.chatStream({ messages: apiMessages }, {
+        await AppAPI.chatStream(request, {
+            onConversation: (conversationId) => {
+                if (session) session.server_id = conversationId;
+            },
+            onStream: (streamId) => {
+                this.activeStreamId = streamId;
+            },
             onChunk: (text) => {
                 this.isThinking = false; // 第一帧到达，停止思考动画
                 this.isStreaming = true; // 开始流式传输状态
@@ -256,6 +315,7 @@ export const chatMethods = {
             onDone: async () => {
                 this.isThinking = false;
                 this.isStreaming = false;
+                this.activeStreamId = null;
 
                 // ================= [新增] 刷新余额 =================
                 // 对话成功结束后，向后端拉取最新的余额（因为后端已经扣费）
@@ -278,6 +338,10 @@ export const chatMethods = {
             onError: async (err) => { // 注意：加上 async
                 this.isThinking = false;
                 this.isStreaming = false;
+                this.activeStreamId = null;
+
+                // 服务端会话已不存在时解除关联，下次发送会重新导入历史
+                if (err.includes("Conversation Not Found") && session) session.server_id = null;
 
                 // 错误处理逻辑 (402 等)
                 if (err.includes("402") || err.includes("点数不足")) {
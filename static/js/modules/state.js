@@ -6,6 +6,7 @@ export function getInitialState() {
         isRegistering: false,
         isThinking: false,
         isStreaming: false,
+        activeStreamId: null, // 当前对话流 ID，用于停止生成
         isLoadingModels: false,
         isTestingConnection: false,
 
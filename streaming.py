@@ -0,0 +1,135 @@
+import re
+import json
+import time
+from utils import compile_path, get_by_path
+
+DEFAULT_RESPONSE_PATH = "choices[0].delta.content"
+DONE_FRAME = "data: [DONE]\n\n"
+# 直通时不解析 JSON，用正则判断：delta 中有非空的 content 字符串 / finish_reason 不为 null
+CONTENT_RE = re.compile(r'"content"\s*:\s*"(?!")')
+FINISH_RE = re.compile(r'"finish_reason"\s*:\s*"')
+
+def sse_delta(content):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': content}}]})}\n\n"
+
+def sse_error(message):
+    return f"data: {json.dumps({'error': message})}\n\n"
+
+# ================= 流式转码 =================
+class StreamTranscoder:
+    """把上游的流式行转换为下游 SSE 帧 (同步与异步模式共用)
+
+    - 直通：上游是标准 OpenAI 格式且未配置自定义响应路径时，原样转发，不做 json 解析/序列化；
+      只有带 reasoning_content 的块或需要闭合 <think> 时才回落到解析路径。
+    - 合并：解析路径按预编译的路径取值，把细碎的 delta 按字符数/时间间隔合并成一帧。
+      flush_chars 与 flush_interval 均为 0 时逐条输出。
+    - 记录：record=True 时 (服务端会话需要保存回复、回复需要写入缓存) 关闭直通，每次 flush 的文本追加到 recorded，
+      回复正文只在这里保留一份，不另存帧。
+    """
+
+    def __init__(self, response_path='', flush_chars=0, flush_interval=0.0, record=False):
+        self.passthrough = not record and (not response_path or response_path == DEFAULT_RESPONSE_PATH)
+        self.recorded = [] if record else None
+        self.path = compile_path(response_path or DEFAULT_RESPONSE_PATH)
+        self.flush_chars = flush_chars
+        self.flush_interval = flush_interval
+        self.think_started = False
+        self.think_ended = False
+        self.has_content = False
+        self.finished = False  # 上游已发出 finish_reason 或 [DONE]，回复完整
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = 0.0
+
+    @property
+    def think_open(self):
+        return self.think_started and not self.think_ended
+
+    def feed(self, line):
+        if not line: return []
+        if line.startswith("data: "): json_str = line[6:]
+        elif line.startswith("{"): json_str = line
+        else: return []
+
+        if json_str.strip() == "[DONE]":
+            self.finished = True
+            if self.think_open: self._push('</think>')
+            frames = self.flush()
+            frames.append(DONE_FRAME)
+            return frames
+
+        if not self.finished and FINISH_RE.search(json_str): self.finished = True
+
+        if (self.passthrough and not self.think_open
+                and '"choices"' in json_str and '"reasoning_content"' not in json_str):
+            # 只有角色、空 delta 的块不算已送达内容
+            if not self.has_content and CONTENT_RE.search(json_str): self.has_content = True
+            frames = self.flush()
+            frames.append(f"data: {json_str}\n\n")
+            return frames
+
+        try:
+            json_data = json.loads(json_str)
+            choices = json_data.get('choices', [])
+            delta = choices[0].get('delta', {}) if choices else {}
+            reasoning = delta.get('reasoning_content', '')
+            if reasoning:
+                if not self.think_started:
+                    self._push('<think>')
+                    self.think_started = True
+                self._push(reasoning)
+                self.has_content = True
+                return self._maybe_flush()
+
+            content = get_by_path(json_data, self.path)
+            if content:
+                if self.think_open:
+                    self._push('</think>')
+                    self.think_ended = True
+                self.has_content = True
+                if not isinstance(content, str):
+                    frames = self.flush()
+                    frames.append(sse_delta(content))
+                    return frames
+                self._push(content)
+                return self._maybe_flush()
+        except Exception as e: pass
+        return []
+
+    def _push(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+
+    def _maybe_flush(self):
+        now = time.monotonic()
+        if self.buffered >= self.flush_chars or now - self.last_flush >= self.flush_interval:
+            return self.flush(now)
+        return []
+
+    def flush_due(self):
+        """缓冲区有内容时返回距离按时间间隔发送还剩的秒数，否则 None；
+        上游停顿 (长时间推理、工具调用) 时 pump 据此按时唤醒，调用 flush() 发出已收到的文本"""
+        if not self.buffer: return None
+        return max(0.0, self.last_flush + self.flush_interval - time.monotonic())
+
+    def flush(self, now=None):
+        """输出缓冲区中尚未发送的内容；流结束时调用方也要调用一次"""
+        if not self.buffer: return []
+        text = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = now or time.monotonic()
+        if self.recorded is not None: self.recorded.append(text)
+        return [sse_delta(text)]
+
+    def replay(self, text, chunk_chars=256):
+        """把缓存的完整回复 (已含 <think> 标记) 重新切成 SSE 帧"""
+        self.has_content = bool(text)
+        if self.recorded is not None: self.recorded.append(text)
+        frames = [sse_delta(text[i:i + chunk_chars]) for i in range(0, len(text), chunk_chars)]
+        frames.append(DONE_FRAME)
+        return frames
+
+    @property
+    def recorded_text(self):
+        return ''.join(self.recorded) if self.recorded else ''
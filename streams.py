@@ -0,0 +1,208 @@
+import time
+import queue
+import asyncio
+import threading
+from uuid import uuid4
+
+# ================= 活动流登记 =================
+# 每条 /api/chat 流登记一个 ActiveStream (流 ID 通过 X-Stream-Id 响应头返回)。
+# 取消来源：客户端调用 /api/chat/cancel ('client')、连接断开 ('disconnect')。
+# 上游的行在后台线程 / 任务中读取，转发方按心跳间隔轮询，因此取消、空闲超时都能及时生效，
+# 不必等到上游下一次输出。
+
+HEARTBEAT_FRAME = ": keep-alive\n\n"
+
+class StreamCancelled(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Stream cancelled ({reason})")
+        self.reason = reason
+
+class UpstreamIdle(TimeoutError):
+    """上游在空闲超时内没有任何输出"""
+
+class ActiveStream:
+    def __init__(self, user_id):
+        self.id = uuid4().hex
+        self.user_id = user_id
+        self.started = time.time()
+        self.reason = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def on_cancel(self, callback):
+        """登记取消回调 (可能在其他线程中调用)；已取消时立即调用"""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, reason='client'):
+        with self._lock:
+            if self.reason is not None: return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Stream cancel callback error: {e}")
+        return True
+
+class StreamRegistry:
+    def __init__(self, app=None):
+        self.first_byte_timeout = 120.0
+        self.idle_timeout = 60.0
+        self.heartbeat_interval = 15.0
+        self.cancel_full_chunks = 500
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._store = None
+        self._watcher = None
+        self.cancel_poll = 0.25
+        self.cancelled = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.first_byte_timeout = conf.get('STREAM_FIRST_BYTE_TIMEOUT', self.first_byte_timeout)
+        self.idle_timeout = conf.get('STREAM_IDLE_TIMEOUT', self.idle_timeout)
+        self.heartbeat_interval = conf.get('STREAM_HEARTBEAT_INTERVAL', self.heartbeat_interval)
+        self.cancel_full_chunks = conf.get('CANCEL_FULL_CHUNKS', self.cancel_full_chunks)
+        app.extensions['stream_registry'] = self
+
+    def share(self, store, cancel_poll=0.25):
+        """多进程模式：流同时登记到 shared.SharedStore；取消请求落到其他 worker 时写入共享表，
+        由本进程的轮询线程 (仅在有活动流时查询) 转为本地取消"""
+        self._store = store
+        self.cancel_poll = cancel_poll
+
+    def _watch(self):
+        while True:
+            time.sleep(self.cancel_poll)
+            if not self._streams: continue
+            try:
+                for stream_id, reason in self._store.cancelled_streams():
+                    stream = self._streams.get(stream_id)
+                    if stream is not None: stream.cancel(reason)
+            except Exception as e:
+                print(f"Shared stream watcher error: {e}")
+
+    @property
+    def read_timeout(self):
+        """httpx 读超时只作兜底 (读取线程不会永远挂起)，实际超时由 pump 判断"""
+        return max(self.first_byte_timeout, self.idle_timeout) + self.heartbeat_interval
+
+    def open(self, user_id):
+        stream = ActiveStream(user_id)
+        with self._lock:
+            self._streams[stream.id] = stream
+            if self._store is not None and self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name='stream-cancel-watch', daemon=True)
+                self._watcher.start()
+        if self._store is not None: self._store.register_stream(stream.id, user_id)
+        return stream
+
+    def close(self, stream):
+        with self._lock:
+            self._streams.pop(stream.id, None)
+            if stream.cancelled:
+                self.cancelled[stream.reason] = self.cancelled.get(stream.reason, 0) + 1
+        if self._store is not None: self._store.unregister_stream(stream.id)
+
+    def cancel(self, user_id, stream_id, reason='client'):
+        """只能取消自己的流；流不存在或已结束时返回 False"""
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            # 可能属于另一个 worker 进程
+            return self._store is not None and self._store.request_cancel(user_id, stream_id, reason)
+        if stream.user_id != user_id: return False
+        return stream.cancel(reason)
+
+    def __len__(self):
+        return len(self._streams)
+
+    def billed_fraction(self, chunks, max_tokens=None, finished=False):
+        """被取消的流的计费比例：上游已发完 (finish_reason / [DONE]) 时按全价；否则按已输出的上游块数
+        (约等于 token 数) 相对请求的 max_tokens 计算，请求未指定 max_tokens 时相对 cancel_full_chunks"""
+        if finished or not self.cancel_full_chunks: return 1.0
+        full = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else self.cancel_full_chunks
+        return min(1.0, chunks / full)
+
+    def timeouts(self, started, last_line):
+        """首个上游行之前用 first_byte_timeout，之后用 idle_timeout"""
+        if last_line is None: return started + self.first_byte_timeout
+        return last_line + self.idle_timeout
+
+    def wait_time(self, pending):
+        """等待下一行的最长时间：pending() 返回缓冲内容距离到期发送的秒数 (无缓冲为 None)"""
+        due = pending() if pending else None
+        return self.heartbeat_interval if due is None else min(self.heartbeat_interval, due)
+
+    def pump(self, response, stream, pending=None):
+        """同步：逐行返回上游内容；超过心跳间隔 (或 pending 给出的更早时刻) 没有新行时返回 None，
+        由调用方发送到期的缓冲内容或心跳"""
+        lines = queue.Queue()
+        cancelled = object()
+
+        def read():
+            try:
+                for line in response.iter_lines(): lines.put(line)
+                lines.put(None)
+            except Exception as e:
+                lines.put(e)
+
+        stream.on_cancel(lambda: lines.put(cancelled))
+        threading.Thread(target=read, name='stream-pump', daemon=True).start()
+        started, last_line = time.monotonic(), None
+        while True:
+            try:
+                item = lines.get(timeout=self.wait_time(pending))
+            except queue.Empty:
+                if time.monotonic() > self.timeouts(started, last_line): raise UpstreamIdle("Upstream idle timeout")
+                yield None
+                continue
+            if item is cancelled: raise StreamCancelled(stream.reason)
+            if item is None: return
+            if isinstance(item, Exception): raise item
+            last_line = time.monotonic()
+            yield item
+
+    async def apump(self, response, stream, pending=None):
+        """异步版本的 pump：读取任务与转发协程之间通过 asyncio.Queue 传递"""
+        lines = asyncio.Queue()
+        cancelled = object()
+        loop = asyncio.get_running_loop()
+
+        async def read():
+            try:
+                async for line in response.aiter_lines(): lines.put_nowait(line)
+                lines.put_nowait(None)
+            except Exception as e:
+                lines.put_nowait(e)
+
+        stream.on_cancel(lambda: loop.call_soon_threadsafe(lines.put_nowait, cancelled))
+        reader = asyncio.create_task(read())
+        started, last_line = time.monotonic(), None
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(lines.get(), self.wait_time(pending))
+                except asyncio.TimeoutError:
+                    if time.monotonic() > self.timeouts(started, last_line): raise UpstreamIdle("Upstream idle timeout")
+                    yield None
+                    continue
+                if item is cancelled: raise StreamCancelled(stream.reason)
+                if item is None: return
+                if isinstance(item, Exception): raise item
+                last_line = time.monotonic()
+                yield item
+        finally:
+            reader.cancel()
+
+stream_registry = StreamRegistry()
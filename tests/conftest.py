@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import tempfile
+from uuid import uuid4
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_upstream import FakeUpstream, UpstreamProfile
+
+# ================= 测试环境 =================
+# 临时数据库 + 本地假上游 (作为官方通道)，PAID_MODE 开启、限流关闭。
+# Config 在导入时读取环境变量，测试模块导入 routes.* 时就会导入它，因此在这里最先设置。
+
+TMPDIR = tempfile.TemporaryDirectory(prefix='aihub-test-')
+os.environ.update(
+    DATABASE_URL='sqlite:///' + os.path.join(TMPDIR.name, 'users.db'),
+    PAID_MODE='true',
+    RATE_LIMITS='{}',
+    METRICS_TOKEN=''
+)
+
+@pytest.fixture(scope='session')
+def upstream():
+    server = FakeUpstream(UpstreamProfile(token_rate=0, tokens=20, latency=0)).start()
+    yield server
+    server.stop()
+
+@pytest.fixture(scope='session')
+def app(upstream):
+    # official_key.json 按当前目录读取
+    with open(os.path.join(TMPDIR.name, 'official_key.json'), 'w', encoding='utf-8') as f:
+        json.dump({'api_endpoint': upstream.base_url, 'api_key': 'test-key'}, f)
+    cwd = os.getcwd()
+    os.chdir(TMPDIR.name)
+    from app import app as flask_app
+    yield flask_app
+    os.chdir(cwd)
+
+@pytest.fixture
+def login(app):
+    """注册并登录一个新用户，返回 (test_client, user_id)；settings 为要覆盖的设置"""
+    def make(**settings):
+        from models import User
+        client = app.test_client()
+        username = f"user-{uuid4().hex[:8]}"
+        client.post('/api/register', json={'username': username, 'password': 'pw'})
+        assert client.post('/api/login', json={'username': username, 'password': 'pw'}).json['success']
+        if settings: client.post('/api/settings', json=settings)
+        with app.app_context():
+            user_id = User.query.filter_by(username=username).first().id
+        return client, user_id
+    return make
+
+def points_of(app, user_id):
+    from models import User
+    from extensions import db
+    with app.app_context():
+        return db.session.get(User, user_id).points
+
+def call_asgi(asgi, client, method, path, payload=None):
+    """以 client 的会话 Cookie 直接调用 ASGI 应用，返回发出的全部消息"""
+    import asyncio
+    from extensions import upstream_clients
+    body = json.dumps(payload).encode() if payload is not None else b''
+    headers = [(b'cookie', f"session={client.get_cookie('session').value}".encode())]
+    if payload is not None:
+        headers += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if messages: return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await asgi(scope, receive, send)
+        # 与 lifespan 关闭时一样：AsyncClient 绑定在当前事件循环上，不能留给下一个 asyncio.run
+        await upstream_clients.aclose_all()
+
+    asyncio.run(run())
+    return sent
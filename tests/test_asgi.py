@@ -0,0 +1,24 @@
+from flask import session
+from conftest import points_of, call_asgi
+
+OFFICIAL = {'use_official_api': True, 'model': 'bench-model'}
+
+def test_async_chat_keeps_response_hooks(app, login, monkeypatch):
+    from asgi import ChatASGI
+    client, user_id = login(**OFFICIAL)
+    before = points_of(app, user_id)
+
+    def hook(response):
+        session['seen'] = True
+        response.headers['X-Hook'] = 'ran'
+        return response
+    monkeypatch.setitem(app.after_request_funcs, None, [hook] + app.after_request_funcs.get(None, []))
+    sent = call_asgi(ChatASGI(app), client, 'POST', '/api/chat', {'messages': [{'role': 'user', 'content': 'hi'}]})
+    start = sent[0]
+    headers = [(k.decode(), v.decode()) for k, v in start['headers']]
+    assert start['status'] == 200
+    assert ('x-hook', 'ran') in headers
+    assert any(k == 'set-cookie' and v.startswith('session=') for k, v in headers)
+    assert ('content-type', 'text/event-stream; charset=utf-8') in headers
+    assert b'data: [DONE]' in b''.join(m.get('body', b'') for m in sent[1:])
+    assert points_of(app, user_id) == before - 100
@@ -0,0 +1,47 @@
+import routes.chat
+from conftest import points_of
+
+OFFICIAL = {'use_official_api': True, 'model': 'bench-model'}
+
+def test_official_chat_settles_full_cost(app, login):
+    client, user_id = login(**OFFICIAL)
+    before = points_of(app, user_id)
+    resp = client.post('/api/chat', json={'messages': [{'role': 'user', 'content': 'hi'}]})
+    assert resp.status_code == 200
+    assert 'data: [DONE]' in resp.get_data(as_text=True)
+    assert points_of(app, user_id) == before - 100
+
+def test_failure_after_reservation_refunds(app, login, monkeypatch):
+    client, user_id = login(**OFFICIAL)
+    before = points_of(app, user_id)
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('template failure')
+    monkeypatch.setattr(routes.chat, 'build_dynamic_payload', broken)
+    resp = client.post('/api/chat', json={'messages': [{'role': 'user', 'content': 'hi'}]})
+    assert resp.status_code == 500
+    assert points_of(app, user_id) == before
+
+def test_new_conversation_on_official_channel(app, login):
+    client, user_id = login(**OFFICIAL)
+    before = points_of(app, user_id)
+    seed = [{'role': 'user', 'content': 'earlier'}, {'role': 'assistant', 'content': 'reply'}]
+    resp = client.post('/api/chat', json={'message': {'role': 'user', 'content': 'hi'}, 'seed': seed})
+    assert resp.status_code == 200
+    assert 'data: [DONE]' in resp.get_data(as_text=True)
+    assert points_of(app, user_id) == before - 100
+
+    conversation_id = resp.headers['X-Conversation-Id']
+    messages = client.get(f'/api/conversations/{conversation_id}/messages').json['messages']
+    assert [m['role'] for m in messages] == ['user', 'assistant', 'user', 'assistant']
+
+def test_new_conversation_is_not_created_without_points(app, login):
+    from extensions import db
+    from models import User
+    client, user_id = login(**OFFICIAL)
+    with app.app_context():
+        db.session.get(User, user_id).points = 10
+        db.session.commit()
+    resp = client.post('/api/chat', json={'message': {'role': 'user', 'content': 'hi'}, 'seed': []})
+    assert resp.status_code == 402
+    assert client.get('/api/conversations').json['conversations'] == []
@@ -0,0 +1,14 @@
+import hashlib
+from documents import DocumentParser
+
+def test_parse_cache_is_bounded_by_characters():
+    parser = DocumentParser()
+    parser.cache.max_weight = 100
+    parser.parse('a.txt', b'a' * 60, 1000)
+    parser.parse('b.txt', b'b' * 60, 1000)
+    parser.parse('c.txt', b'c' * 200, 1000)
+    assert parser.cache.weight == 60 and len(parser.cache._data) == 1
+    # 最近的 b 仍在缓存中，a 已被淘汰，超过上限的 c 不缓存
+    assert parser.cache.get((hashlib.sha256(b'b' * 60).hexdigest(), '.txt', 1000)) == 'b' * 60
+    parser.cache.clear()
+    assert parser.cache.weight == 0
@@ -0,0 +1,35 @@
+import time
+import routes.chat
+from limits import Limiter, LimitRule
+from official import Upstream
+from routes.chat import make_target, claim_target
+
+def test_failover_claims_the_next_upstream_slot(monkeypatch):
+    limiter = Limiter()
+    monkeypatch.setattr(routes.chat, 'limiter', limiter)
+    first = Upstream({'name': 'a', 'api_endpoint': 'http://a/v1', 'api_key': 'k', 'max_concurrency': 1}, 0)
+    second = Upstream({'name': 'b', 'api_endpoint': 'http://b/v1', 'api_key': 'k', 'max_concurrency': 1}, 1)
+    targets = [make_target(u.api_endpoint, u.api_key, u) for u in (first, second)]
+    targets[0]['lease'] = limiter.try_acquire(first.limit_key, first.rule)
+    job = {'targets': targets, 'leases': [targets[0]['lease']]}
+
+    busy = limiter.try_acquire(second.limit_key, second.rule)
+    assert not claim_target(job, 1)
+    busy.release()
+    assert claim_target(job, 1)
+    # 换到第二个上游后，第一个上游的名额已释放，第二个的名额被本次请求占用
+    assert limiter.try_acquire(first.limit_key, first.rule) is not None
+    assert limiter.try_acquire(second.limit_key, second.rule) is None
+
+def test_renewed_lease_outlives_ttl_and_abandoned_lease_expires():
+    limiter = Limiter()
+    limiter.lease_ttl = 0.3
+    rule = LimitRule(concurrency=1)
+    lease = limiter.try_acquire('user:1', rule)
+    time.sleep(0.2)
+    lease.renew()
+    time.sleep(0.2)
+    assert limiter.try_acquire('user:1', rule) is None
+    # 不再续期 (持有的进程崩溃) 后按 ttl 回收
+    time.sleep(0.3)
+    assert limiter.try_acquire('user:1', rule) is not None
@@ -0,0 +1,88 @@
+import json
+from werkzeug.test import EnvironBuilder
+from conftest import points_of, call_asgi
+from streams import stream_registry
+
+OFFICIAL = {'use_official_api': True, 'model': 'bench-model'}
+REQUEST = {'messages': [{'role': 'user', 'content': 'hi'}], 'models': ['bench-model', 'bench-model-mini']}
+
+def test_multi_streams_every_model(app, login):
+    client, user_id = login(**OFFICIAL)
+    before = points_of(app, user_id)
+    body = client.post('/api/chat/multi', json=REQUEST).get_data(as_text=True)
+    done = [json.loads(line[6:]) for line in body.splitlines() if line.startswith('data: {') and '"done"' in line]
+    assert sorted(d['model'] for d in done) == sorted(REQUEST['models'])
+    assert all(d['outcome'] == 'ok' for d in done)
+    assert points_of(app, user_id) == before - 200
+
+def test_multi_closed_before_first_read_settles_lanes(app, login):
+    client, user_id = login(**OFFICIAL)
+    before, active = points_of(app, user_id), len(stream_registry)
+    # 直接调用 WSGI 应用，模拟服务器在迭代响应之前就关闭它 (客户端已断开)
+    environ = EnvironBuilder(path='/api/chat/multi', method='POST', json=REQUEST,
+                             headers={'Cookie': f"session={client.get_cookie('session').value}"}).get_environ()
+    result = app(environ, lambda status, headers, exc_info=None: None)
+    assert points_of(app, user_id) == before - 200
+    result.close()
+    assert points_of(app, user_id) == before
+    assert len(stream_registry) == active
+
+def test_multi_is_streamed_in_async_mode(app, login):
+    from asgi import ChatASGI
+    client, _ = login(**OFFICIAL)
+    sent = call_asgi(ChatASGI(app), client, 'POST', '/api/chat/multi', REQUEST)
+    bodies = [m for m in sent if m['type'] == 'http.response.body']
+    assert sent[0]['status'] == 200
+    # 逐块发送而不是整体缓冲后一次发出
+    assert len(bodies) > 3 and bodies[0]['more_body']
+    assert b'data: [DONE]' in b''.join(m['body'] for m in bodies)
+
+def test_open_multi_streams_do_not_block_other_routes(app, login, monkeypatch):
+    import asyncio
+    import threading
+    import routes.chat
+    from asgi import ChatASGI
+    from extensions import upstream_clients
+    client, _ = login(**OFFICIAL)
+    cookie = (b'cookie', f"session={client.get_cookie('session').value}".encode())
+    release = threading.Event()
+
+    def held(job, transcoder, probe):
+        release.wait(30)
+        return
+        yield
+    monkeypatch.setattr(routes.chat, 'relay_upstream', held)
+    monkeypatch.setitem(app.config, 'ASYNC_WSGI_THREADS', 2)
+    asgi = ChatASGI(app)
+    body = json.dumps({'messages': REQUEST['messages'], 'models': ['bench-model']}).encode()
+
+    async def request(method, path, payload=b'', started=None):
+        headers = [cookie, (b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+        messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if messages: return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+            if started is not None and message['type'] == 'http.response.body': started.set()
+
+        await asgi({'type': 'http', 'method': method, 'path': path, 'headers': headers}, receive, send)
+        return sent
+
+    async def run():
+        opened = [asyncio.Event() for _ in range(4)]
+        streams = [asyncio.create_task(request('POST', '/api/chat/multi', body, e)) for e in opened]
+        try:
+            # 流数超过 ASYNC_WSGI_THREADS，普通请求仍然及时返回
+            await asyncio.wait_for(asyncio.gather(*(e.wait() for e in opened)), 10)
+            status = await asyncio.wait_for(request('GET', '/api/user_status'), 5)
+            assert status[0]['status'] == 200
+        finally:
+            release.set()
+            await asyncio.wait_for(asyncio.gather(*streams), 30)
+            await upstream_clients.aclose_all()
+
+    asyncio.run(run())
@@ -0,0 +1,32 @@
+import os
+import json
+import config
+from official import OfficialPool
+
+def write(path, text, mtime):
+    path.write_text(text, encoding='utf-8')
+    os.utime(path, ns=(mtime, mtime))
+
+def test_broken_hot_reload_keeps_last_good_config(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, '_official_cache', {'mtime': None, 'data': config.EMPTY_OFFICIAL_CONFIG})
+    path = tmp_path / 'official_key.json'
+    write(path, json.dumps({'api_endpoint': 'http://a/v1', 'api_key': 'k'}), 1_000_000_000)
+    pool = OfficialPool()
+    upstreams = pool.upstreams()
+    assert pool.primary().api_endpoint == 'http://a/v1'
+
+    # 写了一半的文件：继续按上一份配置路由，上游列表不重建，同一版本只报错一次
+    write(path, '{"api_endpoint": "http://b', 2_000_000_000)
+    for _ in range(3):
+        assert pool.primary().api_endpoint == 'http://a/v1'
+        assert pool.upstreams() is upstreams
+    assert capsys.readouterr().out.count('Error loading official_key.json') == 1
+
+    write(path, json.dumps({'api_endpoint': 'http://b/v1', 'api_key': 'k'}), 3_000_000_000)
+    assert pool.primary().api_endpoint == 'http://b/v1'
+
+    path.unlink()
+    assert pool.primary() is None
+    upstreams = pool.upstreams()
+    assert pool.upstreams() is upstreams
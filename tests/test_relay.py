@@ -0,0 +1,76 @@
+import time
+import asyncio
+import pytest
+from bench.fake_upstream import FakeUpstream, UpstreamProfile
+from routes.chat import make_target, relay_upstream, relay_aborted, new_transcoder, new_probe
+from streams import stream_registry
+from extensions import upstream_clients
+
+@pytest.fixture(scope='module')
+def failing():
+    server = FakeUpstream(UpstreamProfile(error_rate=1.0, error_status=503, latency=0)).start()
+    yield server
+    server.stop()
+
+def new_job(*base_urls):
+    return {'targets': [make_target(url, 'test-key') for url in base_urls], 'leases': [], 'response_path': '',
+            'payload': {'model': 'bench-model', 'stream': True, 'messages': [{'role': 'user', 'content': 'hi'}]},
+            'provider': 'openai', 'channel': 'custom', 'reservation': None, 'stream': stream_registry.open(1)}
+
+def relay_sync(app, job):
+    transcoder, probe = new_transcoder(job, app.config), new_probe(job, time.perf_counter())
+    try:
+        return ''.join(relay_upstream(job, transcoder, probe)), probe.outcome
+    finally:
+        stream_registry.close(job['stream'])
+
+def relay_async(app, job):
+    from asgi import ChatASGI
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        await ChatASGI(app).stream_chat(job, [], receive, send, time.perf_counter())
+        await upstream_clients.aclose_all()
+
+    asyncio.run(run())
+    return b''.join(m.get('body', b'') for m in sent[1:]).decode(), None
+
+@pytest.mark.parametrize('relay', [relay_sync, relay_async])
+def test_failover_before_output(app, upstream, failing, relay):
+    text, outcome = relay(app, new_job(failing.base_url, upstream.base_url))
+    assert 'API Error' not in text and 'data: [DONE]' in text
+    assert outcome in (None, 'ok')
+
+@pytest.mark.parametrize('relay', [relay_sync, relay_async])
+def test_last_upstream_error_is_reported(app, failing, relay):
+    text, _ = relay(app, new_job(failing.base_url))
+    assert 'API Error 503' in text
+
+class Reservation:
+    def settle(self, success, fraction=1.0, reason='cancel'):
+        self.settled = (success, fraction, reason)
+
+def test_idle_upstream_is_reported_and_billed_partially(app, monkeypatch):
+    from routes.chat import settle_job, IDLE_ERROR
+    from streaming import sse_error
+    stalled = FakeUpstream(UpstreamProfile(token_rate=1, tokens=3, latency=0)).start()
+    monkeypatch.setattr(stream_registry, 'idle_timeout', 0.3)
+    monkeypatch.setattr(stream_registry, 'heartbeat_interval', 0.1)
+    job = new_job(stalled.base_url)
+    job['reservation'] = Reservation()
+    transcoder, probe = new_transcoder(job, app.config), new_probe(job, time.perf_counter())
+    try:
+        text = ''.join(relay_upstream(job, transcoder, probe))
+    except Exception as e:
+        text = ''.join(relay_aborted(job, transcoder, probe, e))
+    settle_job(job, transcoder, probe)
+    stalled.stop()
+    assert text.endswith(sse_error(IDLE_ERROR)) and probe.outcome == 'timeout'
+    success, fraction, reason = job['reservation'].settled
+    assert success and fraction < 1 and reason == 'timeout'
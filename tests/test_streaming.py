@@ -0,0 +1,49 @@
+import time
+from streaming import StreamTranscoder
+from streams import StreamRegistry, ActiveStream
+
+def delta(content):
+    return 'data: {"choices": [{"delta": {"content": "%s"}}]}' % content
+
+class PausingResponse:
+    """先输出两块，停顿 pause 秒后再输出结尾"""
+
+    def __init__(self, pause):
+        self.pause = pause
+
+    def iter_lines(self):
+        yield delta('a')
+        yield delta('b')
+        time.sleep(self.pause)
+        yield delta('c')
+        yield 'data: [DONE]'
+
+def test_buffer_flushes_while_upstream_pauses():
+    registry = StreamRegistry()
+    transcoder = StreamTranscoder('choices[0].delta.content', flush_chars=256, flush_interval=0.1)
+    started = time.monotonic()
+    sent = []
+    for line in registry.pump(PausingResponse(1.0), ActiveStream(1), transcoder.flush_due):
+        frames = transcoder.flush() if line is None else transcoder.feed(line)
+        sent.extend((time.monotonic() - started, frame) for frame in frames)
+    text_before_pause = ''.join(frame for at, frame in sent if at < 0.5)
+    assert '"b"' in text_before_pause
+
+def test_passthrough_counts_only_non_empty_content():
+    transcoder = StreamTranscoder()
+    assert transcoder.passthrough
+    transcoder.feed('data: {"choices": [{"delta": {"role": "assistant", "content": ""}}]}')
+    transcoder.feed('data: {"choices": [{"delta": {}}]}')
+    assert not transcoder.has_content
+    transcoder.feed(delta('hi'))
+    assert transcoder.has_content
+
+def test_finished_stream_is_billed_in_full():
+    registry = StreamRegistry()
+    transcoder = StreamTranscoder()
+    transcoder.feed(delta('hi'))
+    assert registry.billed_fraction(10) == 10 / registry.cancel_full_chunks
+    assert registry.billed_fraction(10, max_tokens=40) == 0.25
+    transcoder.feed('data: {"choices": [{"delta": {}, "finish_reason": "stop"}]}')
+    assert transcoder.finished
+    assert registry.billed_fraction(10, max_tokens=40, finished=transcoder.finished) == 1.0
@@ -0,0 +1,22 @@
+import json
+import pytest
+from utils import build_dynamic_payload
+
+MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+@pytest.mark.parametrize('template, expected', [
+    ({'model': '{{MODEL}}', 'input': {'text': '{{LAST_MSG_CONTENT}}'}, 'stream': True},
+     {'model': 'm', 'input': {'text': 'hi'}, 'stream': True}),
+    (['{{MODEL}}', {'q': '{{LAST_MSG_CONTENT}}'}], ['m', {'q': 'hi'}]),
+    ('{{LAST_MSG_CONTENT}}', 'hi'),
+    ('plain', 'plain'),
+    (42, 42),
+])
+def test_any_json_template_is_rendered(template, expected):
+    assert build_dynamic_payload(json.dumps(template), 'm', MESSAGES, 'sys') == expected
+
+def test_render_does_not_mutate_compiled_template():
+    template = json.dumps({'messages': '{{MESSAGES}}', 'meta': {'model': '{{MODEL}}'}})
+    first = build_dynamic_payload(template, 'a', MESSAGES, 'sys')
+    second = build_dynamic_payload(template, 'b', MESSAGES, 'sys')
+    assert first['meta'] == {'model': 'a'} and second['meta'] == {'model': 'b'}
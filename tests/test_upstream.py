@@ -0,0 +1,14 @@
+import threading
+from upstream import UpstreamClients
+
+def test_pool_counters_are_exact_under_threads():
+    clients = UpstreamClients()
+
+    def worker():
+        for _ in range(2000): clients.get('http://upstream.test/v1/chat/completions')
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    stats = clients.stats()
+    assert (stats['hits'], stats['misses']) == (8 * 2000 - 1, 1)
+    clients.close_all()
@@ -0,0 +1,144 @@
+import atexit
+import threading
+from http.cookiejar import CookieJar
+from urllib.parse import urlsplit
+import httpx
+
+# HTTP/2 需要可选依赖 h2 (pip install httpx[http2])，缺失时自动退回 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+DEFAULT_HEADERS = {
+    "Content-Type": "application/json",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+def pool_key(url):
+    """按上游源站 (scheme://host:port) 归类，同一站点的不同路径共用连接池"""
+    parts = urlsplit(url.strip())
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}"
+
+class NoCookies(CookieJar):
+    """不保存也不发送 Cookie：同一源站的客户端被所有用户 (各自的 API Key) 共用，
+    上游为某个用户设置的 Cookie 不能出现在其他用户的请求里"""
+
+    def set_cookie(self, cookie):
+        pass
+
+    def extract_cookies(self, response, request):
+        pass
+
+# ================= 上游连接池注册表 =================
+class UpstreamClients:
+    """进程级 httpx.Client 注册表，按上游地址复用 keep-alive 连接"""
+
+    def __init__(self, app=None):
+        self._clients = {}
+        self._async_clients = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.max_connections = 100
+        self.async_max_connections = 2000
+        self.max_keepalive = 20
+        self.keepalive_expiry = 30.0
+        self.connect_timeout = 10.0
+        self.http2 = HTTP2_AVAILABLE
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config
+        self.max_connections = conf.get('UPSTREAM_MAX_CONNECTIONS', self.max_connections)
+        self.async_max_connections = conf.get('UPSTREAM_ASYNC_MAX_CONNECTIONS', self.async_max_connections)
+        self.max_keepalive = conf.get('UPSTREAM_MAX_KEEPALIVE', self.max_keepalive)
+        self.keepalive_expiry = conf.get('UPSTREAM_KEEPALIVE_EXPIRY', self.keepalive_expiry)
+        self.connect_timeout = conf.get('UPSTREAM_CONNECT_TIMEOUT', self.connect_timeout)
+        self.http2 = conf.get('UPSTREAM_HTTP2', True) and HTTP2_AVAILABLE
+        app.extensions['upstream_clients'] = self
+        atexit.register(self.close_all)
+
+    def limits(self, max_connections=None):
+        return httpx.Limits(
+            max_connections=max_connections or self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def timeout(self, read):
+        """单次请求超时：连接阶段统一使用配置值，读取阶段由调用方决定"""
+        return httpx.Timeout(read, connect=self.connect_timeout)
+
+    def count(self, name):
+        """hits / misses 由各请求线程 (及异步模式的事件循环) 同时累加，在锁内更新避免计数丢失"""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, url):
+        key = pool_key(url)
+        client = self._clients.get(key)
+        if client is not None and not client.is_closed:
+            self.count('hits')
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None and not client.is_closed:
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = httpx.Client(
+                limits=self.limits(),
+                timeout=self.timeout(120.0),
+                http2=self.http2,
+                cookies=NoCookies()
+            )
+            self._clients[key] = client
+            return client
+
+    def get_async(self, url):
+        """异步模式 (asgi.py) 使用的 AsyncClient，只能在同一个事件循环内调用"""
+        key = pool_key(url)
+        client = self._async_clients.get(key)
+        if client is not None and not client.is_closed:
+            self.count('hits')
+            return client
+        self.count('misses')
+        client = httpx.AsyncClient(
+            limits=self.limits(self.async_max_connections),
+            timeout=self.timeout(120.0),
+            http2=self.http2,
+            cookies=NoCookies()
+        )
+        self._async_clients[key] = client
+        return client
+
+    async def aclose_all(self):
+        clients = list(self._async_clients.values())
+        self._async_clients.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"Upstream async client close error: {e}")
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                print(f"Upstream client close error: {e}")
+
+    def stats(self):
+        return {
+            'pools': len(self._clients),
+            'async_pools': len(self._async_clients),
+            'hits': self.hits,
+            'misses': self.misses,
+            'http2': self.http2
+        }
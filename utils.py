@@ -1,16 +1,117 @@
 import os
 import json
 import base64
-from cryptography.fernet import Fernet
+import hashlib
+import time
+import threading
+from collections import deque, OrderedDict
+from functools import lru_cache
 from flask import current_app
-from pypdf import PdfReader
-from docx import Document
+
+# ================= 通用缓存 =================
+class TTLCache:
+    """线程安全的有界 TTL 缓存，超出容量时按最近最少使用淘汰，并统计命中率。
+    设置 max_weight 时还按 weigh(value) 的总和 (如文本字符数) 限制占用，超过上限的单个值不缓存"""
+
+    def __init__(self, maxsize=1024, ttl=300.0, max_weight=0, weigh=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = None
+        self.hits = 0
+        self.misses = 0
+
+    def share(self, store, namespace):
+        """多进程模式：改为读写 shared.SharedStore 中的 namespace (值需可 JSON 序列化)，各进程看到同一份"""
+        self._shared = (store, namespace)
+
+    def get(self, key, default=None):
+        if self._shared is not None:
+            store, namespace = self._shared
+            value = store.get(namespace, str(key))
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def _remove(self, key=None):
+        """删除 key (默认最久未使用的一项)，调用方持有锁"""
+        value = self._data.pop(key)[0] if key is not None else self._data.popitem(last=False)[1][0]
+        if self.max_weight: self.weight -= self.weigh(value)
+        return value
+
+    def set(self, key, value):
+        if self._shared is not None:
+            store, namespace = self._shared
+            return store.set(namespace, str(key), value, self.ttl)
+        with self._lock:
+            if key in self._data: self._remove(key)
+            if self.max_weight:
+                weight = self.weigh(value)
+                if weight > self.max_weight: return
+                self.weight += weight
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            while len(self._data) > self.maxsize or (self.max_weight and self.weight > self.max_weight):
+                self._remove()
+
+    def pop(self, key):
+        if self._shared is not None:
+            store, namespace = self._shared
+            value = store.get(namespace, str(key))
+            store.delete(namespace, str(key))
+            return value
+        with self._lock:
+            return self._remove(key) if key in self._data else None
+
+    def discard_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        if self._shared is not None:
+            return self._shared[0].delete(self._shared[1])
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': self._shared[0].count(self._shared[1]) if self._shared else len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
 
 # ================= 安全加密工具 =================
-def get_cipher():
-    key = base64.urlsafe_b64encode(current_app.config['SECRET_KEY'].encode('utf-8').ljust(32)[:32])
+@lru_cache(maxsize=4)
+def _build_cipher(secret_key):
+    # cryptography 在首次加解密时才导入，不计入启动耗时
+    from cryptography.fernet import Fernet
+    key = base64.urlsafe_b64encode(secret_key.encode('utf-8').ljust(32)[:32])
     return Fernet(key)
 
+def get_cipher():
+    # 以 SECRET_KEY 为键缓存 Fernet 实例，密钥变化时自动换新
+    return _build_cipher(current_app.config['SECRET_KEY'])
+
 def encrypt_val(value):
     if not value: return ""
     try:
@@ -27,6 +128,21 @@ def decrypt_val(token):
         print(f"Decryption error: {e}")
         return ""
 
+# 解密后的用户 API Key 缓存，键为 (user_id, 密文)，密文变化即视为新条目
+credential_cache = TTLCache(maxsize=1024, ttl=600.0)
+
+def decrypt_user_key(user_id, token):
+    if not token: return ""
+    key = (user_id, token)
+    value = credential_cache.get(key)
+    if value is None:
+        value = decrypt_val(token)
+        credential_cache.set(key, value)
+    return value
+
+def forget_user_key(user_id):
+    credential_cache.discard_where(lambda key: key[0] == user_id)
+
 # ================= 价格与规则 =================
 def load_price_config():
     try:
@@ -42,85 +158,251 @@ def load_match_rules():
     except:
         return []
 
+class KeywordAutomaton:
+    """Aho-Corasick 多模式匹配：一次扫描模型名即可找出所有命中的关键词"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for keyword, payloads in patterns.items():
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            self.out[state].extend(payloads)
+        # 广度优先构建失配指针，根节点的直接子节点失配到根
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text):
+        state = 0
+        for ch in text:
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            yield from self.out[state]
+
+class CompiledRules:
+    """price.json + model_rules.json 的只读编译快照，整体替换以保证线程安全"""
+    CACHE_LIMIT = 4096
+
+    def __init__(self, rules, price, mtimes):
+        self.rules = rules
+        self.rules_json = json.dumps(rules)
+        self.mtimes = mtimes
+        self.default = price.get('default', 100)
+        self.providers = price.get('providers', {})
+        patterns = {}
+        for order, (keyword, cost) in enumerate(price.get('overrides', {}).items()):
+            patterns.setdefault(keyword, []).append(('override', order, cost))
+        for order, rule in enumerate(rules):
+            for keyword in rule.get('keywords', []):
+                patterns.setdefault(keyword, []).append(('rule', order, rule['id']))
+        self.automaton = KeywordAutomaton(patterns)
+        self.cache = {}
+
+    def resolve(self, model_name):
+        """返回 (provider_id, cost)，与原先逐条扫描的优先级一致：按文件中的先后顺序取第一个命中项"""
+        name = model_name.lower()
+        hit = self.cache.get(name)
+        if hit is not None: return hit
+        best = {'rule': None, 'override': None}
+        for kind, order, value in self.automaton.search(name):
+            if best[kind] is None or order < best[kind][0]:
+                best[kind] = (order, value)
+        if best['rule']:
+            provider_id = best['rule'][1]
+        elif '/' in name:
+            provider_id = name.split('/')[-1].split(':')[0].split('-')[0]
+        else:
+            provider_id = 'default'
+        if best['override']:
+            cost = best['override'][1]
+        else:
+            cost = self.providers.get(provider_id, self.default)
+        if len(self.cache) >= self.CACHE_LIMIT: self.cache = {}
+        self.cache[name] = (provider_id, cost)
+        return provider_id, cost
+
+class ProviderMatcher:
+    """按文件 mtime 热加载的规则匹配器，检查间隔内直接复用当前快照"""
+
+    def __init__(self, rules_path='model_rules.json', price_path='price.json', check_interval=1.0):
+        self.rules_path = rules_path
+        self.price_path = price_path
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _mtimes(self):
+        result = []
+        for path in (self.rules_path, self.price_path):
+            try:
+                result.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def current(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked < self.check_interval:
+            return snapshot
+        with self._lock:
+            self._checked = time.monotonic()
+            mtimes = self._mtimes()
+            if self._snapshot is None or self._snapshot.mtimes != mtimes:
+                self._snapshot = CompiledRules(load_match_rules(), load_price_config(), mtimes)
+            return self._snapshot
+
+provider_matcher = ProviderMatcher()
+
 def identify_provider(model_name):
     if not model_name: return 'default'
-    lower_name = model_name.lower()
-    rules = load_match_rules()
-    for rule in rules:
-        for keyword in rule.get('keywords', []):
-            if keyword in lower_name:
-                return rule['id']
-    if '/' in lower_name:
-        return lower_name.split('/')[-1].split(':')[0].split('-')[0]
-    return 'default'
+    return provider_matcher.current().resolve(model_name)[0]
 
 def calculate_cost(model_name):
-    config = load_price_config()
-    name = model_name.lower()
-    overrides = config.get('overrides', {})
-    for keyword, price in overrides.items():
-        if keyword in name: return price
-    provider_id = identify_provider(name)
-    providers = config.get('providers', {})
-    if provider_id in providers: return providers[provider_id]
-    return config.get('default', 100)
-
-# ================= 文档与 JSON 工具 =================
-def extract_text_from_file(file_storage):
-    filename = file_storage.filename.lower()
-    try:
-        if filename.endswith('.pdf'):
-            reader = PdfReader(file_storage.stream)
-            text = "\n".join([page.extract_text() for page in reader.pages if page.extract_text()])
-            return text[:15000]
-        elif filename.endswith('.docx'):
-            doc = Document(file_storage.stream)
-            text = "\n".join([para.text for para in doc.paragraphs])
-            return text[:15000]
-        elif filename.endswith(('.txt', '.md', '.py', '.js')):
-            return file_storage.stream.read().decode('utf-8', errors='replace')[:15000]
-    except Exception as e:
-        return f"[System Error: Failed to parse file {filename}. Reason: {str(e)}]"
-    return None
+    return provider_matcher.current().resolve(model_name)[1]
 
-def extract_by_path(json_obj, path_str):
+# ================= JSON 工具 =================
+@lru_cache(maxsize=256)
+def compile_path(path_str):
+    """把 'choices[0].delta.content' 预编译为 ((键, 下标), ...)，避免每个 chunk 重新切分字符串"""
+    keys = path_str.replace('[', '.').replace(']', '').split('.')
+    return tuple((key, int(key) if key.lstrip('-').isdigit() else None) for key in keys if key != '')
+
+def get_by_path(json_obj, compiled):
     try:
-        keys = path_str.replace('[', '.').replace(']', '').split('.')
         current = json_obj
-        for key in keys:
-            if key == '': continue
-            if isinstance(current, list): key = int(key)
-            current = current[key]
+        for key, index in compiled:
+            current = current[index] if isinstance(current, list) else current[key]
         return current
-    except:
+    except (KeyError, IndexError, TypeError):
         return None
 
-def build_dynamic_payload(template_str, model, messages, system_prompt):
+def extract_by_path(json_obj, path_str):
+    return get_by_path(json_obj, compile_path(path_str))
+
+# ================= 请求模板 =================
+TEMPLATE_SLOTS = ('{{MESSAGES}}', '{{MODEL}}', '{{SYSTEM_PROMPT}}', '{{LAST_MSG_CONTENT}}')
+
+class CompiledTemplate:
+    """custom_request_template 的编译结果：解析一次，记下每个占位符所在的路径。
+    与旧版一样接受任意 JSON 值 (对象、数组、标量，或整个模板就是一个占位符)"""
+
+    def __init__(self, template_str):
+        payload = json.loads(template_str)
+        self.base = payload
+        self.slots = []
+        if isinstance(payload, str) and payload in TEMPLATE_SLOTS:
+            self.slots.append(((), payload))
+        else:
+            self._scan(payload, ())
+        self.needed = {slot for _, slot in self.slots}
+
+    def _scan(self, obj, path):
+        if isinstance(obj, dict): items = obj.items()
+        elif isinstance(obj, list): items = enumerate(obj)
+        else: return
+        for key, value in items:
+            if isinstance(value, str) and value in TEMPLATE_SLOTS:
+                self.slots.append((path + (key,), value))
+            else:
+                self._scan(value, path + (key,))
+
+    def render(self, values):
+        # 只复制占位符路径上的容器，其余子树与编译结果共享 (调用方不得修改返回值)
+        if self.slots and self.slots[0][0] == (): return values[self.slots[0][1]]
+        if not isinstance(self.base, (dict, list)): return self.base
+        root = list(self.base) if isinstance(self.base, list) else dict(self.base)
+        copied = {(): root}
+        for path, slot in self.slots:
+            parent = root
+            for depth in range(1, len(path)):
+                prefix = path[:depth]
+                node = copied.get(prefix)
+                if node is None:
+                    child = parent[path[depth - 1]]
+                    node = list(child) if isinstance(child, list) else dict(child)
+                    parent[path[depth - 1]] = node
+                    copied[prefix] = node
+                parent = node
+            parent[path[-1]] = values[slot]
+        return root
+
+_template_cache = OrderedDict()
+_template_lock = threading.Lock()
+
+def compile_template(template_str):
+    """按模板内容的哈希缓存编译结果；模板无效时抛出 ValueError"""
+    digest = hashlib.sha1(template_str.encode('utf-8')).hexdigest()
+    compiled = _template_cache.get(digest)
+    if compiled is None:
+        compiled = CompiledTemplate(template_str)
+        with _template_lock:
+            _template_cache[digest] = compiled
+            while len(_template_cache) > 256:
+                _template_cache.popitem(last=False)
+    return compiled
+
+def default_payload(model, messages, system_prompt):
+    return {
+        "model": model,
+        "messages": [{"role": "system", "content": system_prompt}] + messages,
+        "temperature": 0.7,
+        "stream": True
+    }
+
+def attach_documents(messages, excerpts):
+    """把检索到的文档片段附加到最后一条消息的副本上 (多模态消息附加到第一个文本部分)"""
+    if not messages or not excerpts: return messages
+    block = f"\n\n[Relevant excerpts from attached documents]\n{excerpts}"
+    last = dict(messages[-1])
+    content = last.get('content')
+    if isinstance(content, list):
+        parts = [dict(part) for part in content]
+        for part in parts:
+            if part.get('type') == 'text':
+                part['text'] = (part.get('text') or '') + block
+                break
+        else:
+            parts.insert(0, {'type': 'text', 'text': block.lstrip()})
+        last['content'] = parts
+    else:
+        last['content'] = (content or '') + block
+    return messages[:-1] + [last]
+
+def build_dynamic_payload(template_str, model, messages, system_prompt, documents=''):
+    """documents 为检索出的文档摘录，附加到本轮消息后再填入模板"""
+    messages = attach_documents(messages, documents)
     if not template_str:
-        return {
-            "model": model,
-            "messages": [{"role": "system", "content": system_prompt}] + messages,
-            "temperature": 0.7,
-            "stream": True
-        }
+        return default_payload(model, messages, system_prompt)
     try:
-        payload = json.loads(template_str)
-        def recursive_replace(obj):
-            if isinstance(obj, dict): return {k: recursive_replace(v) for k, v in obj.items()}
-            elif isinstance(obj, list): return [recursive_replace(i) for i in obj]
-            elif isinstance(obj, str):
-                if obj == "{{MESSAGES}}": return [{"role": "system", "content": system_prompt}] + messages
-                if obj == "{{MODEL}}": return model
-                if obj == "{{SYSTEM_PROMPT}}": return system_prompt
-                if obj == "{{LAST_MSG_CONTENT}}": return messages[-1]['content'] if messages else ""
-                return obj
-            else: return obj
-        return recursive_replace(payload)
-    except Exception as e:
+        compiled = compile_template(template_str)
+    except ValueError as e:
+        # 设置保存时已校验，这里只会遇到旧版遗留的无效模板
         print(f"Payload Build Error: {e}")
-        return {
-            "model": model,
-            "messages": [{"role": "system", "content": system_prompt}] + messages,
-            "temperature": 0.7,
-            "stream": True
-        }
\ No newline at end of file
+        return default_payload(model, messages, system_prompt)
+    values = {}
+    if '{{MESSAGES}}' in compiled.needed:
+        values['{{MESSAGES}}'] = [{"role": "system", "content": system_prompt}] + messages
+    if '{{MODEL}}' in compiled.needed: values['{{MODEL}}'] = model
+    if '{{SYSTEM_PROMPT}}' in compiled.needed: values['{{SYSTEM_PROMPT}}'] = system_prompt
+    if '{{LAST_MSG_CONTENT}}' in compiled.needed:
+        values['{{LAST_MSG_CONTENT}}'] = messages[-1]['content'] if messages else ""
+    return compiled.render(values)